@@ -75,6 +75,11 @@ setup(
             'six',
             # 'pyreadline',
         ],
+        extras_require={
+            # memory-mapped arrays (mmap_arrays), the queries of the
+            # state table, and the priorities learned from it
+            'numpy': ['numpy'],
+        },
 
         tests_require=['nose'],
 )
@@ -9,7 +9,7 @@ logger.setLevel(logging.DEBUG)
 
 from .constants import *
 from .state import *
-from .storage import StorageFilesystem
+from .storage import StorageFilesystem, StorageSQLite
 
 from .jobs import progress
 from .scripts.master import read_rc_files
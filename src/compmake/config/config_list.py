@@ -8,17 +8,20 @@ __all__ = [
     'CONFIG_GENERAL',
     'CONFIG_APPEARANCE',
     'CONFIG_PARALLEL',
+    'CONFIG_STORAGE',
 ]
 
 CONFIG_GENERAL = 'General configuration'
 CONFIG_APPEARANCE = 'Visualization'
 CONFIG_PARALLEL = 'Multiprocessing backend'
 CONFIG_MULTYVAC = 'Multyvac backend'
+CONFIG_STORAGE = 'Storage'
 
 add_config_section(name=CONFIG_GENERAL, desc='', order=-1)
 add_config_section(name=CONFIG_APPEARANCE, desc='', order=2)
 add_config_section(name=CONFIG_PARALLEL, desc='', order=3)
 add_config_section(name=CONFIG_MULTYVAC, desc='', order=4)
+add_config_section(name=CONFIG_STORAGE, desc='', order=5)
 
 add_config_switch('recurse', False,
                   desc="Default choice for parmake and make whether to run "
@@ -144,3 +147,126 @@ add_config_switch('multyvac_sync_up', '',
 add_config_switch('multyvac_core', 'c2',
                       desc="Multyvac core (c1,c2,f2)",
                       section=CONFIG_MULTYVAC)
+
+codec_desc = (' Either "default" (pickle, gzipped if the DB is compressed) '
+              'or one of "none", "gzip", "zstd", "lz4", optionally with a '
+              'level, as in "zstd:3".')
+
+add_config_switch('codec_job', 'none',
+                  desc='Codec for the job definitions.' + codec_desc,
+                  section=CONFIG_STORAGE)
+
+add_config_switch('codec_cache', 'none',
+                  desc='Codec for the job cache records.' + codec_desc,
+                  section=CONFIG_STORAGE)
+
+add_config_switch('codec_args', 'default',
+                  desc='Codec for the job arguments.' + codec_desc,
+                  section=CONFIG_STORAGE)
+
+add_config_switch('codec_res', 'default',
+                  desc='Codec for the job results.' + codec_desc,
+                  section=CONFIG_STORAGE)
+
+add_config_switch('mmap_arrays', False,
+                  desc='Store the numpy arrays in the results of jobs as '
+                       '".npy" files, loaded as read-only memory maps.',
+                  section=CONFIG_STORAGE)
+
+add_config_switch('mmap_arrays_min_size', 1024 * 1024,
+                  desc='Minimum size (bytes) of the arrays stored as '
+                       '".npy" files if mmap_arrays is true.',
+                  section=CONFIG_STORAGE)
+
+add_config_switch('write_behind', False,
+                  desc='Write the result of a job in a background thread '
+                       'while the job finishes. The job is reported as done '
+                       'only after the result is written.',
+                  section=CONFIG_STORAGE)
+
+add_config_switch('blobs', False,
+                  desc='Store the large objects in the arguments and results '
+                       'of jobs only once, identified by their content. '
+                       'Use "gc-blobs" to delete the ones not used anymore.',
+                  section=CONFIG_STORAGE)
+
+add_config_switch('blobs_min_size', 1024 * 1024,
+                  desc='Minimum size (bytes, pickled) of the objects stored '
+                       'as blobs if blobs is true.',
+                  section=CONFIG_STORAGE)
+
+add_config_switch('state_table', True,
+                  desc='Keep a table with the state of all jobs in the '
+                       'directory "state_table" of the DB, used by "stats" '
+                       'and the "done", "failed", ... aliases.',
+                  section=CONFIG_STORAGE)
+
+add_config_switch('storage_metrics', True,
+                  desc='Count the operations of the storage, by key prefix '
+                       '(see "storage-stats").',
+                  section=CONFIG_STORAGE)
+
+add_config_switch('shared_cache', '',
+                  desc='Directory of a result cache shared with other DBs '
+                       '(for example on a shared volume). Before computing '
+                       'a job, its result is looked up there by the '
+                       'fingerprint of its command and arguments.',
+                  section=CONFIG_STORAGE)
+
+add_config_switch('shared_cache_max_mb', 10 * 1024,
+                  desc='Size limit (MB) of the shared cache; the results '
+                       'used least recently are deleted first.',
+                  section=CONFIG_STORAGE)
+
+add_config_switch('shared_cache_min_time', 1.0,
+                  desc='Only the results of the jobs computed in at least '
+                       'this many seconds are added to the shared cache.',
+                  section=CONFIG_STORAGE)
+
+add_config_switch('cold_dir', '',
+                  desc='Directory where "tier-demote" moves the large '
+                       'results and blobs that were not read for a while '
+                       '(filesystem DB only). They are still read '
+                       'transparently.',
+                  section=CONFIG_STORAGE)
+
+add_config_switch('cold_min_size', 16 * 1024 * 1024,
+                  desc='Minimum size (bytes) of the results moved to '
+                       'cold_dir.',
+                  section=CONFIG_STORAGE)
+
+add_config_switch('cold_after_days', 30.0,
+                  desc='Results not read for this many days are moved '
+                       'to cold_dir.',
+                  section=CONFIG_STORAGE)
+
+add_config_switch('cold_promote', True,
+                  desc='Move a result back from cold_dir when it is read.',
+                  section=CONFIG_STORAGE)
+
+add_config_switch('early_cutoff', False,
+                  desc='Record a digest of each result; a job whose children '
+                       'were made again, but gave the same results as when it '
+                       'was computed, is not made again.',
+                  section=CONFIG_GENERAL)
+
+add_config_switch('check_code', False,
+                  desc='A job is out of date if the code of its function, '
+                       'or of the functions that it uses, changed since it '
+                       'was computed.',
+                  section=CONFIG_GENERAL)
+
+add_config_switch('priority', 'heuristic',
+                  desc='How to choose the next job: "heuristic" (bonus for '
+                       'the dynamic jobs and the top-level targets) or '
+                       '"critical_path" (the longest predicted time to a '
+                       'target, using the durations of the past runs).',
+                  section=CONFIG_GENERAL)
+
+add_config_switch('job_index', True,
+                  desc='Keep an index of the definer and of the number of '
+                       'parents of each job in the directory "job_index" of '
+                       'the DB, used to find the top-level targets and the '
+                       'jobs defined by other jobs without reading all of '
+                       'them.',
+                  section=CONFIG_STORAGE)
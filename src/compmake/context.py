@@ -11,18 +11,21 @@ __all__ = [
 
 
 class Context(object):
-    @contract(db='None|str|isinstance(StorageFilesystem)',
+    @contract(db='None|str|isinstance(StorageFilesystem)'
+                 '|isinstance(StorageSQLite)|isinstance(MemoryCache)',
               currently_executing='None|list(str)')
     def __init__(self, db=None, currently_executing=None):
         """
-            db: if a string, it is used as path for the DB
+            db: if a string, it is used as path for the DB;
+                use the prefix "sqlite:" to select the SQLite engine.
+                It can be a MemoryCache wrapping another storage.
             
             currently_executing: str, job currently executing
                 defaults to ['root']
         """
         if currently_executing is None:
             currently_executing = ['root']
-        from compmake import StorageFilesystem
+        from compmake.storage import StorageFilesystem, open_storage
 
         if db is None:
             prog, _ = os.path.splitext(os.path.basename(sys.argv[0]))
@@ -32,7 +35,7 @@ class Context(object):
             db = StorageFilesystem(dirname, compress=True)
 
         if isinstance(db, six.string_types):
-            db = StorageFilesystem(db, compress=True)
+            db = open_storage(db, compress=True)
 
         assert db is not None
         self.compmake_db = db
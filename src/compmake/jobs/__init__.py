@@ -1,10 +1,21 @@
 # -*- coding: utf-8 -*-
 from .storage import *
+from .graph_index import *
+from .changes import *
+from .array_files import *
+from .blobs import *
+from .state_table import *
+from .job_index import *
+from .shared_cache import *
+from .early_cutoff import *
+from .code_fingerprint import *
+from .garbage import *
 from .progress_imp2 import *
 from .queries import *
 from .uptodate import *
 from .actions import *
 from .priority import *
+from .schedule import *
 from .manager import *
 from .syntax.parsing import *
 from .dependencies import *
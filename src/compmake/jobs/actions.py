@@ -9,15 +9,20 @@ import six
 from compmake import get_compmake_config, logger
 from compmake.events import publish
 from compmake.exceptions import JobFailed, JobInterrupted
-from compmake.structures import IntervalTimer, Cache
+from compmake.structures import IntervalTimer, Cache, walltime_overhead
 from compmake.utils import OutputCapture, setproctitle
+from compmake.utils.pickle_frustration import pickle_main_context_load
 
 from .dependencies import collect_dependencies
+from .early_cutoff import children_unchanged, record_digests
 from .job_execution import job_compute
 from .progress_imp2 import init_progress_tracking
-from .queries import direct_parents
-from .storage import delete_job_cache, get_job, get_job_cache, set_job_cache, set_job_userobject, job_cache_exists, \
-    set_job, job_exists
+from .queries import definition_closure, direct_parents, parents
+from .shared_cache import get_shared_cache, job_fingerprint, not_shareable
+from .write_behind import get_write_behind
+from .storage import get_job, get_job_cache, set_job_cache, set_job_userobject, \
+    set_job, job_exists, get_job_userobject, delete_job_caches, \
+    delete_jobs_data
 
 
 def clean_targets(job_list, db):
@@ -26,12 +31,10 @@ def clean_targets(job_list, db):
 
     # now we need to delete the definition closure
 
-    from compmake.jobs.queries import definition_closure
     closure = definition_closure(job_list, db)
 
     basic = job_list - closure
 
-    from compmake.jobs.queries import parents
     other_clean = set()
     for job_id in job_list:
         other_clean.update(parents(job_id, db))
@@ -45,15 +48,10 @@ def clean_targets(job_list, db):
         clean_cache_relations(job_id, db)
 
     # delete all in closure
-    for job_id in closure:
-        from compmake.jobs.storage import delete_all_job_data
-        delete_all_job_data(job_id, db)
+    delete_jobs_data(closure, db)
 
     # just remove cache in basic
-    for job_id in basic:
-        # Cleans associated objects
-        if job_cache_exists(job_id, db):
-            delete_job_cache(job_id, db)
+    delete_job_caches(basic, db)
 
     # now we have to undo this one:
     # jobs_depending_on_this = direct_parents(job_id, self.db)
@@ -172,6 +170,21 @@ def make(job_id, context, echo=False):  # @UnusedVariable
         # print('%s was not DONE' % job_id)
         prev_defined_jobs = None
 
+    # the children were made again, but maybe with the same results
+    if children_unchanged(job, cache, db):
+        return make_cut_off(job_id, cache, db)
+
+    shared_cache = get_shared_cache()
+    fingerprint = None
+    if shared_cache is not None:
+        fingerprint = job_fingerprint(job_id, db)
+        if fingerprint is not None:
+            with pickle_main_context_load(job.pickle_main_context):
+                found, user_object = shared_cache.get(fingerprint)
+            if found:
+                return make_from_shared_cache(job, user_object,
+                                              fingerprint, int_make, db)
+
     # Note that at this point we save important information in the Cache
     # so if we set this then it's going to destroy it
     # cache.state = Cache.IN _ PROGRESS
@@ -318,6 +331,15 @@ def make(job_id, context, echo=False):  # @UnusedVariable
 
     int_save_results = IntervalTimer()
 
+    if get_compmake_config('write_behind'):
+        # write the result in the background while we do the rest,
+        # including hashing it for record_digests()
+        pending = get_write_behind().submit(set_job_userobject, job_id,
+                                            user_object, db=db)
+    else:
+        set_job_userobject(job_id, user_object, db=db)
+        pending = None
+
     # print('Now %s has defined %s' % (job_id, new_jobs))
     if prev_defined_jobs is not None:
         # did we defined fewer jobs this time around?
@@ -333,7 +355,18 @@ def make(job_id, context, echo=False):  # @UnusedVariable
 
     # print('Now %s has deleted %s' % (job_id, deleted_jobs))
 
-    set_job_userobject(job_id, user_object, db=db)
+    user_object_deps = collect_dependencies(user_object)
+
+    if (fingerprint is not None and not user_object_deps and
+            int_compute.get_walltime_used() >=
+            get_compmake_config('shared_cache_min_time')):
+        try:
+            with pickle_main_context_load(job.pickle_main_context):
+                shared_cache.publish(fingerprint, user_object)
+        except Exception as e:
+            logger.warning('Could not add %r to the shared cache: %s' %
+                           (job_id, e))
+
     int_save_results.stop()
 
     #    logger.debug('Save time for %s: %s s' % (job_id, walltime_save_result))
@@ -355,6 +388,7 @@ def make(job_id, context, echo=False):  # @UnusedVariable
     cache.int_compute = int_compute
     cache.int_gc = int_gc
     cache.int_save_results = int_save_results
+    cache.walltime_overhead = walltime_overhead(cache)
 
     cache.timestamp = end_time
 
@@ -362,9 +396,74 @@ def make(job_id, context, echo=False):  # @UnusedVariable
     cache.cputime_used = int_make.get_cputime_used()
     cache.host = host
     cache.jobs_defined = new_jobs
+    if shared_cache is not None and fingerprint is None:
+        cache.fingerprint = not_shareable
+    else:
+        cache.fingerprint = fingerprint
+    cache.code_fingerprint = getattr(job, 'code_fingerprint', None)
+    record_digests(cache, job, user_object, db)
+
+    if pending is not None:
+        # The cache must say DONE only once the result is written.
+        try:
+            pending.wait()
+        except Exception as e:
+            bt = traceback.format_exc()
+            s = 'Could not write the result: %s: %s' % (type(e).__name__, e)
+            mark_as_failed(job_id, s, backtrace=bt, db=db)
+            raise JobFailed(job_id=job_id, reason=s, bt=bt,
+                            deleted_jobs=deleted_jobs)
+        int_save_results.stop()
+        cache.walltime_overhead = walltime_overhead(cache)
+
     set_job_cache(job_id, cache, db=db)
 
     return dict(user_object=user_object,
-                user_object_deps=collect_dependencies(user_object),
+                user_object_deps=user_object_deps,
                 new_jobs=new_jobs,
                 deleted_jobs=deleted_jobs)
+
+
+def make_cut_off(job_id, cache, db):
+    """ For a job that is still up to date because its children gave the
+        same results as before: returns the same as make(), without
+        computing it. """
+    user_object = get_job_userobject(job_id, db=db)
+    return dict(user_object=user_object,
+                user_object_deps=collect_dependencies(user_object),
+                new_jobs=set(cache.jobs_defined),
+                deleted_jobs=set())
+
+
+def make_from_shared_cache(job, user_object, fingerprint, int_make, db):
+    """ Marks the job as done with the result found in the shared cache.
+        Returns the same as make(). """
+    job_id = job.job_id
+    int_save_results = IntervalTimer()
+    set_job_userobject(job_id, user_object, db=db)
+    int_save_results.stop()
+    int_make.stop()
+
+    cache = Cache(Cache.DONE)
+    cache.int_make = int_make
+    cache.int_load_results = IntervalTimer()
+    cache.int_compute = IntervalTimer()
+    cache.int_gc = IntervalTimer()
+    for interval in [cache.int_load_results, cache.int_compute, cache.int_gc]:
+        interval.stop()
+    cache.int_save_results = int_save_results
+    cache.walltime_overhead = walltime_overhead(cache)
+    cache.timestamp = time()
+    cache.walltime_used = int_make.get_walltime_used()
+    cache.cputime_used = int_make.get_cputime_used()
+    cache.host = 'shared-cache'
+    cache.jobs_defined = set()
+    cache.fingerprint = fingerprint
+    cache.code_fingerprint = getattr(job, 'code_fingerprint', None)
+    record_digests(cache, job, user_object, db)
+    set_job_cache(job_id, cache, db=db)
+
+    return dict(user_object=user_object,
+                user_object_deps=set(),
+                new_jobs=set(),
+                deleted_jobs=set())
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+    Stores the large numpy arrays found in the results of jobs as
+    ".npy" files next to the DB, so that they can be loaded as
+    read-only memory maps: jobs reading the same result share
+    the page cache instead of each unpickling its own copy.
+
+    Each result writes new files, named after a version of the result,
+    and the files of the previous result are removed only after the
+    new result was written (remove_stale_array_files()): a reader, or
+    a process that crashes in between, never pairs a result with the
+    arrays of another one.
+"""
+import hashlib
+import os
+import re
+import shutil
+import uuid
+
+from compmake.state import get_compmake_config
+
+__all__ = [
+    'ArrayFile',
+    'ResultWithArrayFiles',
+    'array_files_dir',
+    'externalize_arrays',
+    'remove_stale_array_files',
+    'load_array_files',
+    'delete_array_files',
+    'array_files_sizeof',
+]
+
+# subdirectory of the DB containing the array files
+array_files_dirname = 'arrays'
+
+# "<name>.tmp.<pid>.npy", being written by process pid
+tmp_pattern = re.compile(r'\.tmp\.(\d+)\.npy$')
+
+
+class ArrayFile(object):
+    """ Placeholder for an array stored in a ".npy" file. """
+
+    def __init__(self, filename):
+        # relative to the DB directory
+        self.filename = filename
+
+    def __repr__(self):
+        return 'ArrayFile(%r)' % self.filename
+
+
+class ResultWithArrayFiles(object):
+    """ What is stored instead of a result containing ArrayFile's. """
+
+    def __init__(self, value, filenames):
+        self.value = value
+        self.filenames = filenames
+
+
+def array_files_dir(job_id, db):
+    """ Returns the directory with the array files of the job. """
+    h = hashlib.md5(job_id.encode('utf-8')).hexdigest()
+    safe = re.sub(r'[^\w.-]', '_', job_id)[:64]
+    return os.path.join(db.basepath, array_files_dirname,
+                        '%s-%s' % (safe, h[:8]))
+
+
+def _should_externalize(x, np, min_size):
+    return (isinstance(x, np.ndarray) and not x.dtype.hasobject and
+            x.nbytes >= min_size)
+
+
+def externalize_arrays(job_id, obj, db):
+    """
+        Writes the large arrays contained in obj (possibly inside
+        dicts, lists, tuples) to ".npy" files.
+
+        Returns either obj itself, or a ResultWithArrayFiles.
+    """
+    if not get_compmake_config('mmap_arrays'):
+        return obj
+    try:
+        import numpy as np
+    except ImportError:
+        return obj
+
+    min_size = get_compmake_config('mmap_arrays_min_size')
+    dirname = array_files_dir(job_id, db)
+    version = uuid.uuid4().hex[:12]
+    filenames = []
+
+    def write(x):
+        filename = os.path.join(dirname,
+                                '%s-%d.npy' % (version, len(filenames)))
+        relative = os.path.relpath(filename, db.basepath)
+        filenames.append(relative)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp = '%s.tmp.%s.npy' % (filename, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                np.save(f, x, allow_pickle=False)
+        except:
+            os.unlink(tmp)
+            raise
+        os.rename(tmp, filename)
+        return ArrayFile(relative)
+
+    def replace(x):
+        if _should_externalize(x, np, min_size):
+            return write(x)
+        if type(x) is dict:
+            return dict((k, replace(v)) for k, v in x.items())
+        if type(x) in (list, tuple):
+            return type(x)(replace(v) for v in x)
+        return x
+
+    value = replace(obj)
+    if not filenames:
+        return obj
+    return ResultWithArrayFiles(value, filenames)
+
+
+def remove_stale_array_files(job_id, res, db):
+    """
+        Removes the array files of the job that are not used by res (the
+        value returned by externalize_arrays()); call it after res was
+        written. The files being written by other processes are left.
+    """
+    dirname = array_files_dir(job_id, db)
+    if not os.path.exists(dirname):
+        return
+    filenames = res.filenames if isinstance(res, ResultWithArrayFiles) else []
+    keep = set(os.path.join(db.basepath, x) for x in filenames)
+    mine = str(os.getpid())
+    for entry in os.scandir(dirname):
+        m = tmp_pattern.search(entry.name)
+        if m is not None and m.group(1) != mine:
+            continue
+        if not entry.path in keep:
+            _unlink(entry.path)
+    if not keep:
+        try:
+            os.rmdir(dirname)
+        except OSError:
+            # another process is writing there
+            pass
+
+
+def _unlink(filename):
+    try:
+        os.unlink(filename)
+    except FileNotFoundError:
+        # removed by another process
+        pass
+
+
+def load_array_files(res, db):
+    """ Inverse of externalize_arrays(). """
+    if not isinstance(res, ResultWithArrayFiles):
+        return res
+    import numpy as np
+
+    def replace(x):
+        if isinstance(x, ArrayFile):
+            filename = os.path.join(db.basepath, x.filename)
+            return np.load(filename, mmap_mode='r')
+        if type(x) is dict:
+            return dict((k, replace(v)) for k, v in x.items())
+        if type(x) in (list, tuple):
+            return type(x)(replace(v) for v in x)
+        return x
+
+    return replace(res.value)
+
+
+def delete_array_files(job_id, db):
+    dirname = array_files_dir(job_id, db)
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+
+
+def array_files_sizeof(job_id, db):
+    """ Returns the total size of the array files of the job. """
+    dirname = array_files_dir(job_id, db)
+    if not os.path.exists(dirname):
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(dirname))
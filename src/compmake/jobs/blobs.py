@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+    Content-addressed storage for the large objects found in the
+    arguments and results of jobs.
+
+    Each large object is pickled and stored once, under the key
+    "cm-blob-<sha256>"; the records contain a BlobRef instead. The hash
+    is computed every time from the content (the bytes of strings and
+    numpy arrays, with their type, dtype and shape, or the pickle of the
+    other objects), so an object changed in place gets a new blob.
+
+    For each record containing references there is a key
+    "cm-blobrefs-<record key>" with the list of hashes it uses;
+    the reference counts are computed from these lists, and the
+    blobs that are not referenced anymore are deleted by gc_blobs().
+"""
+import hashlib
+import sys
+
+from compmake.state import get_compmake_config
+from compmake.storage.batch import get_many
+
+from ..structures import Promise
+
+if sys.version_info[0] >= 3:
+    import pickle  # @UnusedImport
+else:
+    import cPickle as pickle  # @Reimport
+
+__all__ = [
+    'BlobRef',
+    'RecordWithBlobs',
+    'blob2key',
+    'blobrefs_key',
+    'store_with_blobs',
+    'load_with_blobs',
+    'blob_refcounts',
+    'gc_blobs',
+]
+
+blob_prefix = 'cm-blob-'
+blobrefs_prefix = 'cm-blobrefs-'
+
+
+def blob2key(h):
+    return '%s%s' % (blob_prefix, h)
+
+
+def blobrefs_key(key):
+    """ The key with the list of blobs used by the record key. """
+    return '%s%s' % (blobrefs_prefix, key)
+
+
+class BlobRef(object):
+    """ Placeholder for an object stored as a blob. """
+
+    def __init__(self, h):
+        self.h = h
+
+    def __repr__(self):
+        return 'BlobRef(%r)' % self.h
+
+
+class RecordWithBlobs(object):
+    """ What is stored instead of a record containing BlobRef's. """
+
+    def __init__(self, value, hashes):
+        self.value = value
+        self.hashes = hashes
+
+
+def _small_leaf(x):
+    return x is None or isinstance(x, (bool, int, float, complex, Promise))
+
+
+def _is_array(x):
+    """ Whether x is a numpy array with a buffer that can be hashed. """
+    dtype = getattr(x, 'dtype', None)
+    return (dtype is not None and hasattr(x, 'shape') and
+            hasattr(x, 'tobytes') and not dtype.hasobject)
+
+
+def _content(x):
+    """ Returns (size, parts to hash) for the objects whose size
+        is known without pickling them, or None for the others. """
+    if isinstance(x, bytes):
+        return len(x), [x]
+    if isinstance(x, str):
+        data = x.encode('utf-8', 'surrogatepass')
+        return len(data), [data]
+    if _is_array(x):
+        header = '%r %r' % (x.dtype.descr, x.shape)
+        # a copy only if it is not contiguous
+        data = (x.reshape(-1).view('u1') if x.flags.c_contiguous
+                else x.tobytes())
+        return x.nbytes, [header.encode('utf-8'), data]
+    return None
+
+
+def _as_blob(x, min_size):
+    """ Returns (hash, pickle) if x should be a blob, else (None, None).
+        The pickle is None if x was hashed without pickling it. """
+    content = _content(x)
+    if content is not None:
+        size, parts = content
+        if size < min_size:
+            return None, None
+        t = type(x)
+        h = hashlib.sha256(('%s.%s\n' % (t.__module__, t.__name__))
+                           .encode('utf-8'))
+        for part in parts:
+            h.update(part)
+        return h.hexdigest(), None
+
+    data = pickle.dumps(x, pickle.HIGHEST_PROTOCOL)
+    if len(data) < min_size:
+        return None, None
+    return hashlib.sha256(data).hexdigest(), data
+
+
+def store_with_blobs(key, obj, db):
+    """ Writes obj in db[key], storing the large objects it contains
+        (possibly inside dicts, lists, tuples) as blobs. """
+    if not get_compmake_config('blobs'):
+        db[key] = obj
+        return
+
+    min_size = get_compmake_config('blobs_min_size')
+    # hash -> (object, pickle or None)
+    found = {}
+
+    def replace(x):
+        if type(x) is dict:
+            return dict((k, replace(v)) for k, v in x.items())
+        if type(x) in (list, tuple):
+            return type(x)(replace(v) for v in x)
+        if _small_leaf(x):
+            return x
+        h, data = _as_blob(x, min_size)
+        if h is None:
+            return x
+        found[h] = (x, data)
+        return BlobRef(h)
+
+    obj = replace(obj)
+
+    refs = blobrefs_key(key)
+    if not found:
+        if refs in db:
+            del db[refs]
+        db[key] = obj
+        return
+
+    hashes = sorted(found)
+    # references first, so that gc_blobs() never sees a blob
+    # without its references
+    db[refs] = hashes
+    for h in hashes:
+        if not blob2key(h) in db:
+            x, data = found[h]
+            if data is None:
+                data = pickle.dumps(x, pickle.HIGHEST_PROTOCOL)
+            db[blob2key(h)] = data
+    db[key] = RecordWithBlobs(obj, hashes)
+
+
+def load_with_blobs(res, db):
+    """ Inverse of store_with_blobs(), given the value of db[key]. """
+    if not isinstance(res, RecordWithBlobs):
+        return res
+    datas = get_many(db, [blob2key(h) for h in res.hashes])
+    objects = dict((h, pickle.loads(datas[blob2key(h)]))
+                   for h in res.hashes)
+
+    def replace(x):
+        if isinstance(x, BlobRef):
+            return objects[x.h]
+        if type(x) is dict:
+            return dict((k, replace(v)) for k, v in x.items())
+        if type(x) in (list, tuple):
+            return type(x)(replace(v) for v in x)
+        return x
+
+    return replace(res.value)
+
+
+def blob_refcounts(db):
+    """ Returns a dict hash -> number of records using it,
+        including the blobs not used anymore. """
+    counts = dict((k[len(blob_prefix):], 0)
+                  for k in db.keys_with_prefix(blob_prefix))
+    for key, hashes in get_many(db,
+                                db.keys_with_prefix(blobrefs_prefix)).items():
+        if not key[len(blobrefs_prefix):] in db:
+            # the record was deleted
+            continue
+        for h in hashes:
+            counts[h] = counts.get(h, 0) + 1
+    return counts
+
+
+def gc_blobs(db, dry_run=False):
+    """
+        Deletes the blobs that are not referenced anymore, and the
+        lists of references of records that were deleted.
+
+        Do not run while other processes write to the DB.
+        Returns a tuple (number of blobs deleted, bytes freed).
+    """
+    # list the blobs before the references (see store_with_blobs())
+    blobs = db.keys_with_prefix(blob_prefix)
+    counts = blob_refcounts(db)
+    ndeleted = nbytes = 0
+    for key in blobs:
+        if counts.get(key[len(blob_prefix):], 0) == 0:
+            ndeleted += 1
+            nbytes += db.sizeof(key)
+            if not dry_run:
+                del db[key]
+    if not dry_run:
+        for refs in db.keys_with_prefix(blobrefs_prefix):
+            if not refs[len(blobrefs_prefix):] in db:
+                del db[refs]
+    return ndeleted, nbytes
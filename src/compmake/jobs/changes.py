@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+    Notes which jobs are changed in the DB by this process, so that the
+    views on the DB (CacheQueryDB) can forget only what concerns those
+    jobs, instead of everything, after each command.
+
+    The functions writing the jobs in storage.py call note_jobs_changed();
+    the manager calls note_jobs_changed_elsewhere() for the jobs changed
+    by its workers.
+
+    The other compmake processes using the same DB at the same time are
+    noticed with the file ".compmake-writes" in the DB: every process
+    writing jobs appends a line with its token (the workers of parmake
+    share the one of the process that forked them, as the manager notes
+    their changes); a line of another token means that everything might
+    have changed (see WritesLog).
+"""
+import os
+import socket
+import weakref
+
+from compmake.utils.safe_write import safe_write
+
+__all__ = [
+    'JobChanges',
+    'WritesLog',
+    'watch_job_changes',
+    'note_jobs_changed',
+    'note_jobs_changed_elsewhere',
+]
+
+writes_filename = '.compmake-writes'
+
+# the log is started again when it gets larger than this
+writes_max_size = 10 * 1000 * 1000
+
+
+class WritesLog(object):
+    """ Tells whether other processes wrote jobs in the DB since
+        the last call of written_elsewhere(). """
+
+    def __init__(self, basepath):
+        self.filename = os.path.join(basepath, writes_filename)
+        self.token = writer_token()
+        st = self._stat()
+        self.inode = st.st_ino if st is not None else None
+        self.offset = st.st_size if st is not None else 0
+
+    def _stat(self):
+        try:
+            return os.stat(self.filename)
+        except OSError:
+            return None
+
+    def written_elsewhere(self):
+        st = self._stat()
+        if st is None:
+            # removed: the DB might have been, too
+            res = self.inode is not None
+            self.inode = None
+            self.offset = 0
+            return res
+
+        res = False
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            # created, or started again; what was appended to the old one
+            # since the last time is lost
+            res = self.inode is not None
+            self.inode = st.st_ino
+            self.offset = 0
+
+        if st.st_size > self.offset:
+            with open(self.filename, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+            # ignore a partially written last line
+            end = data.rfind(b'\n') + 1
+            self.offset += end
+            tokens = set(data[:end].decode('utf-8').split('\n'))
+            tokens.discard('')
+            if tokens - set([self.token]):
+                res = True
+        return res
+
+
+def writer_token():
+    """ The token of the writes of this process (and of the processes it
+        forks afterwards). """
+    if Instances.token is None:
+        Instances.token = '%s:%d' % (socket.gethostname(), os.getpid())
+    return Instances.token
+
+
+def _note_write(basepath):
+    filename = os.path.join(basepath, writes_filename)
+    line = writer_token() + '\n'
+    # a single write() on a file opened in append mode
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, line.encode('utf-8'))
+        size = os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+    if size > writes_max_size:
+        with safe_write(filename, mode='w'):
+            pass
+
+
+class JobChanges(object):
+    """ The jobs changed since the last call to take(). """
+
+    def __init__(self, basepath):
+        self.job_ids = set()
+        # whether some jobs might have been defined or deleted
+        self.defined = False
+        self.writes = WritesLog(basepath)
+
+    def take(self):
+        """ Returns the tuple (job_ids, defined, elsewhere) and starts
+            again; elsewhere is True if other processes wrote jobs. """
+        elsewhere = self.writes.written_elsewhere()
+        res = self.job_ids, self.defined, elsewhere
+        self.job_ids = set()
+        self.defined = False
+        return res
+
+
+def _key(db):
+    basepath = getattr(db, 'basepath', None)
+    if basepath is None:
+        return None
+    return basepath, os.getpid()
+
+
+class Instances(object):
+    # (basepath, pid) -> WeakSet of JobChanges
+    watchers = {}
+    # see writer_token()
+    token = None
+
+
+def watch_job_changes(db):
+    """
+        Returns a JobChanges that collects the changes to the jobs of db
+        made by this process, and notices the ones made by others, or
+        None if they cannot be tracked.
+
+        It stops collecting when it is not referenced anymore.
+    """
+    k = _key(db)
+    if k is None:
+        return None
+    if not k in Instances.watchers:
+        Instances.watchers[k] = weakref.WeakSet()
+    changes = JobChanges(k[0])
+    Instances.watchers[k].add(changes)
+    return changes
+
+
+def note_jobs_changed(job_ids, db, defined=False):
+    """ Called when the records of the jobs (definition or cache) are
+        written; defined=True if they were created or deleted. """
+    k = _key(db)
+    if k is None:
+        return
+    _note_write(k[0])
+    _notify(k, job_ids, defined)
+
+
+def _notify(k, job_ids, defined):
+    watchers = Instances.watchers.get(k, None)
+    if not watchers:
+        return
+    for changes in list(watchers):
+        changes.job_ids.update(job_ids)
+        if defined:
+            changes.defined = True
+
+
+def note_jobs_changed_elsewhere(job_ids, db, defined=False):
+    """ Called for the jobs that might have been changed by another
+        process, for example a worker of parmake. The children of the
+        jobs that exist are included, as their parents might have
+        changed. """
+    k = _key(db)
+    if k is None or not Instances.watchers.get(k, None):
+        return
+    from .storage import get_jobs
+    job_ids = set(job_ids)
+    children = set()
+    for job in get_jobs(job_ids, db).values():
+        children.update(job.children)
+    _notify(k, job_ids | children, defined)
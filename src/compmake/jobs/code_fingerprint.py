@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+    Fingerprints of the code of the commands, so that editing a function
+    makes out of date exactly the jobs that use it.
+
+    The fingerprint of a function is a hash of its bytecode, constants
+    and defaults, and of those of the functions that it references,
+    transitively: the module-level functions and classes of the user's
+    modules named in its code (directly, or as attributes of a module).
+    The modules of the standard library and of the installed packages
+    are not followed.
+
+    comp() stores the fingerprint of the command in the Job, and make()
+    copies it in the Cache of the result. With the switch "check_code",
+    up_to_date() considers a job out of date if the two differ.
+
+    The fingerprints are computed once for each function object, so
+    defining many jobs with the same functions costs one computation
+    per function (a module reloaded has new function objects).
+"""
+import hashlib
+import os
+import sys
+import sysconfig
+import types
+import weakref
+
+__all__ = [
+    'code_fingerprint',
+    'code_changed',
+]
+
+
+def code_fingerprint(function):
+    """ Returns the fingerprint (a hex string) of the code of the function
+        or method, or None for other callables. """
+    function = getattr(function, '__func__', function)
+    if not isinstance(function, types.FunctionType):
+        return None
+    try:
+        return Instances.fingerprints[function]
+    except KeyError:
+        pass
+    fp = _compute(function)
+    Instances.fingerprints[function] = fp
+    return fp
+
+
+def code_changed(job, cache):
+    """ True if the fingerprint of the job is different from the one that
+        its result was computed with (if both are known). """
+    fp = getattr(job, 'code_fingerprint', None)
+    used = getattr(cache, 'code_fingerprint', None)
+    return fp is not None and used is not None and fp != used
+
+
+class Instances(object):
+    # function -> fingerprint
+    fingerprints = weakref.WeakKeyDictionary()
+    # module name -> whether it is user code
+    user_modules = {}
+    # directories of the standard library and of the installed packages
+    library_dirs = None
+
+
+def _library_dirs():
+    if Instances.library_dirs is not None:
+        return Instances.library_dirs
+    dirs = set()
+    for name in ['stdlib', 'platstdlib', 'purelib', 'platlib']:
+        path = sysconfig.get_paths().get(name)
+        if path:
+            dirs.add(os.path.realpath(path) + os.sep)
+    for path in sys.path:
+        if 'site-packages' in path or 'dist-packages' in path:
+            dirs.add(os.path.realpath(path) + os.sep)
+    Instances.library_dirs = tuple(dirs)
+    return Instances.library_dirs
+
+
+def _is_user_module(name):
+    if name in Instances.user_modules:
+        return Instances.user_modules[name]
+    module = sys.modules.get(name, None)
+    filename = getattr(module, '__file__', None)
+    if filename is None:
+        res = False
+    else:
+        res = not os.path.realpath(filename).startswith(_library_dirs())
+    Instances.user_modules[name] = res
+    return res
+
+
+def _compute(function):
+    """ Hashes the descriptions of the functions reachable from the
+        function, in a fixed order. The names of the modules are not
+        included, as the script might be "__main__" or not. """
+    found = {}
+    stack = [function]
+    while stack:
+        f = stack.pop()
+        if (f.__module__, _name(f)) in found:
+            continue
+        found[(f.__module__, _name(f))] = (_name(f), _describe_function(f))
+        stack.extend(_referenced(f))
+    h = hashlib.sha256()
+    for x in sorted((repr(x) for x in found.values())):
+        h.update(x.encode('utf-8'))
+    return h.hexdigest()
+
+
+def _name(f):
+    return getattr(f, '__qualname__', f.__name__)
+
+
+def _describe_function(f):
+    code = _describe_code(f.__code__)
+    consts = code[1]
+    if f.__doc__ is not None and consts and consts[0] == f.__doc__:
+        # editing the documentation does not change the function
+        code = (code[0], (None,) + consts[1:], code[2])
+    return (code,
+            _describe_value(f.__defaults__),
+            _describe_value(getattr(f, '__kwdefaults__', None)))
+
+
+def _describe_code(code):
+    return (code.co_code,
+            tuple(_describe_value(c) for c in code.co_consts),
+            code.co_names)
+
+
+def _describe_value(x):
+    """ A description that does not depend on the addresses or on the
+        hash seed. """
+    if isinstance(x, types.CodeType):
+        return _describe_code(x)
+    if x is None or isinstance(x, (bool, int, float, complex, str, bytes)):
+        return x
+    if isinstance(x, (tuple, list)):
+        return tuple(_describe_value(y) for y in x)
+    if isinstance(x, (frozenset, set)):
+        return ('set',) + tuple(sorted((_describe_value(y) for y in x),
+                                       key=repr))
+    if isinstance(x, dict):
+        return ('dict',) + tuple(sorted(((k, _describe_value(v))
+                                         for k, v in x.items()), key=repr))
+    return ('object', type(x).__module__, type(x).__name__)
+
+
+def _names(code):
+    """ The global names used by the code and its nested functions. """
+    names = set(code.co_names)
+    for c in code.co_consts:
+        if isinstance(c, types.CodeType):
+            names.update(_names(c))
+    return names
+
+
+def _referenced(f):
+    """ The functions of the user's modules referenced by f. """
+    res = []
+    wrapped = getattr(f, '__wrapped__', None)
+    if wrapped is not None:
+        res.append(wrapped)
+    names = _names(f.__code__)
+    values = []
+    for name in names:
+        if name in f.__globals__:
+            values.append(f.__globals__[name])
+    for cell in f.__closure__ or ():
+        try:
+            values.append(cell.cell_contents)
+        except ValueError:  # empty cell
+            pass
+    for x in values:
+        if isinstance(x, types.ModuleType):
+            if _is_user_module(x.__name__):
+                # attributes used as module.name
+                for name in names:
+                    res.extend(_functions(getattr(x, name, None)))
+        else:
+            res.extend(_functions(x))
+    return res
+
+
+def _functions(x):
+    """ The user's functions in x: a function, or the methods of a class. """
+    if isinstance(x, types.FunctionType):
+        if _is_user_module(x.__module__):
+            return [x]
+        return []
+    if isinstance(x, type) and _is_user_module(x.__module__):
+        res = []
+        for cls in x.__mro__:
+            if not _is_user_module(cls.__module__):
+                continue
+            for v in vars(cls).values():
+                v = getattr(v, '__func__', v)
+                if isinstance(v, property):
+                    v = v.fget
+                if isinstance(v, types.FunctionType):
+                    res.append(v)
+        return res
+    return []
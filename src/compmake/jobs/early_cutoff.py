@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+    Early cutoff: a job whose children were computed again, but gave the
+    same results, does not need to be computed again.
+
+    With the switch "early_cutoff", make() records in the Cache a digest
+    of the result (result_digest) and the digests of the results of the
+    children that the job used (hashes_dependencies). A child that is
+    newer than the job then makes it out of date only if its digest
+    changed (see CacheQueryDB.up_to_date()); make() checks again when
+    the turn of a job comes, after its children were made, and does not
+    compute it if it is still up to date (see children_unchanged(), which
+    looks at the direct children and definers only).
+"""
+import hashlib
+import sys
+
+from compmake.state import get_compmake_config
+from compmake.utils.pickle_frustration import pickle_main_context_load
+
+from ..structures import Cache
+from .code_fingerprint import code_changed
+from .storage import get_job_caches
+
+if sys.version_info[0] >= 3:
+    import pickle  # @UnusedImport
+else:
+    import cPickle as pickle  # @Reimport
+
+__all__ = [
+    'result_digest',
+    'record_digests',
+    'same_result',
+    'children_unchanged',
+]
+
+digest_protocol = min(4, pickle.HIGHEST_PROTOCOL)
+
+
+class _HashWriter(object):
+    """ A file that only updates a hash with what is written. """
+
+    def __init__(self, h):
+        self.h = h
+
+    def write(self, data):
+        self.h.update(data)
+
+
+def result_digest(value, pickle_main_context):
+    """ Returns the digest of the value pickled, or None if it cannot be
+        pickled. The pickle is not kept in memory. """
+    h = hashlib.sha256()
+    try:
+        with pickle_main_context_load(pickle_main_context):
+            pickle.Pickler(_HashWriter(h), digest_protocol).dump(value)
+    except Exception:
+        return None
+    return h.hexdigest()
+
+
+def record_digests(cache, job, user_object, db):
+    """ Sets the fields result_digest and hashes_dependencies of the Cache
+        of the job just computed, if the switch "early_cutoff" is on. """
+    if not get_compmake_config('early_cutoff'):
+        return
+    cache.result_digest = result_digest(user_object, job.pickle_main_context)
+    caches = get_job_caches(list(job.children), db)
+    hashes = {}
+    for child, child_cache in caches.items():
+        digest = getattr(child_cache, 'result_digest', None)
+        if digest is not None:
+            hashes[child] = digest
+    cache.hashes_dependencies = hashes
+
+
+def same_result(cache, child, child_cache):
+    """ True if the child has the same result as when the job whose
+        Cache is given was computed (and the switch "early_cutoff"
+        is on). """
+    recorded = cache.hashes_dependencies.get(child, None)
+    if recorded is None or not get_compmake_config('early_cutoff'):
+        return False
+    return recorded == getattr(child_cache, 'result_digest', None)
+
+
+def children_unchanged(job, cache, db):
+    """
+        For a job done before, whose turn came in make (so its children
+        are done): True if it does not need to be computed again, because
+        the children that are newer gave the same results, and its
+        definers are done.
+
+        Unlike CacheQueryDB.up_to_date(), this reads only the Caches of
+        the direct children and definers, so it costs the same for each
+        job of a long chain made again.
+    """
+    if not get_compmake_config('early_cutoff'):
+        return False
+    if (cache.state != Cache.DONE or
+            cache.timestamp == Cache.TIMESTAMP_TO_REMAKE):
+        return False
+    definers = [x for x in job.defined_by if x != 'root']
+    caches = get_job_caches(set(job.children) | set(definers), db)
+    for child in job.children:
+        child_cache = caches[child]
+        if (child_cache.state != Cache.DONE or
+                child_cache.timestamp == Cache.TIMESTAMP_TO_REMAKE):
+            return False
+        if (child_cache.timestamp > cache.timestamp and
+                not same_result(cache, child, child_cache)):
+            return False
+    for definer in definers:
+        definer_cache = caches[definer]
+        if (definer_cache.state != Cache.DONE or
+                definer_cache.timestamp == Cache.TIMESTAMP_TO_REMAKE):
+            return False
+    if get_compmake_config('check_code') and code_changed(job, cache):
+        return False
+    return True
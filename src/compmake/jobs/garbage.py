@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+    Finds what can be deleted from a DB directory: files left by
+    processes that were killed, and records of jobs that do not
+    exist anymore. See the command "gc-db".
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+import shutil
+import time
+
+import psutil
+
+from compmake.storage.batch import delete_many, get_many
+
+from .array_files import array_files_dir, array_files_dirname
+from .blobs import blob_prefix, blobrefs_prefix
+from .storage import (all_jobs, job2cachedetailskey, job2cachekey,
+                      job2jobargskey, job2userobjectkey)
+
+__all__ = [
+    'Garbage',
+    'garbage_categories',
+    'find_garbage',
+    'delete_garbage',
+]
+
+garbage_categories = [
+    # files and directories "<name>.tmp.<pid>" of processes that died
+    # (see _is_dead_tmp())
+    'tmp',
+    # results left by parmake new_process=1
+    'new_process',
+    # spool directories of the SGE backend
+    'sge',
+    # log of the last parmake
+    'logs',
+    # records of jobs that do not exist
+    'orphans',
+    # array files of results that do not exist
+    'arrays',
+    # blobs that are not referenced
+    'blobs',
+]
+
+# subdirectories of the DB, each a category in itself
+category_dirs = {
+    'parmake_job2_new_process': 'new_process',
+    'sge': 'sge',
+    'logs': 'logs',
+}
+
+tmp_pattern = re.compile(r'\.tmp\.(\d+)(\.npy)?$')
+
+# seconds since the last modification after which a temporary file
+# can be of a process that died
+tmp_min_age = 60 * 60
+
+
+class Garbage(object):
+    """ A file, a directory, or a key of the DB that can be deleted. """
+
+    def __init__(self, category, nbytes, path=None, key=None):
+        assert category in garbage_categories, category
+        assert (path is None) != (key is None)
+        self.category = category
+        self.nbytes = nbytes
+        self.path = path
+        self.key = key
+
+    def __repr__(self):
+        return 'Garbage(%s, %s, %s)' % (self.category, self.path or self.key,
+                                        self.nbytes)
+
+
+def _size(entry):
+    """ Size of a DirEntry; recursive for directories. """
+    if entry.is_dir(follow_symlinks=False):
+        return sum(_size(x) for x in os.scandir(entry.path))
+    return entry.stat(follow_symlinks=False).st_size
+
+
+def _is_dead_tmp(entry):
+    """ Whether the DirEntry is a temporary file of a process that died.
+        The pid in the name might be of a process on another host using
+        the same DB, so the file must also be older than tmp_min_age. """
+    m = tmp_pattern.search(entry.name)
+    if m is None or psutil.pid_exists(int(m.group(1))):
+        return False
+    mtime = entry.stat(follow_symlinks=False).st_mtime
+    return time.time() - mtime > tmp_min_age
+
+
+def _find_tmp(dirname):
+    """ Walks dirname looking for the temporary files of dead processes. """
+    res = []
+    for entry in os.scandir(dirname):
+        if _is_dead_tmp(entry):
+            res.append(Garbage('tmp', _size(entry), path=entry.path))
+        elif entry.is_dir(follow_symlinks=False):
+            res.extend(_find_tmp(entry.path))
+    return res
+
+
+def _find_files(db, pool):
+    """ Returns the garbage in the DB directory (categories tmp,
+        new_process, sge, logs), scanning subdirectories in parallel. """
+    res = []
+    subdirs = []
+    for entry in os.scandir(db.basepath):
+        if entry.name in category_dirs and entry.is_dir():
+            for x in os.scandir(entry.path):
+                res.append(Garbage(category_dirs[entry.name], _size(x),
+                                   path=x.path))
+        elif _is_dead_tmp(entry):
+            res.append(Garbage('tmp', _size(entry), path=entry.path))
+        elif entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+    for found in pool.map(_find_tmp, subdirs):
+        res.extend(found)
+    return res
+
+
+def _find_records(db, pool):
+    """ Returns the garbage in the DB records (categories orphans,
+        arrays, blobs). """
+    jobs = set(all_jobs(db))
+    orphans = []
+    for key2 in [job2jobargskey, job2userobjectkey, job2cachekey,
+                 job2cachedetailskey]:
+        prefix = key2('')
+        for key in db.keys_with_prefix(prefix):
+            if not key[len(prefix):] in jobs:
+                orphans.append(key)
+
+    # the blobs used by the records that stay
+    refs = [k for k in db.keys_with_prefix(blobrefs_prefix)]
+    orphans_set = set(orphans)
+    used = set()
+    for key, hashes in get_many(db, refs).items():
+        record = key[len(blobrefs_prefix):]
+        if record in orphans_set or not record in db:
+            orphans.append(key)
+        else:
+            used.update(hashes)
+    blobs = [k for k in db.keys_with_prefix(blob_prefix)
+             if not k[len(blob_prefix):] in used]
+
+    res = []
+    for category, keys in [('orphans', orphans), ('blobs', blobs)]:
+        sizes = pool.map(db.sizeof, keys)
+        res.extend(Garbage(category, n, key=k) for k, n in zip(keys, sizes))
+
+    arrays = os.path.join(db.basepath, array_files_dirname)
+    if os.path.exists(arrays):
+        results = set(job_id for job_id in jobs
+                      if job2userobjectkey(job_id) in db)
+        keep = set(array_files_dir(job_id, db) for job_id in results)
+        for entry in os.scandir(arrays):
+            # the temporary files are in the category tmp
+            if not entry.path in keep and not tmp_pattern.search(entry.name):
+                res.append(Garbage('arrays', _size(entry), path=entry.path))
+    return res
+
+
+def find_garbage(db, threads=8):
+    """
+        Returns the list of Garbage found in the DB.
+
+        The temporary files are included if their process does not exist
+        on this host and they were not modified for tmp_min_age seconds;
+        the rest assumes that no other process is using the DB.
+    """
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        files = _find_files(db, pool)
+        records = _find_records(db, pool)
+    # do not count twice what is inside a directory that goes
+    dirs = tuple(g.path + os.sep for g in records if g.path is not None)
+    files = [g for g in files if not g.path.startswith(dirs)]
+    return files + records
+
+
+def delete_garbage(db, garbage, threads=8):
+    """ Deletes the garbage found by find_garbage(). """
+    delete_many(db, [g.key for g in garbage if g.key is not None])
+
+    def delete(path):
+        if not os.path.lexists(path):
+            return
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
+    paths = [g.path for g in garbage if g.path is not None]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(delete, paths))
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+    An in-memory index of the dependency graph of the jobs, so that the
+    queries do not need to unpickle the Job records.
+
+    Jobs get integer handles; the edges (children, parents, and
+    "defines", the inverse of the last element of defined_by) are kept
+    in compressed sparse row arrays. Jobs written afterwards with
+    set_job() go in an overlay, which is merged into the arrays when
+    it gets large.
+
+    The closures (all the parents, all the children, ...) of each job
+    queried are memoized, and reused by the queries that reach that job,
+    so that asking again for the ancestors of a job costs in proportion
+    to the size of the result. When the edges of a job change, only the
+    closures that contain it are forgotten; they are found with an
+    inverse map, so this costs in proportion to what is forgotten.
+
+    The index is used by the process running the commands: it is
+    activated at the start of the first command, loaded from the DB in
+    one batch the first time it is needed, and then kept across the
+    commands. The functions writing the jobs in storage.py update it.
+    Other processes (the workers of parmake) do not use it; the manager
+    calls graph_index_refresh() for the jobs that they define or delete.
+    If other compmake processes wrote jobs since it was loaded (see
+    WritesLog in jobs/changes.py), it is loaded again at the start of the
+    next command; deactivate_graph_index() also makes it load again.
+
+    The "defines" edges come from the defined_by of the jobs that exist,
+    so definition_closure() also includes the jobs defined by a job that
+    is not done anymore (failed, or invalidated), while without an index
+    it follows Cache.jobs_defined of the jobs done only.
+"""
+from array import array
+import os
+
+from compmake.exceptions import CompmakeBug
+
+from .changes import WritesLog
+
+__all__ = [
+    'GraphIndex',
+    'activate_graph_index',
+    'deactivate_graph_index',
+    'get_graph_index',
+    'graph_index_job_defined',
+    'graph_index_job_deleted',
+    'graph_index_refresh',
+]
+
+relations = ['children', 'parents', 'defines']
+
+
+class GraphIndex(object):
+    """ The graph of the jobs; see the module documentation. """
+
+    # merge the overlay into the arrays when it has more rows than this
+    # (or than a quarter of the jobs)
+    overlay_max = 10000
+    # forget all the closures when they have more elements than this
+    # (or than 4 times the jobs)
+    reach_max = 1000 * 1000
+
+    def __init__(self, jobs):
+        """ jobs: dict job_id -> Job """
+        # handle -> job id, and back
+        self.ids = sorted(jobs)
+        self.handles = dict((job_id, h) for h, job_id in enumerate(self.ids))
+        n = len(self.ids)
+        # handle -> whether the job exists (the children
+        # might refer to jobs that do not exist)
+        self.exists = bytearray(b'\x01' * n)
+        self.needs_context = bytearray(n)
+        # handle -> handle of the job that defined it, or -1 for root
+        self.definer = array('i', [-1]) * n
+
+        rows = dict((r, {}) for r in relations)
+        for job_id, job in jobs.items():
+            h = self.handles[job_id]
+            self.needs_context[h] = 1 if job.needs_context else 0
+            rows['children'][h] = self._handles(job.children)
+            rows['parents'][h] = self._handles(job.parents)
+            d = self._definer_handle(job)
+            self.definer[h] = d
+            if d >= 0:
+                rows['defines'].setdefault(d, []).append(h)
+
+        # relation -> (indptr, indices)
+        self.csr = {}
+        self.overlay = dict((r, {}) for r in relations)
+        self._build(rows)
+        # relation -> handle -> frozenset of the handles reachable
+        self.reach = dict((r, {}) for r in relations)
+        # relation -> handle -> set of the handles whose closure has it
+        self.reached_from = dict((r, {}) for r in relations)
+        # total size of the memoized closures
+        self.reach_size = 0
+
+    def __len__(self):
+        """ Number of jobs that exist. """
+        return self.exists.count(1)
+
+    def _handle(self, job_id):
+        h = self.handles.get(job_id)
+        if h is None:
+            h = len(self.ids)
+            self.ids.append(job_id)
+            self.handles[job_id] = h
+            self.exists.append(0)
+            self.needs_context.append(0)
+            self.definer.append(-1)
+        return h
+
+    def _handles(self, job_ids):
+        return tuple(sorted(self._handle(x) for x in job_ids))
+
+    def _definer_handle(self, job):
+        last = job.defined_by[-1]
+        if last == 'root':
+            return -1
+        return self._handle(last)
+
+    def _build(self, rows):
+        """ rows: relation -> dict handle -> list of handles """
+        n = len(self.ids)
+        for r in relations:
+            indptr = array('l', [0])
+            indices = array('i')
+            row = rows[r]
+            for h in range(n):
+                x = row.get(h)
+                if x:
+                    indices.extend(sorted(x))
+                indptr.append(len(indices))
+            self.csr[r] = (indptr, indices)
+            self.overlay[r] = {}
+
+    def _row(self, relation, h):
+        overlay = self.overlay[relation]
+        if h in overlay:
+            return overlay[h]
+        indptr, indices = self.csr[relation]
+        if h + 1 >= len(indptr):
+            return ()
+        return indices[indptr[h]:indptr[h + 1]]
+
+    def _set_row(self, relation, h, row):
+        row = tuple(row)
+        if tuple(self._row(relation, h)) != row:
+            self._forget_reach(relation, h)
+        self.overlay[relation][h] = row
+
+    def _forget_reach(self, relation, h):
+        """ The edges of h changed: forgets the closures that contain h. """
+        reach = self.reach[relation]
+        reached_from = self.reached_from[relation]
+        stale = reached_from.pop(h, set())
+        if h in reach:
+            stale.add(h)
+        for x in stale:
+            result = reach.pop(x)
+            self.reach_size -= len(result) + 1
+            for y in result:
+                if y != h:
+                    others = reached_from[y]
+                    others.discard(x)
+                    if not others:
+                        del reached_from[y]
+
+    def _compact_if_needed(self):
+        n = sum(len(x) for x in self.overlay.values())
+        if n > max(self.overlay_max, len(self.ids) // 4):
+            rows = {}
+            for r in relations:
+                rows[r] = dict((h, self._row(r, h))
+                               for h in range(len(self.ids)))
+            self._build(rows)
+
+    # updates
+
+    def set_job(self, job_id, job):
+        """ Records the job, new or modified. """
+        h = self._handle(job_id)
+        existed = self.exists[h]
+        old_definer = self.definer[h] if existed else -1
+        self.exists[h] = 1
+        self.needs_context[h] = 1 if job.needs_context else 0
+        self._set_row('children', h, self._handles(job.children))
+        self._set_row('parents', h, self._handles(job.parents))
+        new_definer = self._definer_handle(job)
+        if new_definer != old_definer:
+            self._unlink_definer(h, old_definer)
+            if new_definer >= 0:
+                defines = set(self._row('defines', new_definer))
+                defines.add(h)
+                self._set_row('defines', new_definer, sorted(defines))
+        self.definer[h] = new_definer
+        self._compact_if_needed()
+
+    def delete_job(self, job_id):
+        h = self.handles.get(job_id)
+        if h is None or not self.exists[h]:
+            return
+        self.exists[h] = 0
+        self.needs_context[h] = 0
+        self._set_row('children', h, ())
+        self._set_row('parents', h, ())
+        self._unlink_definer(h, self.definer[h])
+        self.definer[h] = -1
+        self._compact_if_needed()
+
+    def _unlink_definer(self, h, definer):
+        if definer >= 0:
+            defines = [x for x in self._row('defines', definer) if x != h]
+            self._set_row('defines', definer, defines)
+
+    # queries
+
+    def job_exists(self, job_id):
+        h = self.handles.get(job_id)
+        return h is not None and self.exists[h] == 1
+
+    def _existing(self, job_id):
+        h = self.handles.get(job_id)
+        if h is None or not self.exists[h]:
+            msg = 'Job %r does not exist.' % job_id
+            raise CompmakeBug(msg)
+        return h
+
+    def _ids(self, handles):
+        ids = self.ids
+        return set(ids[h] for h in handles)
+
+    def direct_children(self, job_id):
+        return self._ids(self._row('children', self._existing(job_id)))
+
+    def direct_parents(self, job_id):
+        return self._ids(self._row('parents', self._existing(job_id)))
+
+    def jobs_defined(self, job_id):
+        """ The jobs that exist and were defined by job_id. """
+        return self._ids(self._row('defines', self._existing(job_id)))
+
+    def job_needs_context(self, job_id):
+        return self.needs_context[self._existing(job_id)] == 1
+
+    def closure(self, jobs, relation):
+        """ Returns the jobs reachable from the jobs with one or more
+            edges of the relation (the jobs themselves are included only
+            if reachable). Jobs that do not exist are ignored. """
+        result = set()
+        for job_id in jobs:
+            h = self.handles.get(job_id)
+            if h is not None and self.exists[h]:
+                result.update(self._reach(relation, h))
+        return self._ids(result)
+
+    def _reach(self, relation, h):
+        """ The handles reachable from h, memoized; the visit does not
+            go through the jobs whose closure is already known. """
+        reach = self.reach[relation]
+        if h in reach:
+            return reach[h]
+        result = set()
+        stack = [h]
+        row = self._row
+        while stack:
+            for x in row(relation, stack.pop()):
+                if x in result:
+                    continue
+                result.add(x)
+                known = reach.get(x, None)
+                if known is None:
+                    stack.append(x)
+                else:
+                    result.update(known)
+        result = frozenset(result)
+        self.reach_size += len(result) + 1
+        if self.reach_size > max(self.reach_max, 4 * len(self.ids)):
+            for r in relations:
+                self.reach[r] = {}
+                self.reached_from[r] = {}
+            self.reach_size = len(result) + 1
+            reach = self.reach[relation]
+        reach[h] = result
+        reached_from = self.reached_from[relation]
+        for x in result:
+            if x in reached_from:
+                reached_from[x].add(h)
+            else:
+                reached_from[x] = set([h])
+        return result
+
+    def top_targets(self):
+        """ The jobs that exist and have no parents. """
+        return sorted(self.ids[h] for h in range(len(self.ids))
+                      if self.exists[h] and not self._row('parents', h))
+
+
+def _key(db):
+    basepath = getattr(db, 'basepath', None)
+    if basepath is None:
+        return None
+    return basepath, os.getpid()
+
+
+class Instances(object):
+    # (basepath, pid) -> GraphIndex, or None if active but not loaded
+    indexes = {}
+    # (basepath, pid) -> WritesLog since the index was loaded
+    writes = {}
+
+
+def activate_graph_index(db):
+    """ Makes the queries on db use a GraphIndex in this process; it is
+        loaded from the DB the next time it is needed, unless it is
+        already and no other process wrote jobs since. Called at the
+        start of each command. """
+    k = _key(db)
+    if k is None:
+        return
+    if k in Instances.indexes and Instances.indexes[k] is not None:
+        if Instances.writes[k].written_elsewhere():
+            Instances.indexes[k] = None
+    if not k in Instances.indexes:
+        Instances.indexes[k] = None
+
+
+def deactivate_graph_index(db):
+    """ The queries on db go back to reading the Job records;
+        activate_graph_index() then loads the index again. """
+    k = _key(db)
+    if k is not None:
+        Instances.indexes.pop(k, None)
+
+
+def get_graph_index(db):
+    """ Returns the GraphIndex for db, or None if it is not active
+        in this process. """
+    k = _key(db)
+    if k is None or not k in Instances.indexes:
+        return None
+    index = Instances.indexes[k]
+    if index is None:
+        from .storage import all_jobs, get_jobs
+        # before reading, so that what is written meanwhile is noticed
+        Instances.writes[k] = WritesLog(k[0])
+        index = GraphIndex(get_jobs(list(all_jobs(db)), db))
+        Instances.indexes[k] = index
+    return index
+
+
+def _loaded(db):
+    k = _key(db)
+    if k is None:
+        return None
+    return Instances.indexes.get(k, None)
+
+
+def graph_index_job_defined(job_id, job, db):
+    """ Called by set_job(). """
+    index = _loaded(db)
+    if index is not None:
+        index.set_job(job_id, job)
+
+
+def graph_index_job_deleted(job_ids, db):
+    """ Called when the jobs are deleted. """
+    index = _loaded(db)
+    if index is not None:
+        for job_id in job_ids:
+            index.delete_job(job_id)
+
+
+def graph_index_refresh(job_ids, db):
+    """ Reads again the given jobs, which might have been changed
+        by another process, and the children of those that exist
+        (whose parents might have changed). """
+    index = _loaded(db)
+    if index is None:
+        return
+    from .storage import get_jobs
+    job_ids = set(job_ids)
+    jobs = get_jobs(job_ids, db)
+    children = set()
+    for job in jobs.values():
+        children.update(job.children)
+    jobs.update(get_jobs(children - job_ids, db))
+    for job_id in job_ids:
+        if not job_id in jobs:
+            index.delete_job(job_id)
+    for job_id, job in jobs.items():
+        index.set_job(job_id, job)
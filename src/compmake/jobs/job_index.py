@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+    Persisted indexes of the definitions of the jobs, so that finding
+    the top-level targets, the jobs defined by a job, or the jobs defined
+    by the root does not need to read all the Job records.
+
+    For each job, the index has the job that defined it (the last element
+    of defined_by, "root" for the jobs defined by the script) and the
+    number of its parents. It is derived from the cm-job- records and
+    kept in the directory "job_index" of the DB, as an append-only log
+    "log.txt" of lines "+nparents<TAB>definer<TAB>job_id" (the job was
+    written) and "-job_id" (the job was deleted). It is updated by
+    set_job(), update_job() and the functions deleting the jobs; readers
+    keep the index in memory and read only what was appended since the
+    last time. When the log is much longer than the index it is
+    rewritten.
+
+    The entries come from the Job objects being written, and the lock is
+    taken only to append the ones that differ from the index, so writing
+    a job costs neither a read nor a lock when its entry did not change.
+
+    The first query of each process adds the jobs that are missing from
+    the index, and removes the ones that do not exist anymore, so that an
+    index that was not kept up to date (e.g. the DB was used with the
+    switch "job_index" off) converges; this is done again if this process
+    writes jobs with the switch off. "check-consistency" verifies the
+    rest (for example two processes writing the same job at the same
+    time), and "rebuild-job-index" writes it again from the jobs.
+"""
+from contextlib import contextmanager
+import fcntl
+import os
+
+from compmake.exceptions import CompmakeBug
+from compmake.state import get_compmake_config
+from compmake.utils.safe_write import safe_write
+
+__all__ = [
+    'JobIndex',
+    'get_job_index',
+    'rebuild_job_index',
+    'check_job_index',
+    'job_index_job_defined',
+    'job_index_delete',
+    'indexed_top_targets',
+    'indexed_jobs_defined_by',
+]
+
+job_index_dirname = 'job_index'
+
+
+class JobIndex(object):
+    """ See the module documentation. Use get_job_index(). """
+
+    # compact when there are more than 2*live + compact_min lines
+    compact_min = 1000
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.log_filename = os.path.join(dirname, 'log.txt')
+        # whether the jobs missing from the index were looked for
+        # (see _converged())
+        self.converged = False
+        self._forget()
+
+    def _forget(self):
+        # job_id -> (definer, number of parents)
+        self.entries = {}
+        # definer -> set of job ids
+        self.defines = {}
+        # jobs without parents
+        self.top = set()
+        self.inode = None
+        self.offset = 0
+        self.nlines = 0
+
+    @contextmanager
+    def _locked(self):
+        with open(self.dirname + '.lock', 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _read_tail(self):
+        """ Reads the lines appended since the last time. """
+        if not os.path.exists(self.log_filename):
+            # being built
+            self._forget()
+            return
+        st = os.stat(self.log_filename)
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            # first time, or rewritten
+            self._forget()
+            self.inode = st.st_ino
+        if st.st_size == self.offset:
+            return
+
+        with open(self.log_filename, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        # ignore a partially written last line
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+
+        for line in data[:end].decode('utf-8').split('\n'):
+            if not line:
+                continue
+            self.nlines += 1
+            op = line[0]
+            if op == '+':
+                nparents, definer, job_id = line[1:].split('\t', 2)
+                self._set(job_id, definer, int(nparents))
+            elif op == '-':
+                self._remove(line[1:])
+            else:
+                msg = 'Invalid line %r in %s.' % (line, self.log_filename)
+                raise CompmakeBug(msg)
+
+    def _set(self, job_id, definer, nparents):
+        self._remove(job_id)
+        self.entries[job_id] = (definer, nparents)
+        self.defines.setdefault(definer, set()).add(job_id)
+        if nparents == 0:
+            self.top.add(job_id)
+
+    def _remove(self, job_id):
+        if not job_id in self.entries:
+            return
+        definer, _ = self.entries.pop(job_id)
+        self.defines[definer].discard(job_id)
+        if not self.defines[definer]:
+            del self.defines[definer]
+        self.top.discard(job_id)
+
+    def _append(self, lines):
+        """ Call with the lock held. """
+        if not lines:
+            return
+        fd = os.open(self.log_filename,
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, ''.join(lines).encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def read(self):
+        """ Reads what was appended, compacting the log if needed. """
+        self._read_tail()
+        if self.nlines > 2 * len(self.entries) + self.compact_min:
+            with self._locked():
+                self._read_tail()
+                self.write(self.entries)
+                self._read_tail()
+        return self.entries
+
+    def _changed(self, entries, deleted):
+        return (any(self.entries.get(job_id, None) != entry
+                    for job_id, entry in entries.items()) or
+                any(job_id in self.entries for job_id in deleted))
+
+    def update(self, entries, deleted=()):
+        """ Records the entries, a dict job_id -> (definer, number of
+            parents), and removes the deleted jobs. The lock is taken
+            only if this changes the index. """
+        self._read_tail()
+        if not self._changed(entries, deleted):
+            return
+        with self._locked():
+            # what the others appended in the meantime
+            self._read_tail()
+            lines = []
+            for job_id, (definer, nparents) in sorted(entries.items()):
+                if self.entries.get(job_id, None) != (definer, nparents):
+                    lines.append('+%d\t%s\t%s\n' % (nparents, definer, job_id))
+            for job_id in sorted(set(deleted)):
+                if job_id in self.entries:
+                    lines.append('-%s\n' % job_id)
+            self._append(lines)
+
+    def write(self, entries):
+        """ Rewrites the log with exactly these entries; call with
+            the lock held. """
+        with safe_write(self.log_filename, mode='w') as f:
+            for job_id, (definer, nparents) in sorted(entries.items()):
+                f.write('+%d\t%s\t%s\n' % (nparents, definer, job_id))
+        self._forget()
+
+
+def _entry(job):
+    return job.defined_by[-1], len(job.parents)
+
+
+class Instances(object):
+    # (dirname, pid) -> JobIndex
+    indexes = {}
+
+
+def get_job_index(db):
+    """
+        Returns the JobIndex of the DB, building it the first time,
+        or None if the switch "job_index" is off.
+    """
+    basepath = getattr(db, 'basepath', None)
+    if basepath is None:
+        return None
+    dirname = os.path.join(basepath, job_index_dirname)
+    k = (dirname, os.getpid())
+    if not get_compmake_config('job_index'):
+        if k in Instances.indexes:
+            # the jobs written now are not recorded
+            Instances.indexes[k].converged = False
+        return None
+    if not k in Instances.indexes:
+        Instances.indexes[k] = JobIndex(dirname)
+    if not os.path.exists(dirname):
+        rebuild_job_index(db, only_if_missing=True)
+    return Instances.indexes[k]
+
+
+def rebuild_job_index(db, only_if_missing=False):
+    """ Writes the index from the job records; returns the number of jobs. """
+    from .storage import all_jobs, get_jobs
+
+    dirname = os.path.join(db.basepath, job_index_dirname)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    index = JobIndex(dirname)
+    with index._locked():
+        if only_if_missing and os.path.exists(index.log_filename):
+            return None
+        jobs = get_jobs(all_jobs(db), db)
+        index.write(dict((job_id, _entry(job))
+                         for job_id, job in jobs.items()))
+    return len(jobs)
+
+
+def check_job_index(db):
+    """ Returns a list of the differences between the index and the
+        job records (empty if the index is off). """
+    from .storage import all_jobs, get_jobs
+    index = get_job_index(db)
+    if index is None:
+        return []
+    entries = index.read()
+    jobs = get_jobs(all_jobs(db), db)
+    errors = []
+    for job_id in sorted(set(entries) - set(jobs)):
+        errors.append('Job %r is in the index but does not exist.' % job_id)
+    for job_id in sorted(jobs):
+        expected = _entry(jobs[job_id])
+        found = entries.get(job_id, None)
+        if found is None:
+            errors.append('Job %r is not in the index.' % job_id)
+        elif found != expected:
+            errors.append('Job %r is in the index as (definer, parents) = '
+                          '%r instead of %r.' % (job_id, found, expected))
+    return errors
+
+
+def job_index_job_defined(job_id, job, db):
+    """ Called by set_job() and update_job(). """
+    index = get_job_index(db)
+    if index is not None:
+        index.update({job_id: _entry(job)})
+
+
+def job_index_delete(job_ids, db):
+    """ Called when the jobs are deleted. """
+    index = get_job_index(db)
+    if index is not None:
+        index.update({}, deleted=job_ids)
+
+
+def _converged(db):
+    """ Returns the index, or None if it is off. The first time, adds
+        the jobs missing from it and removes the ones that do not exist. """
+    from .storage import all_jobs, get_jobs
+    index = get_job_index(db)
+    if index is None:
+        return None
+    entries = index.read()
+    if index.converged:
+        return index
+    existing = set(all_jobs(db))
+    missing = existing - set(entries)
+    deleted = set(entries) - existing
+    if missing or deleted:
+        jobs = get_jobs(missing, db)
+        index.update(dict((job_id, _entry(job))
+                          for job_id, job in jobs.items()), deleted=deleted)
+        index.read()
+    index.converged = True
+    return index
+
+
+def indexed_top_targets(db):
+    """ Returns the sorted list of the jobs without parents,
+        or None if the index is off. """
+    index = _converged(db)
+    if index is None:
+        return None
+    return sorted(index.top)
+
+
+def indexed_jobs_defined_by(definers, db, recursive=False):
+    """ Returns the set of the jobs whose definer (the last element of
+        defined_by) is in definers ("root" for the jobs defined by the
+        script), or None if the index is off.
+
+        If recursive, also the jobs that those defined, and so on. """
+    index = _converged(db)
+    if index is None:
+        return None
+    res = set()
+    stack = list(definers)
+    while stack:
+        for job_id in index.defines.get(stack.pop(), ()):
+            if not job_id in res:
+                res.add(job_id)
+                if recursive:
+                    stack.append(job_id)
+    return res
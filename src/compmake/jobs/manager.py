@@ -14,6 +14,8 @@ from compmake.state import get_compmake_config
 from contracts import ContractsMeta, contract, indent
 
 from .actions import mark_as_blocked
+from .changes import note_jobs_changed, note_jobs_changed_elsewhere
+from .graph_index import graph_index_refresh
 from .priority import compute_priorities
 from .queries import direct_children, direct_parents
 from .uptodate import CacheQueryDB
@@ -418,6 +420,11 @@ class Manager(ManagerLog):
 
         new_jobs = result['new_jobs']
         deleted_jobs = result['deleted_jobs']
+        # the job might have run in another process
+        graph_index_refresh(set(new_jobs) | set(deleted_jobs), self.db)
+        note_jobs_changed_elsewhere(set(new_jobs) | set(deleted_jobs),
+                                    self.db, defined=True)
+        note_jobs_changed([job_id], self.db)
         # self.log('deleted jobs: %r' % list(deleted_jobs))
         for _ in deleted_jobs:
             self.job_is_deleted(_)
@@ -524,6 +531,9 @@ class Manager(ManagerLog):
         """ The specified job has failed. Update the structures,
             mark any parent as failed as well. """
         self.log('job_failed', job_id=job_id, deleted_jobs=deleted_jobs)
+        graph_index_refresh(deleted_jobs, self.db)
+        note_jobs_changed_elsewhere(deleted_jobs, self.db, defined=True)
+        note_jobs_changed([job_id], self.db)
         self.check_invariants()
         assert job_id in self.processing
 
@@ -538,7 +548,7 @@ class Manager(ManagerLog):
 
         publish(self.context, 'manager-job-failed', job_id=job_id)
 
-        # TODO: more efficient query
+        # the closures come from the GraphIndex, which memoizes them
         # parent_jobs = set(parents(job_id, db=self.db))
         from compmake.jobs.uptodate import direct_uptodate_deps_inverse_closure
         parent_jobs = direct_uptodate_deps_inverse_closure(job_id, db=self.db)
@@ -1,38 +1,97 @@
 # -*- coding: utf-8 -*-
+from collections import defaultdict
+
+from compmake.exceptions import CompmakeBug, UserError
+from compmake.state import get_compmake_config
 from compmake.structures import Cache
 
+from .graph_index import get_graph_index
+from .state_table import read_state_table
+
 __all__ = [
-    'compute_priorities'
+    'compute_priorities',
+    'compute_critical_path_priorities',
+    'predict_durations',
 ]
 
+# predicted duration of the jobs, if nothing ran before
+default_duration = 1.0
+
 
 def compute_priorities(all_targets, cq, priorities=None):
-    """ Computes the priority for all_targets.
+    """ Computes the priority for all_targets, according to the
+        switch "priority" ("heuristic" or "critical_path").
 
         :param priorities: str->float: cache
     """
+    mode = get_compmake_config('priority')
+    if mode == 'critical_path':
+        return compute_critical_path_priorities(all_targets, cq, priorities)
+    if mode != 'heuristic':
+        msg = 'Invalid value %r for the switch "priority".' % mode
+        raise UserError(msg)
     if priorities is None:
         priorities = {}
     all_targets = set(all_targets)
+    graph = get_graph_index(cq.db)
     for job_id in all_targets:
         p = compute_priority(job_id=job_id, priorities=priorities,
-                             targets=all_targets, cq=cq)
+                             targets=all_targets, cq=cq, graph=graph)
         priorities[job_id] = p
     return priorities
 
 
-def compute_priority(job_id, priorities, targets, cq):
+def compute_priority(job_id, priorities, targets, cq, graph=None):
     """ Computes the priority for one job. It uses caching results in
-        self.priorities if they are found. """
-    if job_id in priorities:
-        return priorities[job_id]
-
-    parents = set(cq.direct_parents(job_id))
+        self.priorities if they are found.
+
+        The priority of a job depends on the priorities of its parents
+        which are targets; they are computed first, with an explicit
+        stack rather than by recursion.
+
+        If graph (a GraphIndex) is given, the Job records are not read. """
+    # job -> (base priority, parents which are targets)
+    pending = {}
+    stack = [job_id]
+    while stack:
+        j = stack[-1]
+        if j in priorities:
+            stack.pop()
+            continue
+        if not j in pending:
+            pending[j] = _base_priority(j, targets, cq, graph)
+        base_priority, parents_which_are_targets = pending[j]
+        missing = [p for p in parents_which_are_targets
+                   if not p in priorities]
+        if missing:
+            stack.extend(missing)
+            continue
+        stack.pop()
+        if not parents_which_are_targets:
+            priority = base_priority
+        else:
+            # it was -1
+            parents_priority = [priorities[p]
+                                for p in parents_which_are_targets]
+            # priority = base_priority + max(parents_priority)
+            priority = base_priority + sum(parents_priority)
+        priorities[j] = priority
+
+    return priorities[job_id]
+
+
+def _base_priority(job_id, targets, cq, graph):
+    """ Returns the pair (base priority, parents which are targets). """
+    if graph is not None:
+        parents = graph.direct_parents(job_id)
+        needs_context = graph.job_needs_context(job_id)
+    else:
+        parents = set(cq.direct_parents(job_id))
+        needs_context = cq.get_job(job_id).needs_context
     parents_which_are_targets = [x for x in parents if x in targets]
 
     # Dynamic jobs get bonus 
-    job = cq.get_job(job_id)
-    if job.needs_context:
+    if needs_context:
         base_priority = 10
     else:
         base_priority = -1
@@ -45,18 +104,130 @@ def compute_priority(job_id, priorities, targets, cq):
     if cache.state == Cache.FAILED:
         base_priority -= 100
 
-    if not parents_which_are_targets:
-        priority = base_priority
-    else:
-        pf = lambda p: compute_priority(p, priorities, targets, cq=cq)
-        # it was -1
-        parents_priority = list(map(pf, parents_which_are_targets))
-        # priority = base_priority + max(parents_priority)
-        priority = base_priority + sum(parents_priority)
+    return base_priority, parents_which_are_targets
 
-    priorities[job_id] = priority
 
-    return priority
+def compute_critical_path_priorities(all_targets, cq, priorities=None):
+    """ The priority of a job is its bottom level: the predicted duration
+        of the longest path from the job to a target, through its
+        parents, including the job itself (see predict_durations()).
+        Starting the jobs on the critical path first shortens the total
+        time with many workers.
 
+        The jobs are evaluated in one topological pass, parents first;
+        the parents that are not in all_targets count only if they are
+        in priorities.
+
+        :param priorities: str->float: cache
+    """
+    if priorities is None:
+        priorities = {}
+    todo = set(all_targets) - set(priorities)
+    graph = get_graph_index(cq.db)
+    durations = predict_durations(todo, cq)
+
+    # job -> parents evaluated before it
+    parents = {}
+    # job -> children in todo
+    children = defaultdict(list)
+    # job -> number of parents not evaluated yet
+    waiting = {}
+    for job_id in todo:
+        if graph is not None:
+            direct_parents = graph.direct_parents(job_id)
+        else:
+            direct_parents = cq.direct_parents(job_id)
+        parents[job_id] = [p for p in direct_parents
+                           if p in todo or p in priorities]
+        waiting[job_id] = 0
+        for p in parents[job_id]:
+            if p in todo:
+                children[p].append(job_id)
+                waiting[job_id] += 1
+
+    ready = sorted(job_id for job_id in todo if not waiting[job_id])
+    while ready:
+        job_id = ready.pop()
+        longest = max([priorities[p] for p in parents[job_id]] or [0.0])
+        priorities[job_id] = durations[job_id] + longest
+        for c in children[job_id]:
+            waiting[c] -= 1
+            if not waiting[c]:
+                ready.append(c)
+
+    if len(todo - set(priorities)) > 0:
+        msg = 'The jobs depend on themselves: %s' % sorted(todo -
+                                                           set(priorities))
+        raise CompmakeBug(msg)
+    return priorities
 
 
+def predict_durations(job_ids, cq):
+    """
+        Returns a dict job_id -> predicted walltime, in seconds, using
+        the past runs: the last walltime of the job itself, if known;
+        otherwise the median over the jobs with the same command;
+        otherwise the median over all the commands (default_duration if
+        none ran).
+
+        The medians use the state table if it is available, which covers
+        all the jobs in the DB; otherwise only the jobs given.
+    """
+    own = {}
+    command_of = {}
+    samples = defaultdict(list)
+    for job_id in job_ids:
+        command = cq.get_job(job_id).command_desc
+        command_of[job_id] = command
+        walltime = cq.get_job_cache(job_id).walltime_used
+        if walltime is not None:
+            own[job_id] = walltime
+            samples[command].append(walltime)
+
+    medians = _command_durations(cq.db)
+    if medians is None:
+        medians = {}
+    for command, walltimes in samples.items():
+        if not command in medians:
+            medians[command] = _median(walltimes)
+    if medians:
+        fallback = _median(list(medians.values()))
+    else:
+        fallback = default_duration
+
+    res = {}
+    for job_id, command in command_of.items():
+        if job_id in own:
+            res[job_id] = own[job_id]
+        else:
+            res[job_id] = medians.get(command, fallback)
+    return res
+
+
+def _median(values):
+    values = sorted(values)
+    n = len(values)
+    if n % 2:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2.0
+
+
+def _command_durations(db):
+    """ Returns a dict command -> median walltime of the jobs in the
+        state table, or None if it is not available. """
+    if getattr(db, 'basepath', None) is None:
+        return None
+    try:
+        import numpy as np
+    except ImportError:
+        return None
+    table = read_state_table(db)
+    if table is None:
+        return None
+    _, commands, records = table
+    walltimes = records['walltime']
+    known = np.nonzero(~np.isnan(walltimes))[0]
+    samples = defaultdict(list)
+    for i in known:
+        samples[commands[i]].append(float(walltimes[i]))
+    return dict((c, _median(x)) for c, x in samples.items())
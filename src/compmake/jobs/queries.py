@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 """ Contains queries of the job DB. """
-import warnings
 import six
-from ..jobs import all_jobs, get_job
+from ..jobs import all_jobs, get_job, job_exists
 from contracts import contract
 from contextlib import contextmanager
 from contracts.utils import raise_wrapped, check_isinstance
 from compmake.exceptions import CompmakeBug
+from compmake.jobs.graph_index import get_graph_index
+from compmake.jobs.job_index import (indexed_jobs_defined_by,
+                                     indexed_top_targets)
 from compmake.jobs.storage import get_job_cache
 from compmake.structures import Cache
 
@@ -47,27 +49,50 @@ def jobs_defined(job_id, db):
 
 @contract(jobs='Iterable', returns='set(str)')
 def definition_closure(jobs, db):
-    """ The result does not contain jobs (unless one job defines another) """
+    """ The jobs defined by the jobs, recursively. The result does not
+        contain jobs (unless one job defines another).
+
+        With an index (graph_index, job_index) this follows defined_by,
+        so it includes what was defined by jobs that are not done
+        anymore; otherwise it follows Cache.jobs_defined of the jobs
+        that are done. """
     #print('definition_closure(%s)' % jobs)
     check_isinstance(jobs, (list, set))
     jobs = set(jobs)
+    graph = get_graph_index(db)
+    if graph is not None:
+        for a in jobs:
+            if not graph.job_exists(a):
+                print('Warning: job %r does not exist anymore; ignoring.' % a)
+        return graph.closure(jobs, 'defines')
+
+    defined = indexed_jobs_defined_by(jobs, db, recursive=True)
+    if defined is not None:
+        for a in jobs:
+            if not job_exists(a, db):
+                print('Warning: job %r does not exist anymore; ignoring.' % a)
+        return defined
+
     from compmake.jobs.uptodate import CacheQueryDB
     cq = CacheQueryDB(db)
     stack = set(jobs)
     result = set()
     while stack:
         #print('stack: %s' % stack)
-        a = stack.pop()
-        if not cq.job_exists(a):
-            print('Warning: job %r does not exist anymore; ignoring.' % a)
-            continue
-
-        if cq.get_job_cache(a).state == Cache.DONE:
-            a_d = cq.jobs_defined(a)
-            #print('%s ->%s' % (a, a_d))
-            for x in a_d:
-                result.add(x)
-                stack.add(x)
+        # read the whole level in one batch
+        cq.prefetch(stack)
+        level, stack = stack, set()
+        for a in level:
+            if not cq.job_exists(a):
+                print('Warning: job %r does not exist anymore; ignoring.' % a)
+                continue
+
+            if cq.get_job_cache(a).state == Cache.DONE:
+                a_d = cq.jobs_defined(a)
+                #print('%s ->%s' % (a, a_d))
+                for x in a_d:
+                    result.add(x)
+                    stack.add(x)
 
     #print('  result = %s' % result)
     return result
@@ -78,6 +103,9 @@ def direct_parents(job_id, db):
         (Jobs that depend directly on this one) """
     check_isinstance(job_id,six.string_types)
     with trace_bugs('direct_parents(%r)' % job_id):
+        graph = get_graph_index(db)
+        if graph is not None:
+            return graph.direct_parents(job_id)
         computation = get_job(job_id, db=db)
         return set(computation.parents)
 
@@ -86,6 +114,9 @@ def direct_children(job_id, db):
     """ Returns the direct children (dependencies) of the specified job """
     check_isinstance(job_id, six.string_types)
     with trace_bugs('direct_children(%r)' % job_id):
+        graph = get_graph_index(db)
+        if graph is not None:
+            return graph.direct_children(job_id)
         computation = get_job(job_id, db=db)
         return set(computation.children)
 
@@ -94,15 +125,21 @@ def children(job_id, db):
     """ Returns children, children of children, etc. """
     check_isinstance(job_id, six.string_types)
     with trace_bugs('children(%r)' % job_id):
-        t = set()
-        for c in direct_children(job_id, db=db):
-            t.add(c)
-            t.update(children(c, db=db))
-        return t
+        graph = get_graph_index(db)
+        if graph is not None:
+            graph.direct_children(job_id)  # raises if it does not exist
+            return graph.closure([job_id], 'children')
+        return _closure([job_id], direct_children, db)
 
 
 def top_targets(db):
     """ Returns a list of all jobs which are not needed by anybody """
+    top = indexed_top_targets(db)
+    if top is not None:
+        return top
+    graph = get_graph_index(db)
+    if graph is not None:
+        return graph.top_targets()
     return [x for x in all_jobs(db=db) if not direct_parents(x, db=db)]
 
 
@@ -114,15 +151,10 @@ def top_targets(db):
 @contract(jobs='list|set')
 def tree(jobs, db):
     """
-        Returns the tree of all dependencies of the jobs.
-        Note this is very inefficient because recursive.
+        Returns the tree of all dependencies of the jobs
+        (including the jobs).
     """
-    warnings.warn('Do not use -- very inefficient')
-    t = set(jobs)
-    for job_id in jobs:
-        children_id = direct_children(job_id, db=db)
-        t = t.union(tree(children_id, db=db))
-    return t
+    return set(jobs) | _closure(jobs, direct_children, db)
 
 
 @contract(job_id='str')
@@ -132,9 +164,21 @@ def parents(job_id, db):
     check_isinstance(job_id, six.string_types)
 
     with trace_bugs('parents(%r)' % job_id):
-        t = set()
-        parents_jobs = direct_parents(job_id, db=db)
-        for p in parents_jobs:
-            t.add(p)
-            t.update(parents(p, db=db))
-        return t
+        graph = get_graph_index(db)
+        if graph is not None:
+            graph.direct_parents(job_id)  # raises if it does not exist
+            return graph.closure([job_id], 'parents')
+        return _closure([job_id], direct_parents, db)
+
+
+def _closure(jobs, direct, db):
+    """ Returns the jobs reachable from the jobs with one or more steps
+        of direct(), visiting each job once. """
+    result = set()
+    stack = list(jobs)
+    while stack:
+        for x in direct(stack.pop(), db=db):
+            if not x in result:
+                result.add(x)
+                stack.append(x)
+    return result
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+    Predicts how long a make will take, before running it (see the
+    command "explain").
+
+    The jobs to do are the ones that the manager would make
+    (CacheQueryDB.list_todo_targets()); their durations are predicted
+    from the past runs (predict_durations()). The scheduler is then
+    simulated with n workers: when a worker is free, it starts the ready
+    job with the highest priority (compute_priorities()), as the manager
+    does. The jobs get integer handles and the simulation uses two heaps,
+    so it takes O((jobs + dependencies) log jobs); MakePlan memoizes it
+    for each number of workers, and the critical path.
+
+    The jobs that the dynamic jobs will define are not known in advance,
+    unless they were defined by a previous run.
+"""
+from heapq import heapify, heappop, heappush
+
+from compmake.exceptions import CompmakeBug
+
+from .priority import compute_priorities, predict_durations
+
+__all__ = [
+    'MakePlan',
+    'plan_make',
+    'simulate_schedule',
+    'critical_path',
+]
+
+
+def simulate_schedule(durations, children, priorities, workers,
+                      parents=None):
+    """
+        Returns the time to make the jobs 0..n-1 with the given number of
+        workers.
+
+        :param durations: list, the duration of each job
+        :param children: list of lists, the jobs that each job needs
+        :param priorities: list, the priority of each job
+        :param parents: the inverse of children, if already computed
+    """
+    n = len(durations)
+    if parents is None:
+        parents = _parents(children)
+    waiting = [len(kids) for kids in children]
+    # the ready jobs are in a heap of their ranks by priority
+    # (integers compare faster than tuples)
+    order = sorted(range(n), key=lambda i: -priorities[i])
+    rank = [0] * n
+    for r, i in enumerate(order):
+        rank[i] = r
+
+    ready = [rank[i] for i in range(n) if not waiting[i]]
+    heapify(ready)
+    # (end, job)
+    running = []
+    t = 0.0
+    finished = 0
+    push, pop = heappush, heappop
+    while ready or running:
+        while ready and len(running) < workers:
+            i = order[pop(ready)]
+            push(running, (t + durations[i], i))
+        t, i = pop(running)
+        finished += 1
+        for p in parents[i]:
+            waiting[p] -= 1
+            if not waiting[p]:
+                push(ready, rank[p])
+
+    if finished < n:
+        msg = 'The jobs depend on themselves (%d not made).' % (n - finished)
+        raise CompmakeBug(msg)
+    return t
+
+
+def critical_path(durations, children, parents=None):
+    """ Returns (length, path): the longest chain of dependencies, as
+        a list of jobs, the first one needed by the second, etc. """
+    n = len(durations)
+    if n == 0:
+        return 0.0, []
+    if parents is None:
+        parents = _parents(children)
+    waiting = [len(kids) for kids in children]
+    # longest path ending with the job, and the child it comes from
+    longest = [0.0] * n
+    previous = [-1] * n
+    stack = [i for i in range(n) if not waiting[i]]
+    while stack:
+        i = stack.pop()
+        li = longest[i] = longest[i] + durations[i]
+        for p in parents[i]:
+            if li > longest[p]:
+                longest[p] = li
+                previous[p] = i
+            waiting[p] -= 1
+            if not waiting[p]:
+                stack.append(p)
+    last = longest.index(max(longest))
+    path = [last]
+    while previous[path[-1]] >= 0:
+        path.append(previous[path[-1]])
+    return longest[last], path[::-1]
+
+
+def _parents(children):
+    parents = [[] for _ in children]
+    for i, kids in enumerate(children):
+        for c in kids:
+            parents[c].append(i)
+    return parents
+
+
+class MakePlan(object):
+    """ The jobs that a make would do, with their predicted durations. """
+
+    def __init__(self, jobs, durations, children, priorities, ready,
+                 from_history, dynamic):
+        # handle -> job_id
+        self.jobs = jobs
+        # handle -> predicted duration
+        self.durations = durations
+        # handle -> handles of the jobs to do that it needs
+        self.children = children
+        self.priorities = priorities
+        # number of jobs ready to start
+        self.ready = ready
+        # number of jobs whose own duration is known
+        self.from_history = from_history
+        # the dynamic jobs among them
+        self.dynamic = dynamic
+        self.parents = _parents(children)
+        # workers -> makespan, memoized
+        self.makespans = {}
+        # (length, handles), computed the first time
+        self._critical_path = None
+
+    def total(self):
+        """ The sum of the durations. """
+        return sum(self.durations)
+
+    def makespan(self, workers):
+        """ The predicted time with the given number of workers. """
+        if workers in self.makespans:
+            return self.makespans[workers]
+        if workers <= 1:
+            res = self.total()
+        elif workers >= len(self.jobs):
+            # every job starts when it is ready
+            res = self._critical()[0]
+        else:
+            res = simulate_schedule(self.durations, self.children,
+                                    self.priorities, workers, self.parents)
+        self.makespans[workers] = res
+        return res
+
+    def _critical(self):
+        if self._critical_path is None:
+            self._critical_path = critical_path(self.durations,
+                                                self.children, self.parents)
+        return self._critical_path
+
+    def critical_path(self):
+        """ Returns (length, list of job ids). """
+        length, path = self._critical()
+        return length, [self.jobs[i] for i in path]
+
+    def speedup(self, workers_list):
+        """ Returns a list of (workers, makespan, speedup); stops when the
+            makespan reaches the critical path. """
+        total = self.total()
+        length, _ = self._critical()
+        res = []
+        for workers in sorted(set(workers_list)):
+            makespan = self.makespan(workers)
+            speedup = total / makespan if makespan > 0 else 1.0
+            res.append((workers, makespan, speedup))
+            if makespan <= length * (1 + 1e-9):
+                break
+        return res
+
+
+def plan_make(targets, cq):
+    """ Returns the MakePlan for making the targets (and the jobs
+        that they need), as the manager would do. """
+    todo, _, ready = cq.list_todo_targets(targets)
+    jobs = sorted(todo)
+    handles = dict((job_id, h) for h, job_id in enumerate(jobs))
+    predicted = predict_durations(jobs, cq)
+    priorities = compute_priorities(jobs, cq)
+    children = []
+    from_history = 0
+    dynamic = []
+    for job_id in jobs:
+        children.append([handles[c] for c in cq.direct_children(job_id)
+                         if c in handles])
+        if cq.get_job_cache(job_id).walltime_used is not None:
+            from_history += 1
+        if cq.get_job(job_id).needs_context:
+            dynamic.append(job_id)
+    return MakePlan(jobs=jobs,
+                    durations=[predicted[j] for j in jobs],
+                    children=children,
+                    priorities=[priorities[j] for j in jobs],
+                    ready=len(ready),
+                    from_history=from_history,
+                    dynamic=dynamic)
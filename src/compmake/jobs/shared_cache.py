@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+    A result cache shared by several DBs, for example a directory on
+    a shared volume (see the switches "shared_cache*").
+
+    Results are keyed by the fingerprint of the computation: a hash of
+    the command and of its arguments, where each Promise is replaced by
+    the fingerprint of the job it refers to, and the sets and dicts are
+    sorted. Before computing a job,
+    make() looks for its fingerprint in the shared cache, and on a hit
+    copies the result into the DB instead of computing it.
+
+    Files are written to a temporary name and then renamed, so readers
+    never see partial results. The least recently used results are
+    deleted when the total size exceeds the limit.
+"""
+import hashlib
+import os
+import sys
+from time import time
+
+from compmake import logger
+from compmake.state import get_compmake_config
+from compmake.utils import safe_pickle_dump, safe_pickle_load
+from compmake.utils.pickle_frustration import pickle_main_context_load
+
+from ..structures import Cache, Promise
+from .code_fingerprint import code_fingerprint
+from .storage import get_job, get_job_args, get_job_cache, job_cache_exists
+
+if sys.version_info[0] >= 3:
+    import pickle  # @UnusedImport
+else:
+    import cPickle as pickle  # @Reimport
+
+__all__ = [
+    'SharedCache',
+    'get_shared_cache',
+    'job_fingerprint',
+    'not_shareable',
+]
+
+# fixed, so that different versions of Python agree on the fingerprints
+fingerprint_protocol = 2
+
+
+# recorded as the fingerprint of the jobs that cannot be shared,
+# so that the jobs using them do not compute it again
+not_shareable = 'not-shareable'
+
+
+def job_fingerprint(job_id, db):
+    """
+        Returns the fingerprint of the computation of the job,
+        or None if the job cannot be shared: jobs that need the context
+        (they define other jobs), and the jobs using their results.
+
+        For the dependencies that are done, the fingerprint recorded
+        in their cache is used; the others are computed in turn,
+        without recursion.
+    """
+    # job_id -> fingerprint or None
+    memo = {}
+    # job_id -> (job, command, args, kwargs, dependencies)
+    loaded = {}
+    stack = [job_id]
+    while stack:
+        j = stack[-1]
+        if j in memo:
+            stack.pop()
+            continue
+        if not j in loaded:
+            recorded = None if j == job_id else _recorded(j, db)
+            if recorded is not None:
+                memo[j] = None if recorded == not_shareable else recorded
+                stack.pop()
+                continue
+            job = get_job(j, db)
+            if job.needs_context:
+                memo[j] = None
+                stack.pop()
+                continue
+            command, args, kwargs = get_job_args(j, db)
+            loaded[j] = (job, command, args, kwargs,
+                         _promises((args, kwargs)))
+        missing = [d for d in loaded[j][4] if not d in memo]
+        if missing:
+            stack.extend(missing)
+            continue
+        stack.pop()
+        memo[j] = _fingerprint(loaded.pop(j), memo)
+    return memo[job_id]
+
+
+def _recorded(job_id, db):
+    """ The fingerprint recorded in the cache, if the job is done. """
+    if job_cache_exists(job_id, db):
+        cache = get_job_cache(job_id, db)
+        if cache.state == Cache.DONE:
+            return getattr(cache, 'fingerprint', None)
+    return None
+
+
+def _promises(x):
+    """ The ids of the jobs referred to in x. """
+    res = []
+    stack = [x]
+    while stack:
+        x = stack.pop()
+        if isinstance(x, Promise):
+            res.append(x.job_id)
+        elif type(x) is dict:
+            stack.extend(x.values())
+        elif type(x) in (list, tuple):
+            stack.extend(x)
+    return res
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+def _fingerprint(loaded, memo):
+    """ The fingerprint of a job, given the ones of its dependencies. """
+    job, command, args, kwargs, _ = loaded
+
+    def replace(x):
+        if isinstance(x, Promise):
+            # (not found by _promises() inside a set)
+            fp = memo.get(x.job_id, None)
+            if fp is None:
+                raise _Uncacheable()
+            return ('compmake-promise', fp)
+        # the sets and the dicts are sorted, as their order might
+        # depend on the hash seed (see _describe_value())
+        if type(x) is dict:
+            items = [(replace(k), replace(v)) for k, v in x.items()]
+            return ('compmake-dict',
+                    tuple(sorted(items, key=lambda kv: repr(kv[0]))))
+        if type(x) in (set, frozenset):
+            return ('compmake-set',
+                    tuple(sorted((replace(v) for v in x), key=repr)))
+        if type(x) in (list, tuple):
+            return type(x)(replace(v) for v in x)
+        return x
+
+    try:
+        what = (command_id(command, job.pickle_main_context),
+                replace(args), replace(kwargs))
+    except _Uncacheable:
+        return None
+    try:
+        with pickle_main_context_load(job.pickle_main_context):
+            data = pickle.dumps(what, fingerprint_protocol)
+    except Exception:
+        return None
+    return hashlib.sha256(data).hexdigest()
+
+
+def command_id(command, pickle_main_context):
+    """ Identifies a function by its name and its code
+        (see code_fingerprint()). """
+    module = getattr(command, '__module__', None)
+    if module == '__main__':
+        module = pickle_main_context['main_module']
+    name = getattr(command, '__qualname__', getattr(command, '__name__', None))
+    fp = code_fingerprint(command)
+    if fp is None:
+        return module, name, repr(command)
+    return module, name, fp
+
+
+class SharedCache(object):
+    """ The results stored in a directory, by fingerprint. """
+
+    # seconds after which the total size is measured again
+    rescan_interval = 60.0
+
+    def __init__(self, dirname, max_bytes):
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        # estimate of the total size, and when it was measured
+        self.nbytes = None
+        self.last_scan = 0.0
+
+    def filename(self, fp):
+        return os.path.join(self.dirname, fp[:2], '%s.pickle' % fp)
+
+    def get(self, fp):
+        """ Returns a pair (found, value). """
+        filename = self.filename(fp)
+        try:
+            value = safe_pickle_load(filename)
+        except (IOError, OSError):
+            return False, None
+        except Exception as e:
+            # something that cannot be unpickled here
+            logger.warning('Cannot read %s from the shared cache: %s' %
+                           (filename, e))
+            return False, None
+        try:
+            # remember that it was used recently (see evict())
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return True, value
+
+    def __contains__(self, fp):
+        return os.path.exists(self.filename(fp))
+
+    def publish(self, fp, value):
+        """ Stores the value, unless it is there already. """
+        filename = self.filename(fp)
+        if os.path.exists(filename):
+            return
+        safe_pickle_dump(value, filename)
+        size = os.stat(filename).st_size
+        if self.nbytes is not None:
+            self.nbytes += size
+        if (self.nbytes is None or self.nbytes > self.max_bytes or
+                time() - self.last_scan > self.rescan_interval):
+            self.evict()
+
+    def _entries(self):
+        """ Returns the list of (mtime, size, filename). """
+        res = []
+        if not os.path.exists(self.dirname):
+            return res
+        for d in os.scandir(self.dirname):
+            if not d.is_dir():
+                continue
+            for entry in os.scandir(d.path):
+                if not entry.name.endswith('.pickle'):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:  # deleted by another process
+                    continue
+                res.append((st.st_mtime, st.st_size, entry.path))
+        return res
+
+    def evict(self):
+        """ Deletes the least recently used results until the total
+            is below the limit. Returns the number of bytes freed. """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        freed = 0
+        for _, size, filename in entries:
+            if total - freed <= self.max_bytes:
+                break
+            try:
+                os.unlink(filename)
+            except OSError:  # deleted by another process
+                pass
+            freed += size
+        self.nbytes = total - freed
+        self.last_scan = time()
+        return freed
+
+
+class Instances(object):
+    # (dirname, pid) -> SharedCache
+    caches = {}
+
+
+def get_shared_cache():
+    """ Returns the SharedCache given by the switch "shared_cache",
+        or None if it is not set. """
+    dirname = get_compmake_config('shared_cache')
+    if not dirname:
+        return None
+    dirname = os.path.realpath(os.path.expanduser(dirname))
+    k = (dirname, os.getpid())
+    if not k in Instances.caches:
+        max_bytes = get_compmake_config('shared_cache_max_mb') * 1024 * 1024
+        Instances.caches[k] = SharedCache(dirname, max_bytes)
+    return Instances.caches[k]
@@ -0,0 +1,497 @@
+# -*- coding: utf-8 -*-
+"""
+    A columnar table with the state of each job, so that the commands
+    that only need the states (stats, the "done"/"failed"/... aliases)
+    do not read one Cache record per job.
+
+    The table is derived from the cm-job- and cm-cache- records. It is
+    kept in the directory "state_table" of the DB, and it is updated by
+    set_job(), set_job_cache() and the functions deleting them.
+
+    - "index.txt" is an append-only log of lines
+      "row<TAB>command<TAB>job_id" assigning a row to each job;
+    - "states.bin" has a fixed-size record for each row, updated in
+      place, that can be memory-mapped as a numpy array with the dtype
+      state_table_dtype (state, timestamp, walltime, cputime).
+
+    The rows are written holding the lock of the table, with the states
+    of the records as they are then (see _write_records()): when several
+    processes write the same job, the last one to take the lock reads
+    the last record written.
+
+    The queries use numpy; without it they read the Cache records.
+
+    The records written directly (e.g. copied from another DB) must be
+    followed by jobs_copied(). "check-consistency" compares the table
+    with the records, and "rebuild-state-table" writes it again.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import repeat
+import fcntl
+import os
+import shutil
+import struct
+
+from compmake.state import get_compmake_config
+
+from ..structures import Cache
+
+__all__ = [
+    'StateTable',
+    'get_state_table',
+    'rebuild_state_table',
+    'check_state_table',
+    'read_state_table',
+    'count_states_by_command',
+    'jobs_with_state',
+    'state_table_job_defined',
+    'state_table_update',
+    'state_table_reset',
+    'state_table_delete',
+]
+
+state_table_dirname = 'state_table'
+
+# state of the rows of deleted jobs
+STATE_DELETED = -1
+
+record_format = '<bddd'
+record_size = struct.calcsize(record_format)
+state_table_dtype = [('state', '<i1'),
+                     ('timestamp', '<f8'),
+                     ('walltime', '<f8'),
+                     ('cputime', '<f8')]
+
+
+class StateTable(object):
+    """ See the module documentation. Use get_state_table(). """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.index_filename = os.path.join(dirname, 'index.txt')
+        self.states_filename = os.path.join(dirname, 'states.bin')
+        self._forget()
+
+    def _forget(self):
+        self.job2row = {}
+        # row -> job_id
+        self.row2job = []
+        # row -> command id; command id -> command
+        self.row2command = []
+        self.commands = []
+        self.command2id = {}
+        self.inode = None
+        self.offset = 0
+
+    @contextmanager
+    def _locked(self):
+        with open(self.dirname + '.lock', 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _read_tail(self):
+        """ Reads the index lines appended since the last time. """
+        st = os.stat(self.index_filename)
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            # first time, or rebuilt
+            self._forget()
+            self.inode = st.st_ino
+        if st.st_size == self.offset:
+            return
+
+        with open(self.index_filename, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        # ignore a partially written last line
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+
+        for line in data[:end].decode('utf-8').split('\n'):
+            if not line:
+                continue
+            row, command, job_id = line.split('\t', 2)
+            self._set_row(int(row), command, job_id)
+
+    def _set_row(self, row, command, job_id):
+        if not command in self.command2id:
+            self.command2id[command] = len(self.commands)
+            self.commands.append(command)
+        if row == len(self.row2job):
+            self.row2job.append(job_id)
+            self.row2command.append(self.command2id[command])
+        else:
+            self.row2command[row] = self.command2id[command]
+        self.job2row[job_id] = row
+
+    def row(self, job_id):
+        """ Returns the row of the job, or None. """
+        self._read_tail()
+        return self.job2row.get(job_id, None)
+
+    def rows(self, job_ids):
+        """ Returns the list of the rows of the jobs (-1 if not present). """
+        self._read_tail()
+        return list(map(self.job2row.get, job_ids, repeat(-1)))
+
+    def add(self, job_id, command):
+        """ Returns the row of the job, creating it if necessary,
+            and whether it was created. """
+        row = self.row(job_id)
+        if row is not None and self.commands[self.row2command[row]] == command:
+            return row, False
+
+        with self._locked():
+            self._read_tail()
+            row = self.job2row.get(job_id, None)
+            created = row is None
+            if created:
+                row = len(self.row2job)
+                # the record before the index line, which makes it visible
+                self.write(row, Cache.NOT_STARTED)
+            elif self.commands[self.row2command[row]] == command:
+                return row, False
+            line = '%d\t%s\t%s\n' % (row, command, job_id)
+            fd = os.open(self.index_filename,
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+            try:
+                os.write(fd, line.encode('utf-8'))
+            finally:
+                os.close(fd)
+            self._read_tail()
+        return row, created
+
+    def write(self, row, state, timestamp=0.0, walltime=None, cputime=None):
+        data = _pack(state, timestamp, walltime, cputime)
+        fd = os.open(self.states_filename, os.O_RDWR | os.O_CREAT)
+        try:
+            os.lseek(fd, row * record_size, os.SEEK_SET)
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def read_state(self, row):
+        """ Returns the state of one row. """
+        fd = os.open(self.states_filename, os.O_RDONLY)
+        try:
+            data = os.pread(fd, record_size, row * record_size)
+        finally:
+            os.close(fd)
+        if len(data) < record_size:
+            # being added
+            return Cache.NOT_STARTED
+        return struct.unpack(record_format, data)[0]
+
+    def read_states(self):
+        """ Returns the column of the states, indexed by row. """
+        import numpy as np
+        self._read_tail()
+        n = len(self.row2job)
+        size = min(os.path.getsize(self.states_filename) // record_size, n)
+        states = np.empty(n, 'i1')
+        # rows being added
+        states[size:] = Cache.NOT_STARTED
+        if size > 0:
+            states[:size] = self.read_records()['state'][:size]
+        return states
+
+    def read_records(self):
+        """ Returns all the records as a numpy structured array
+            (a read-only memory map), indexed by row. """
+        import numpy as np
+        self._read_tail()
+        size = os.path.getsize(self.states_filename) // record_size
+        if size == 0:
+            return np.zeros(0, dtype=state_table_dtype)
+        return np.memmap(self.states_filename, mode='r',
+                         dtype=state_table_dtype, shape=(size,))
+
+
+class Instances(object):
+    # (dirname, pid) -> StateTable
+    tables = {}
+
+
+def get_state_table(db):
+    """
+        Returns the StateTable of the DB, building it the first time,
+        or None if the switch "state_table" is off.
+    """
+    if not get_compmake_config('state_table'):
+        return None
+    dirname = os.path.join(db.basepath, state_table_dirname)
+    k = (dirname, os.getpid())
+    if not k in Instances.tables:
+        Instances.tables[k] = StateTable(dirname)
+    table = Instances.tables[k]
+    if not os.path.exists(dirname):
+        rebuild_state_table(db, only_if_missing=True)
+    return table
+
+
+def rebuild_state_table(db, only_if_missing=False):
+    """ Builds the table from the job and cache records;
+        returns the number of jobs. """
+    from .storage import all_jobs, get_job_caches, get_jobs
+
+    dirname = os.path.join(db.basepath, state_table_dirname)
+    if not os.path.exists(db.basepath):
+        os.makedirs(db.basepath)
+    with StateTable(dirname)._locked():
+        if only_if_missing and os.path.exists(dirname):
+            return None
+        jobs = get_jobs(all_jobs(db), db)
+        caches = get_job_caches(jobs, db)
+
+        tmp = StateTable('%s.tmp.%s' % (dirname, os.getpid()))
+        if os.path.exists(tmp.dirname):
+            shutil.rmtree(tmp.dirname)
+        os.makedirs(tmp.dirname)
+        with open(tmp.index_filename, 'w') as f:
+            for row, job_id in enumerate(sorted(jobs)):
+                command = jobs[job_id].command_desc
+                f.write('%d\t%s\t%s\n' % (row, command, job_id))
+        with open(tmp.states_filename, 'wb') as f:
+            for job_id in sorted(jobs):
+                cache = caches[job_id]
+                f.write(_pack(cache.state, cache.timestamp,
+                              cache.walltime_used, cache.cputime_used))
+
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        os.rename(tmp.dirname, dirname)
+    return len(jobs)
+
+
+def check_state_table(db):
+    """ Returns a list of the differences between the table and the
+        job and cache records (empty if the table is off). """
+    from .storage import all_jobs, get_job_caches, get_jobs
+    table = get_state_table(db)
+    if table is None:
+        return []
+    table._read_tail()
+    with open(table.states_filename, 'rb') as f:
+        data = f.read()
+    jobs = get_jobs(all_jobs(db), db)
+    caches = get_job_caches(jobs, db)
+    names = dict(Cache.state2desc)
+    names[STATE_DELETED] = 'deleted'
+
+    errors = []
+    for row, job_id in enumerate(table.row2job):
+        if (row + 1) * record_size <= len(data):
+            state = struct.unpack_from(record_format, data,
+                                       row * record_size)[0]
+        else:
+            # being added
+            state = Cache.NOT_STARTED
+        if not job_id in jobs:
+            if state != STATE_DELETED:
+                errors.append('Job %r does not exist but is %r in the '
+                              'state table.' % (job_id, names[state]))
+            continue
+        command = table.commands[table.row2command[row]]
+        if command != jobs[job_id].command_desc:
+            errors.append('Job %r has command %r in the state table '
+                          'instead of %r.' % (job_id, command,
+                                              jobs[job_id].command_desc))
+        expected = caches[job_id].state
+        if state != expected:
+            errors.append('Job %r is %r in the state table instead of %r.' %
+                          (job_id, names.get(state, state), names[expected]))
+    for job_id in sorted(set(jobs) - set(table.job2row)):
+        errors.append('Job %r is not in the state table.' % job_id)
+    return errors
+
+
+def _pack(state, timestamp, walltime, cputime):
+    nan = float('nan')
+    return struct.pack(record_format, state, timestamp or 0.0,
+                       nan if walltime is None else walltime,
+                       nan if cputime is None else cputime)
+
+
+def state_table_job_defined(job_id, job, db):
+    """ Called by set_job(). """
+    table = get_state_table(db)
+    if table is None:
+        return
+    row, created = table.add(job_id, job.command_desc)
+    if not created and table.read_state(row) != STATE_DELETED:
+        return
+    from .storage import job2cachekey
+    if created and not job2cachekey(job_id) in db:
+        # added as not started
+        return
+    # the job could have been deleted keeping its cache
+    with table._locked():
+        _write_records(table, [job_id], db)
+
+
+def state_table_update(job_id, cache, db):  # @UnusedVariable
+    """ Called by set_job_cache(); the cache is read again holding
+        the lock (see _write_records()). """
+    table = get_state_table(db)
+    if table is None:
+        return
+    row = table.row(job_id)
+    if row is None:
+        from .storage import get_job, job_exists
+        if not job_exists(job_id, db):
+            return
+        table.add(job_id, get_job(job_id, db).command_desc)
+    with table._locked():
+        _write_records(table, [job_id], db)
+
+
+def _write_records(table, job_ids, db):
+    """
+        Writes the rows of the jobs with the states of their records as
+        they are now (deleted if the job does not exist).
+
+        Call with the lock held, after writing the records: the process
+        that writes a row last then reads the last records.
+    """
+    from compmake.storage.batch import contains_many
+    from .storage import get_job_caches, job2key
+    rows = dict((job_id, row) for job_id, row in
+                zip(job_ids, table.rows(job_ids)) if row >= 0)
+    keys = dict((job2key(job_id), job_id) for job_id in rows)
+    existing = [keys[k] for k in contains_many(db, keys)]
+    caches = get_job_caches(existing, db)
+    for job_id, row in rows.items():
+        if job_id in caches:
+            _write_cache(table, row, caches[job_id])
+        else:
+            table.write(row, STATE_DELETED)
+
+
+def _write_cache(table, row, cache):
+    table.write(row, cache.state, cache.timestamp,
+                cache.walltime_used, cache.cputime_used)
+
+
+def state_table_reset(job_ids, db):
+    """ Called when the caches of the jobs are deleted. """
+    table = get_state_table(db)
+    if table is None:
+        return
+    with table._locked():
+        _write_records(table, job_ids, db)
+
+
+def state_table_delete(job_ids, db):
+    """ Called when the jobs are deleted. """
+    table = get_state_table(db)
+    if table is None:
+        return
+    with table._locked():
+        _write_records(table, job_ids, db)
+
+
+def read_state_table(db):
+    """
+        Returns a tuple (job_ids, commands, records) for all the jobs
+        in the table: commands[i] is the command of job_ids[i] and
+        records is a numpy structured array (see state_table_dtype).
+
+        The rows of deleted jobs have state -1.
+    """
+    table = get_state_table(db)
+    if table is None:
+        return None
+    records = table.read_records()
+    n = len(records)
+    commands = [table.commands[c] for c in table.row2command[:n]]
+    return list(table.row2job[:n]), commands, records
+
+
+def _use_table(db):
+    """ Whether the queries can use the table; the table is
+        written in any case, but read using numpy. """
+    if get_state_table(db) is None:
+        return False
+    try:
+        import numpy  # @UnusedImport
+    except ImportError:
+        return False
+    return True
+
+
+def _lookup(job_ids, db):
+    """
+        Returns (table, found, rows, states): found are the indices in
+        job_ids of the jobs that exist, rows their rows, and states the
+        column of the states.
+
+        The jobs missing from the table are read from the DB and added,
+        so that a table that was not kept up to date (e.g. the DB was
+        used with the switch off) converges; the states written with
+        the switch off are found by "check-consistency", and fixed by
+        "rebuild-state-table".
+    """
+    import numpy as np
+    table = get_state_table(db)
+
+    def lookup():
+        rows = np.array(table.rows(job_ids), dtype='int64')
+        states = table.read_states()
+        ok = rows >= 0
+        ok[ok] = states[rows[ok]] != STATE_DELETED
+        return rows, states, ok
+
+    rows, states, ok = lookup()
+    if not np.all(ok):
+        from .storage import get_job_caches, get_jobs
+        missing = [job_ids[i] for i in np.nonzero(~ok)[0]]
+        jobs = get_jobs(missing, db)
+        caches = get_job_caches(jobs, db)
+        for job_id in sorted(jobs):
+            row, _ = table.add(job_id, jobs[job_id].command_desc)
+            _write_cache(table, row, caches[job_id])
+        if jobs:
+            rows, states, ok = lookup()
+    found = np.nonzero(ok)[0]
+    return table, found, rows[found], states
+
+
+def count_states_by_command(job_ids, db):
+    """ Returns a dict command -> state -> number of jobs. """
+    job_ids = list(job_ids)
+    res = defaultdict(lambda: defaultdict(lambda: 0))
+    if not _use_table(db):
+        from .storage import get_job_caches, get_jobs
+        jobs = get_jobs(job_ids, db)
+        caches = get_job_caches(jobs, db)
+        for job_id in jobs:
+            res[jobs[job_id].command_desc][caches[job_id].state] += 1
+        return res
+
+    import numpy as np
+    table, _, rows, states = _lookup(job_ids, db)
+    commands = np.array(table.row2command, dtype='int64')[rows]
+    nstates = max(Cache.allowed_states) + 1
+    counts = np.bincount(commands * nstates + states[rows],
+                         minlength=len(table.commands) * nstates)
+    for i in np.nonzero(counts)[0]:
+        command, state = divmod(int(i), nstates)
+        res[table.commands[command]][state] = int(counts[i])
+    return res
+
+
+def jobs_with_state(job_ids, db, states):
+    """ Returns the jobs among job_ids whose state is in states. """
+    job_ids = list(job_ids)
+    if not _use_table(db):
+        from .storage import get_job_caches
+        caches = get_job_caches(job_ids, db)
+        return [job_id for job_id in job_ids if caches[job_id].state in states]
+
+    import numpy as np
+    _, found, rows, column = _lookup(job_ids, db)
+    selected = found[np.isin(column[rows], list(states))]
+    return [job_ids[i] for i in selected]
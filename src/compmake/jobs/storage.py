@@ -2,14 +2,26 @@
 """
     These are all wrappers around the raw methods in storage
 """
+import copy
+from functools import partial
 
 from compmake.exceptions import CompmakeBug, CompmakeException, CompmakeDBError
+from compmake.storage.atomic import atomic_update
+from compmake.storage.batch import delete_many, get_many
 from compmake.utils.pickle_frustration import pickle_main_context_load
 from contracts import contract
 from contracts.utils import raise_desc
 
 from ..structures import Cache, Job
-from ..utils import wildcard_to_regexp
+from .array_files import (array_files_sizeof, delete_array_files,
+                          externalize_arrays, load_array_files,
+                          remove_stale_array_files)
+from .blobs import blobrefs_key, load_with_blobs, store_with_blobs
+from .changes import note_jobs_changed
+from .graph_index import graph_index_job_defined, graph_index_job_deleted
+from .job_index import job_index_delete, job_index_job_defined
+from .state_table import (state_table_delete, state_table_job_defined,
+                          state_table_reset, state_table_update)
 
 
 def job2key(job_id):
@@ -27,12 +39,8 @@ def all_jobs(db, force_db=False):
         If force_db is True, read jobs from DB.
         Otherwise, use local cache.
      """
-    pattern = job2key('*')
-    regexp = wildcard_to_regexp(pattern)
-
-    for key in db.keys():
-        if regexp.match(key):
-            yield key2job(key)
+    for key in db.keys_with_prefix(job2key('')):
+        yield key2job(key)
 
 
 def get_job(job_id, db):
@@ -42,6 +50,13 @@ def get_job(job_id, db):
     return computation
 
 
+def get_jobs(job_ids, db):
+    """ Returns a dict job_id -> Job for the jobs that exist,
+        reading them in one batch. """
+    keys = dict((job2key(job_id), job_id) for job_id in job_ids)
+    return dict((keys[key], job) for key, job in get_many(db, keys).items())
+
+
 def job_exists(job_id, db):
     key = job2key(job_id)
     return key in db
@@ -59,11 +74,54 @@ def set_job(job_id, job, db):
     key = job2key(job_id)
     assert (isinstance(job, Job))
     db[key] = job
+    state_table_job_defined(job_id, job, db)
+    graph_index_job_defined(job_id, job, db)
+    job_index_job_defined(job_id, job, db)
+    note_jobs_changed([job_id], db, defined=True)
+
+
+def update_job(job_id, function, db):
+    """ Atomically replaces the job with function(job), where function
+        can modify the job in place; returns the new job. """
+    key = job2key(job_id)
+
+    def f(job):
+        assert isinstance(job, Job)
+        job = function(job)
+        assert isinstance(job, Job)
+        return job
+
+    job = atomic_update(db, key, f)
+    graph_index_job_defined(job_id, job, db)
+    job_index_job_defined(job_id, job, db)
+    note_jobs_changed([job_id], db)
+    return job
+
+
+def jobs_copied(job_ids, db):
+    """ Updates the indexes after the Job and Cache records of the jobs
+        were written without set_job() and set_job_cache() (e.g. copied
+        from another DB). """
+    job_ids = list(job_ids)
+    for job_id in job_ids:
+        if not job_exists(job_id, db):
+            continue
+        job = get_job(job_id, db)
+        state_table_job_defined(job_id, job, db)
+        graph_index_job_defined(job_id, job, db)
+        job_index_job_defined(job_id, job, db)
+        if job_cache_exists(job_id, db):
+            state_table_update(job_id, get_job_cache(job_id, db), db)
+    note_jobs_changed(job_ids, db, defined=True)
 
 
 def delete_job(job_id, db):
     key = job2key(job_id)
     del db[key]
+    state_table_delete([job_id], db)
+    graph_index_job_deleted([job_id], db)
+    job_index_delete([job_id], db)
+    note_jobs_changed([job_id], db, defined=True)
 
 
 #
@@ -81,12 +139,13 @@ def get_job_cache(job_id, db):
             cache = db[cache_key]
             assert isinstance(cache, Cache)
         except Exception as e:
-            del db[cache_key]
+            # through delete_job_cache() for the state table
+            delete_job_cache(job_id, db)
             # also remove user object?
             msg = 'Could not read Cache object for job "%s": %s; deleted.' % (
                 job_id, e)
             raise CompmakeException(msg)
-        return cache
+        return _with_details_loader(job_id, cache, db)
     else:
         # make sure this is a valid job_id
         # XXX expensive
@@ -105,26 +164,112 @@ def get_job_cache(job_id, db):
         return cache
 
 
+def get_job_caches(job_ids, db):
+    """ Returns a dict job_id -> Cache, reading them in one batch.
+        The jobs must exist; jobs without cache are NOT_STARTED. """
+    job_ids = list(job_ids)
+    keys = dict((job2cachekey(job_id), job_id) for job_id in job_ids)
+    found = get_many(db, keys)
+    res = {}
+    for key, job_id in keys.items():
+        if key in found:
+            cache = found[key]
+            assert isinstance(cache, Cache)
+            res[job_id] = _with_details_loader(job_id, cache, db)
+        else:
+            res[job_id] = Cache(Cache.NOT_STARTED)
+    return res
+
+
 def job_cache_exists(job_id, db):
     key = job2cachekey(job_id)
     return key in db
 
 
 def job_cache_sizeof(job_id, db):
+    """ Size of the cache, including the details. """
     key = job2cachekey(job_id)
-    return db.sizeof(key)
+    size = db.sizeof(key)
+    details_key = job2cachedetailskey(job_id)
+    if details_key in db:
+        size += db.sizeof(details_key)
+    return size
 
 
 def set_job_cache(job_id, cache, db):
+    """
+        Writes the cache; the fields in Cache.details_fields (output,
+        backtrace, timers) go in a separate key, so that reading the
+        state of a job does not read them.
+
+        If the cache was read from the DB and those fields were not
+        accessed, the stored ones are left as they are.
+    """
     assert (isinstance(cache, Cache))
     key = job2cachekey(job_id)
-    db[key] = cache
+    fields = cache.__dict__
+    present = [f for f in Cache.details_fields if f in fields]
+    if present:
+        details = {}
+        if len(present) < len(Cache.details_fields):
+            details.update(get_job_cache_details(job_id, db))
+        for f in present:
+            details[f] = fields[f]
+        details = dict((k, v) for k, v in details.items() if v is not None)
+        details_key = job2cachedetailskey(job_id)
+        if details:
+            db[details_key] = details
+        elif details_key in db:
+            del db[details_key]
+
+    record = Cache.__new__(Cache)
+    record.__dict__.update((k, v) for k, v in fields.items()
+                           if not k in Cache.details_fields and
+                           k != '_details_loader')
+    db[key] = record
+    state_table_update(job_id, record, db)
+    note_jobs_changed([job_id], db)
 
 
 @contract(job_id=str)
 def delete_job_cache(job_id, db):
-    key = job2cachekey(job_id)
-    del db[key]
+    delete_job_caches([job_id], db)
+
+
+def delete_job_caches(job_ids, db):
+    """ Deletes the caches of the jobs (the ones that do not
+        have one are ignored). """
+    job_ids = set(job_ids)
+    delete_many(db, [f(job_id) for job_id in job_ids
+                     for f in [job2cachekey, job2cachedetailskey]])
+    state_table_reset(job_ids, db)
+    note_jobs_changed(job_ids, db)
+
+
+def job2cachedetailskey(job_id):
+    prefix = 'cm-details-'
+    return '%s%s' % (prefix, job_id)
+
+
+def get_job_cache_details(job_id, db):
+    """ Returns a dict with the fields of the cache in
+        Cache.details_fields that are not None. """
+    key = job2cachedetailskey(job_id)
+    found = get_many(db, [key])
+    return found.get(key, {})
+
+
+def _with_details_loader(job_id, cache, db):
+    """ Returns a copy of the cache that loads the details
+        when they are accessed. """
+    if any(f in cache.__dict__ for f in Cache.details_fields):
+        # written before the details were split; they are split
+        # the next time it is written
+        return cache
+    # do not modify the object, which could be in a MemoryCache
+    cache = copy.copy(cache)
+    cache._details_loader = partial(get_job_cache_details, job_id, db)
+    return cache
 
 
 #
@@ -150,14 +295,20 @@ def get_job_userobject(job_id, db):
     #         raise CompmakeBug(msg)
     # print('loading %r ' % job_id)
     key = job2userobjectkey(job_id)
-    res = db[key]
+    res = load_with_blobs(db[key], db)
     # print('... done')
-    return res
+    try:
+        return load_array_files(res, db)
+    except FileNotFoundError:
+        # the result was rewritten while loading it
+        res = load_with_blobs(db[key], db)
+        return load_array_files(res, db)
 
 
 def job_userobject_sizeof(job_id, db):
+    """ Includes the size of the array files. """
     key = job2userobjectkey(job_id)
-    return db.sizeof(key)
+    return db.sizeof(key) + array_files_sizeof(job_id, db)
 
 
 def is_job_userobject_available(job_id, db):
@@ -170,12 +321,16 @@ job_userobject_exists = is_job_userobject_available
 
 def set_job_userobject(job_id, obj, db):
     key = job2userobjectkey(job_id)
-    db[key] = obj
+    value = externalize_arrays(job_id, obj, db)
+    store_with_blobs(key, value, db)
+    # the previous result does not use them anymore
+    remove_stale_array_files(job_id, value, db)
 
 
 def delete_job_userobject(job_id, db):
     key = job2userobjectkey(job_id)
-    del db[key]
+    delete_many(db, [key, blobrefs_key(key)])
+    delete_array_files(job_id, db)
 
 
 def job2jobargskey(job_id):
@@ -192,7 +347,7 @@ def get_job_args(job_id, db):
         job = get_job(job_id, db)
         pickle_main_context = job.pickle_main_context
         with pickle_main_context_load(pickle_main_context):
-            return db[key]
+            return load_with_blobs(db[key], db)
 
 
 def job_args_exists(job_id, db):
@@ -207,68 +362,57 @@ def job_args_sizeof(job_id, db):
 
 def set_job_args(job_id, obj, db):
     key = job2jobargskey(job_id)
-    db[key] = obj
+    store_with_blobs(key, obj, db)
 
 
 def delete_job_args(job_id, db):
     key = job2jobargskey(job_id)
-    del db[key]
+    delete_many(db, [key, blobrefs_key(key)])
 
 
 def delete_all_job_data(job_id, db):
     # print('deleting_all_job_data(%r)' % job_id)
-    args = dict(job_id=job_id, db=db)
-    if job_exists(**args):
-        delete_job(**args)
-    if job_args_exists(**args):
-        delete_job_args(**args)
-    if job_userobject_exists(**args):
-        delete_job_userobject(**args)
-    if job_cache_exists(**args):
-        delete_job_cache(**args)
-
-
-# These are delicate and should be implemented differently
+    delete_jobs_data([job_id], db)
+
+
+def delete_jobs_data(job_ids, db):
+    """ Deletes everything about the jobs, in one batch. """
+    job_ids = list(job_ids)
+    keys = []
+    for job_id in job_ids:
+        args_key = job2jobargskey(job_id)
+        res_key = job2userobjectkey(job_id)
+        keys.extend([job2key(job_id), args_key, res_key,
+                     job2cachekey(job_id), job2cachedetailskey(job_id),
+                     blobrefs_key(args_key),
+                     blobrefs_key(res_key)])
+        delete_array_files(job_id, db)
+    delete_many(db, keys)
+    state_table_delete(job_ids, db)
+    graph_index_job_deleted(job_ids, db)
+    job_index_delete(job_ids, db)
+    note_jobs_changed(job_ids, db, defined=True)
+
+
 def db_job_add_dynamic_children(job_id, children, returned_by, db):
-    job = get_job(job_id, db)
-    if not returned_by in job.children:
-        msg = '%r does not know it has child  %r' % (job_id, returned_by)
-        raise CompmakeBug(msg)
+    def add(job):
+        if not returned_by in job.children:
+            msg = '%r does not know it has child  %r' % (job_id, returned_by)
+            raise CompmakeBug(msg)
+        job.children.update(children)
+        job.dynamic_children[returned_by] = children
+        return job
 
-    job.children.update(children)
-    job.dynamic_children[returned_by] = children
-    set_job(job_id, job, db)
-    job2 = get_job(job_id, db)
-    assert job2.children == job.children, 'Race condition'
-    assert job2.dynamic_children == job.dynamic_children, 'Race condition'
+    update_job(job_id, add, db)
 
 
 def db_job_add_parent(db, job_id, parent):
-    j = get_job(job_id, db)
-    # print('%s old parents list: %s' % (d, j.parents))
-    j.parents.add(parent)
-    set_job(job_id, j, db)
-    j2 = get_job(job_id, db)
-    assert j2.parents == j.parents, 'Race condition'  # FIXME
+    def add(job):
+        job.parents.add(parent)
+        return job
+
+    update_job(job_id, add, db)
 
 
 def db_job_add_parent_relation(child, parent, db):
-    child_comp = get_job(child, db=db)
-    orig = set(child_comp.parents)
-    want = orig | set([parent])
-    # alright, need to take care of race condition
-    while True:
-        # Try to write
-        child_comp.parents = want
-        set_job(child, child_comp, db=db)
-        # now read back
-        child_comp = get_job(child, db=db)
-        if child_comp.parents != want:
-            print('race condition for parents of %s' % child)
-            print('orig: %s' % orig)
-            print('want: %s' % want)
-            print('now: %s' % child_comp.parents)
-            # add the children of the other racers as well
-            want = want | child_comp.parents
-        else:
-            break
+    db_job_add_parent(db=db, job_id=child, parent=parent)
@@ -32,6 +32,7 @@ from compmake.jobs.uptodate import CacheQueryDB
 from contracts import check_isinstance, contract
 
 from .. import get_job
+from ..state_table import jobs_with_state
 from ...exceptions import CompmakeSyntaxError, UserError
 from ...structures import Cache
 from ...utils import expand_wildcard
@@ -175,9 +176,7 @@ class Operators(object):
 
 def list_jobs_with_state(state, context, cq):  # @UnusedVariable
     """ Returns a list of jobs in the given state. """
-    for job_id in cq.all_jobs():
-        if cq.get_job_cache(job_id).state == state:  # TODO
-            yield job_id
+    return jobs_with_state(cq.all_jobs(), cq.db, [state])
 
 
 def list_ready_jobs(context, cq):  # @UnusedVariable
@@ -202,9 +201,8 @@ def list_todo_jobs(context, cq):  # @UnusedVariable
         Returns a list of jobs that haven't been DONE.
         Note that it could be DONE but not up-to-date.
     """
-    for job_id in cq.all_jobs():
-        if cq.get_job_cache(job_id).state != Cache.DONE:
-            yield job_id
+    states = [s for s in Cache.allowed_states if s != Cache.DONE]
+    return jobs_with_state(cq.all_jobs(), cq.db, states)
 
 
 def list_root_jobs(context, cq):  # @UnusedVariable
@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
+from collections import defaultdict
 from contextlib import contextmanager
 
 from compmake.exceptions import CompmakeDBError
+from compmake.state import get_compmake_config
 from contracts import check_isinstance, contract
 from contracts.utils import raise_wrapped, raise_desc
 
 from ..exceptions import CompmakeBug
 from ..structures import Cache, Job
 from ..utils import memoized_reset
+from .changes import watch_job_changes
+from .code_fingerprint import code_changed
 from .dependencies import collect_dependencies
+from .early_cutoff import same_result
+from .graph_index import get_graph_index
 from .queries import jobs_defined
 from .storage import get_job_userobject
 
@@ -109,12 +115,24 @@ class CacheQueryDB(object):
     """
         This works as a view on a DB which is assumed not to change
         between calls.
+
+        The changes made to the jobs by this process are noted (see
+        jobs/changes.py); refresh() forgets what they concern, or
+        everything if other processes wrote jobs in the meantime.
     """
 
+    # the memoized queries
+    memoized = ['get_job_cache', 'get_job', 'all_jobs', 'job_exists',
+                'up_to_date', 'direct_children', 'direct_parents',
+                'dependencies_up_to_date', 'jobs_defined']
+
     def __init__(self, db):
         self.db = db
+        # the jobs changed since the last refresh() or invalidate()
+        self.changes = watch_job_changes(db)
 
     def invalidate(self):
+        """ Forgets everything. """
         self.get_job_cache.reset()
         self.get_job.reset()
         self.all_jobs.reset()
@@ -124,6 +142,102 @@ class CacheQueryDB(object):
         self.direct_parents.reset()
         self.dependencies_up_to_date.reset()
         self.jobs_defined.reset()
+        if self.changes is not None:
+            self.changes.take()
+
+    def refresh(self):
+        """ Forgets what concerns the jobs changed since the last call
+            (everything if the changes cannot be tracked, or were made
+            by other processes). """
+        if self.changes is None:
+            self.invalidate()
+            return
+        job_ids, defined, elsewhere = self.changes.take()
+        if elsewhere:
+            self.invalidate()
+            return
+        if defined:
+            self.all_jobs.forget()
+        if job_ids:
+            self.invalidate_jobs(job_ids)
+
+    def invalidate_jobs(self, job_ids):
+        """
+            Forgets what was read about the jobs, and the up-to-date
+            status of the jobs that depend on them: the parents and the
+            jobs that they defined, recursively.
+        """
+        job_ids = set(job_ids)
+        # job -> the jobs whose up_to_date() used its status
+        dependents = defaultdict(set)
+        for (job_id,), children in self.direct_children.items():
+            for c in children:
+                dependents[c].add(job_id)
+        for (job_id,), job in self.get_job.items():
+            for d in job.defined_by[1:]:
+                dependents[d].add(job_id)
+
+        affected = set(job_ids)
+        stack = list(job_ids)
+        while stack:
+            for x in dependents.get(stack.pop(), ()):
+                if not x in affected:
+                    affected.add(x)
+                    stack.append(x)
+
+        for job_id in job_ids:
+            self.get_job_cache.forget(job_id)
+            self.get_job.forget(job_id)
+            self.job_exists.forget(job_id)
+            self.direct_children.forget(job_id)
+            self.direct_parents.forget(job_id)
+            self.jobs_defined.forget(job_id)
+        for job_id in affected:
+            self.up_to_date.forget(job_id)
+            self.dependencies_up_to_date.forget(job_id)
+
+    def hit_rates(self):
+        """ Returns a dict query -> (hits, misses) for the memoized
+            queries. """
+        res = {}
+        for name in self.memoized:
+            fn = getattr(self, name)
+            res[name] = fn.hits, fn.misses
+        return res
+
+    def prefetch(self, job_ids):
+        """ Reads in one batch the job and cache records of the jobs
+            that were not read yet. """
+        from .storage import get_job_caches, get_jobs
+
+        todo = [j for j in set(job_ids) if not self.get_job.is_cached(j)]
+        if not todo:
+            return
+        jobs = get_jobs(todo, db=self.db)
+        for job_id in todo:
+            self.job_exists.prime(job_id in jobs, job_id)
+        for job_id, job in jobs.items():
+            self.get_job.prime(job, job_id)
+            self.direct_children.prime(set(job.children), job_id)
+            self.direct_parents.prime(set(job.parents), job_id)
+
+        todo = [j for j in jobs if not self.get_job_cache.is_cached(j)]
+        for job_id, cache in get_job_caches(todo, db=self.db).items():
+            self.get_job_cache.prime(cache, job_id)
+
+    def prefetch_tree(self, jobs):
+        """ Prefetches the jobs and their dependencies, recursively,
+            one level of the tree per batch. """
+        seen = set()
+        level = set(jobs)
+        while level:
+            self.prefetch(level)
+            seen.update(level)
+            below = set()
+            for job_id in level:
+                if self.job_exists(job_id):
+                    below.update(self.direct_children(job_id))
+            level = below - seen
 
     @memoized_reset
     @contract(returns=Cache)
@@ -155,6 +269,9 @@ class CacheQueryDB(object):
     def job_exists(self, job_id):
         from .storage import job_exists
 
+        graph = get_graph_index(self.db)
+        if graph is not None:
+            return graph.job_exists(job_id)
         return job_exists(job_id=job_id, db=self.db)
 
     @memoized_reset
@@ -165,45 +282,35 @@ class CacheQueryDB(object):
 
     @contract(returns='tuple(bool, str, float)')
     def _up_to_date_actual(self, job_id):
+        """
+            Evaluates the jobs below job_id depth-first with an explicit
+            stack, so that long chains of jobs do not exceed the
+            recursion limit. The status of each job is computed once
+            and memoized.
+        """
         with db_error_wrap("_up_to_date_actual()", job_id=job_id):
-            cache = self.get_job_cache(job_id)  # OK
-
-            if cache.state == Cache.NOT_STARTED:
-                return False, 'Not started', cache.timestamp
-
-            if cache.timestamp == Cache.TIMESTAMP_TO_REMAKE:
-                return False, 'Marked invalid', cache.timestamp
-
-            dependencies = self.direct_children(job_id)
-
-            for child in dependencies:
-                child_up, _, child_timestamp = self.up_to_date(child)
-                if not child_up:
-                    return False, 'At least: Dep %r not up to date.' % child, cache.timestamp
-                else:
-                    if child_timestamp > cache.timestamp:
-                        return (
-                            False, 'At least: Dep %r have been updated.' % child, cache.timestamp)
-
-            # plus jobs that defined it
-            defined_by = list(self.get_job(job_id).defined_by)
-            defined_by.remove('root')
-            dependencies.update(defined_by)
-
-            for defby in defined_by:
-                defby_up, _, _ = self.up_to_date(defby)
-                if not defby_up:
-                    return False, 'Definer %r not up to date.' % defby, cache.timestamp
-                # don't check timestamp for definers
-
-            # FIXME BUG if I start (in progress), children get updated,
-            # I still finish the computation instead of starting again
-            if cache.state == Cache.FAILED:
-                return False, 'Failed', cache.timestamp
-
-            assert (cache.state == Cache.DONE)
-
-            return True, '', cache.timestamp
+            memo = self.up_to_date
+            stack = [_UpToDateFrame(self, job_id)]
+            # the jobs in the stack
+            active = set([job_id])
+            while True:
+                frame = stack[-1]
+                needed = frame.step(memo)
+                if needed is not None:
+                    if needed in active:
+                        cycle = [f.job_id for f in stack]
+                        cycle = cycle[cycle.index(needed):] + [needed]
+                        msg = 'The jobs depend on themselves: %s' % cycle
+                        raise CompmakeBug(msg)
+                    active.add(needed)
+                    stack.append(_UpToDateFrame(self, needed))
+                    continue
+                stack.pop()
+                active.remove(frame.job_id)
+                if not stack:
+                    return frame.result
+                memo.misses += 1
+                memo.prime(frame.result, frame.job_id)
 
     @memoized_reset
     def direct_children(self, job_id):
@@ -229,6 +336,10 @@ class CacheQueryDB(object):
     def tree(self, jobs):
         """ More efficient version of tree()
             which is direct_children() recursively. """
+        graph = get_graph_index(self.db)
+        if graph is not None:
+            return list(graph.closure(jobs, 'children'))
+
         stack = []
 
         stack.extend(jobs)
@@ -272,6 +383,7 @@ class CacheQueryDB(object):
                 if A.count % 100 != 0:
                     return
 
+            self.prefetch_tree(jobs)
             while stack:
                 summary()
 
@@ -333,6 +445,89 @@ class CacheQueryDB(object):
         return result
 
 
+class _UpToDateFrame(object):
+    """ The evaluation of up_to_date() for one job, which is suspended
+        when it needs the status of a job that is not memoized yet. """
+
+    __slots__ = ('cq', 'job_id', 'cache', 'dependencies', 'children', 'i',
+                 'defined_by', 'j', 'result')
+
+    def __init__(self, cq, job_id):
+        self.cq = cq
+        self.job_id = job_id
+        self.cache = cache = cq.get_job_cache(job_id)
+        self.result = None
+        if cache.state == Cache.NOT_STARTED:
+            self.result = False, 'Not started', cache.timestamp
+        elif cache.timestamp == Cache.TIMESTAMP_TO_REMAKE:
+            self.result = False, 'Marked invalid', cache.timestamp
+        else:
+            self.dependencies = cq.direct_children(job_id)
+            # the children in the order of the original recursion
+            self.children = list(self.dependencies)
+            self.i = 0
+            self.defined_by = None
+
+    def step(self, memo):
+        """ Continues the evaluation; returns the job whose status is
+            needed, or None when self.result is set. """
+        if self.result is not None:
+            return None
+        cache = self.cache
+        children = self.children
+        while self.i < len(children):
+            child = children[self.i]
+            if not memo.is_cached(child):
+                return child
+            self.i += 1
+            child_up, _, child_timestamp = memo(child)
+            if not child_up:
+                self.result = (False, 'At least: Dep %r not up to date.' %
+                               child, cache.timestamp)
+                return None
+            if (child_timestamp > cache.timestamp and
+                    not same_result(cache, child,
+                                    self.cq.get_job_cache(child))):
+                self.result = (False, 'At least: Dep %r have been updated.' %
+                               child, cache.timestamp)
+                return None
+
+        if self.defined_by is None:
+            # plus jobs that defined it
+            defined_by = list(self.cq.get_job(self.job_id).defined_by)
+            defined_by.remove('root')
+            self.dependencies.update(defined_by)
+            self.defined_by = defined_by
+            self.j = 0
+
+        while self.j < len(self.defined_by):
+            defby = self.defined_by[self.j]
+            if not memo.is_cached(defby):
+                return defby
+            self.j += 1
+            defby_up, _, _ = memo(defby)
+            if not defby_up:
+                self.result = (False, 'Definer %r not up to date.' % defby,
+                               cache.timestamp)
+                return None
+            # don't check timestamp for definers
+
+        if (get_compmake_config('check_code') and
+                code_changed(self.cq.get_job(self.job_id), cache)):
+            self.result = False, 'Code changed', cache.timestamp
+            return None
+
+        # FIXME BUG if I start (in progress), children get updated,
+        # I still finish the computation instead of starting again
+        if cache.state == Cache.FAILED:
+            self.result = False, 'Failed', cache.timestamp
+            return None
+
+        assert (cache.state == Cache.DONE)
+        self.result = True, '', cache.timestamp
+        return None
+
+
 @contextmanager
 def db_error_wrap(what, **args):
     try:
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+    A background thread that does the writes of a worker in order,
+    so that the worker can do something else while a large result
+    is serialized and written.
+"""
+import os
+import sys
+import threading
+
+from future.moves.queue import Queue
+
+__all__ = [
+    'WriteBehind',
+    'get_write_behind',
+]
+
+
+class PendingWrite(object):
+
+    def __init__(self, function, args, kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.done = threading.Event()
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.function(*self.args, **self.kwargs)
+        except BaseException:
+            self.exc_info = sys.exc_info()
+        finally:
+            self.done.set()
+
+    def wait(self):
+        """ Waits until the write is done; raises its exception if any. """
+        self.done.wait()
+        if self.exc_info is not None:
+            e = self.exc_info[1]
+            self.exc_info = None
+            raise e
+
+
+class WriteBehind(object):
+    """
+        Executes the functions submitted in order, in a thread.
+
+        At most maxsize writes can be pending; submit() blocks
+        after that.
+    """
+
+    def __init__(self, maxsize=2):
+        self.queue = Queue(maxsize)
+        self.thread = threading.Thread(target=self._loop,
+                                       name='compmake-write-behind')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _loop(self):
+        while True:
+            pending = self.queue.get()
+            pending.run()
+
+    def submit(self, function, *args, **kwargs):
+        """ Returns a PendingWrite, whose wait() must be called. """
+        pending = PendingWrite(function, args, kwargs)
+        self.queue.put(pending)
+        return pending
+
+
+class Instance(object):
+    # pid -> WriteBehind; threads do not survive a fork
+    pid2writer = {}
+
+
+def get_write_behind():
+    """ Returns the writer for this process. """
+    pid = os.getpid()
+    if not pid in Instance.pid2writer:
+        Instance.pid2writer[pid] = WriteBehind()
+    return Instance.pid2writer[pid]
@@ -21,14 +21,23 @@ from . import details
 from . import details_why
 from . import dump
 from . import event_debugger
+from . import explain
+from . import gc_blobs
+from . import gc_db
 from . import gantt
 from . import graph
 from . import graph_animation_imp
 from . import job_definition_status
 from . import list_jobs_imp
+from . import migrate_layout
+from . import rebuild_manifest
+from . import rebuild_job_index
+from . import rebuild_state_table
 from . import reload_module
 from . import sanity_check
 from . import stats
+from . import storage_stats
+from . import tiers
 
 # Useful for debugging events
 # TODO: mail, html_status
@@ -2,8 +2,8 @@
 from compmake.context import Context
 from compmake.exceptions import CompmakeBug, HostFailed, JobFailed
 from compmake.jobs import result_dict_check
-from compmake.jobs import (get_job_args, job2cachekey, job2jobargskey, 
-    job2key, job2userobjectkey)
+from compmake.jobs import (get_job_args, job2cachekey, job2cachedetailskey,
+    job2jobargskey, job2key, job2userobjectkey, jobs_copied)
 from .logging_imp import disable_logging_if_config
 from compmake.state import get_compmake_config
 from compmake.storage.filesystem import StorageFilesystem
@@ -104,6 +104,9 @@ def transfer_down(db, vol, rdb_db, job_id, new_jobs):
         remote_path = os.path.relpath(fr, rdb_db.basepath)
         #print('down %r->%r' % (remote_path, local_path))
         vol.get_file(remote_path, local_path)
+        db.register_key(key)
+    # the records were written without set_job() and set_job_cache()
+    jobs_copied([job_id] + list(new_jobs), db)
  
  
 def get_keys_to_download(job_id, new_jobs, results=False):
@@ -111,6 +114,7 @@ def get_keys_to_download(job_id, new_jobs, results=False):
     
     # result of the job 
     keys.append(job2cachekey(job_id))
+    keys.append(job2cachedetailskey(job_id))
     
     if results:
         keys.append(job2userobjectkey(job_id))
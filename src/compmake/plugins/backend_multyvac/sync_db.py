@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
-from compmake.jobs.storage import (job2cachekey, job2jobargskey, job2key,
-    job2userobjectkey)
+from compmake.jobs.storage import (job2cachekey, job2cachedetailskey,
+    job2jobargskey, job2key, job2userobjectkey)
 from compmake.jobs.uptodate import CacheQueryDB
 from compmake.storage.filesystem import StorageFilesystem
 
@@ -28,7 +28,7 @@ def synchronize_db_up(context, targets):
     # XXX: not all jobs
     for job_id in jobs:
         resources = [job2jobargskey, job2userobjectkey, 
-                     job2cachekey, job2key]
+                     job2cachekey, job2cachedetailskey, job2key]
         for r in resources:
             key = r(job_id)
             if key in db:
@@ -7,6 +7,7 @@ from multiprocessing import TimeoutError
 from compmake.exceptions import CompmakeBug, HostFailed, JobFailed, JobInterrupted
 from compmake.jobs.manager import AsyncResultInterface
 from compmake.jobs.result_dict import result_dict_raise_if_error
+from compmake.storage import flush_storage_metrics
 from contracts import check_isinstance, indent
 from future.moves.queue import Empty
 
@@ -123,6 +124,9 @@ def pmake_worker(name, job_queue, result_queue, signal_queue, signal_token,
         log('(put)')
 
 
+    # the process exits without running the atexit handlers
+    flush_storage_metrics()
+
     if signal_queue is not None:
         signal_queue.close()
     result_queue.close()
@@ -17,6 +17,9 @@ else:
 def dump(non_empty_job_list, context, directory='.'):
     """ Dumps the result of jobs as pickle files.
 
+        The arrays stored as separate files (see mmap_arrays) are
+        included in the pickle.
+
         Arguments:
             directory='.'   where to dump the files
 
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import json
+
+from compmake.constants import DefaultsToConfig
+from compmake.exceptions import UserError
+from compmake.jobs import plan_make, top_targets
+from compmake.ui import VISUALIZATION, ui_command
+from compmake.utils import duration_compact
+
+
+@ui_command(section=VISUALIZATION)
+def explain(job_list, context, cq, n=DefaultsToConfig('max_parallel_jobs'),
+            format='table'):  # @ReservedAssignment
+    """ Predicts what a make of the jobs would do, and how long it would
+        take with n workers, without running anything.
+
+        Usage:
+
+            explain n=16             # all the targets, 16 workers
+            explain <jobs> n=16      # the given jobs and their dependencies
+            explain format=json      # machine-readable
+
+        The duration of each job is the one of its last run, or the median
+        of the jobs with the same function. The scheduler is simulated
+        with the priorities of the switch "priority". Shown: the total
+        time, the critical path (the longest chain of dependencies: the
+        time with unlimited workers), and the time for n workers and for
+        a few other numbers of workers (powers of 2 up to 2n).
+    """
+    if not format in ['table', 'json']:
+        msg = 'Invalid format %r; use "table" or "json".' % format
+        raise UserError(msg)
+    n = int(n)
+    if n < 1:
+        msg = 'Invalid number of workers %r.' % n
+        raise UserError(msg)
+    job_list = list(job_list)
+    if not job_list:
+        job_list = list(top_targets(db=context.get_compmake_db()))
+
+    plan = plan_make(job_list, cq)
+    total = plan.total()
+    length, path = plan.critical_path()
+    makespan = plan.makespan(n)
+    # powers of 2 up to n, and 2n to show if more workers would help
+    workers_list = [1, n, 2 * n]
+    w = 2
+    while w < n:
+        workers_list.append(w)
+        w *= 2
+    curve = plan.speedup(workers_list)
+
+    if format == 'json':
+        res = dict(jobs=len(plan.jobs), ready=plan.ready,
+                   from_history=plan.from_history, dynamic=plan.dynamic,
+                   workers=n, makespan=makespan, total=total,
+                   critical_path=dict(length=length, jobs=path),
+                   speedup=[dict(workers=a, makespan=b, speedup=c)
+                            for a, b, c in curve])
+        print(json.dumps(res, indent=1, sort_keys=True))
+        return
+
+    if not plan.jobs:
+        print('Nothing to do.')
+        return
+    print('%d jobs to do, %d ready to start.' % (len(plan.jobs), plan.ready))
+    print('Durations from the last run for %d jobs, from the median of '
+          'their function for %d.' % (plan.from_history,
+                                      len(plan.jobs) - plan.from_history))
+    if plan.dynamic:
+        print('%d dynamic jobs: the jobs that they define are included only '
+              'if defined by a previous run.' % len(plan.dynamic))
+    print('Total: %s (%.2f CPU-hours)' % (duration_compact(total),
+                                          total / 3600.0))
+    print('Critical path: %s, %d jobs' % (duration_compact(length),
+                                          len(path)))
+    shown = path if len(path) <= 7 else path[:3] + ['...'] + path[-3:]
+    print('  %s' % ' -> '.join(shown))
+    print('Predicted time with n=%d: %s' % (n, duration_compact(makespan)))
+    print('%8s %12s %8s %11s' % ('workers', 'time', 'speedup', 'efficiency'))
+    for workers, time, speedup in curve:
+        print('%8d %12s %8.2f %10.0f%%' % (workers, duration_compact(time),
+                                          speedup, 100.0 * speedup / workers))
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from compmake.jobs.blobs import gc_blobs as gc_blobs_
+from compmake.ui import COMMANDS_ADVANCED, info, ui_command
+
+
+@ui_command(section=COMMANDS_ADVANCED, alias='gc-blobs', dbchange=True)
+def gc_blobs(context, dry_run=False):
+    """ Deletes the blobs (see the config switch "blobs") that are not
+        used anymore by any job.
+
+        Usage:
+
+            gc-blobs dry_run=1   # only show what would be deleted
+
+        Do not run while another compmake process uses the same DB.
+    """
+    db = context.get_compmake_db()
+    n, nbytes = gc_blobs_(db, dry_run=dry_run)
+    if dry_run:
+        info('Would delete %d blobs (%.1f MB).' % (n, nbytes / 1e6))
+    else:
+        info('Deleted %d blobs (%.1f MB).' % (n, nbytes / 1e6))
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+
+from compmake.jobs.garbage import (delete_garbage, find_garbage,
+                                   garbage_categories)
+from compmake.ui import COMMANDS_ADVANCED, info, ui_command
+
+
+@ui_command(section=COMMANDS_ADVANCED, alias='gc-db', dbchange=True)
+def gc_db(context, dry_run=False, threads=8):
+    """ Deletes the garbage in the DB directory: the temporary files
+        of killed processes (not modified in the last hour, as they
+        might be of another host), the files left by parmake new_process=1,
+        the SGE spool directories, the last parmake log, the records
+        and array files of jobs that do not exist, and the blobs
+        that are not used.
+
+        Usage:
+
+            gc-db dry_run=1   # only show what would be deleted
+
+        Do not run while another compmake process uses the same DB.
+    """
+    db = context.get_compmake_db()
+    garbage = find_garbage(db, threads=threads)
+
+    count = defaultdict(lambda: 0)
+    nbytes = defaultdict(lambda: 0)
+    for g in garbage:
+        count[g.category] += 1
+        nbytes[g.category] += g.nbytes
+    for category in garbage_categories:
+        info('%12s: %6d items, %10.1f MB' % (category, count[category],
+                                              nbytes[category] / 1e6))
+    total = sum(nbytes.values())
+
+    if dry_run:
+        info('Would delete %d items (%.1f MB).' % (len(garbage), total / 1e6))
+    else:
+        delete_garbage(db, garbage, threads=threads)
+        info('Deleted %d items (%.1f MB).' % (len(garbage), total / 1e6))
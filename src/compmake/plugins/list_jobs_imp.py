@@ -5,9 +5,11 @@ from time import time
 
 from compmake.constants import CompmakeConstants
 from compmake.jobs import parse_job_list
-from compmake.jobs.storage import (job_args_sizeof, job_cache_exists,
+from compmake.jobs.storage import (job2cachekey, job2userobjectkey,
+                                   job_args_sizeof, job_cache_exists,
                                    job_cache_sizeof,
                                    job_userobject_exists, job_userobject_sizeof)
+from compmake.storage import contains_many
 from compmake.jobs.syntax.parsing import is_root_job
 from compmake.structures import timing_summary, cache_has_large_overhead, Cache
 from compmake.ui import VISUALIZATION, compmake_colored, ui_command
@@ -138,6 +140,12 @@ def list_jobs(context, job_list, cq, complete_names=False, all_details=False,
 
     tf = TableFormatter(sep="  ")
 
+    db = context.get_compmake_db()
+    cq.prefetch_tree(job_list)
+    keys = [f(job_id) for job_id in job_list
+            for f in [job2cachekey, job2userobjectkey]]
+    present = contains_many(db, keys)
+
     for job_id in job_list:
         tf.row()
 
@@ -189,8 +197,7 @@ def list_jobs(context, job_list, cq, complete_names=False, all_details=False,
             tf.cell(up_reason)
             tf.cell(duration_compact(time() - up_ts))
 
-        db = context.get_compmake_db()
-        sizes = get_sizes(job_id, db=db)
+        sizes = get_sizes(job_id, db=db, present=present)
         size_s = format_size(sizes['total'])
         tf.cell(size_s)
 
@@ -256,20 +263,29 @@ def format_size(nbytes):
 
 
 @contract(returns='dict')
-def get_sizes(job_id, db):
+def get_sizes(job_id, db, present=None):
     """ Returns byte sizes for jobs pieces.
 
         Returns dict with keys 'args','cache','result','total'.
+
+        present: optional set of the keys known to exist.
     """
+    if present is None:
+        cache_exists = job_cache_exists(job_id, db)
+        userobject_exists = job_userobject_exists(job_id, db)
+    else:
+        cache_exists = job2cachekey(job_id) in present
+        userobject_exists = job2userobjectkey(job_id) in present
+
     res = {}
     res['args'] = job_args_sizeof(job_id, db)
 
-    if job_cache_exists(job_id, db):
+    if cache_exists:
         res['cache'] = job_cache_sizeof(job_id, db)
     else:
         res['cache'] = 0
 
-    if job_userobject_exists(job_id, db):
+    if userobject_exists:
         res['result'] = job_userobject_sizeof(job_id, db)
     else:
         res['result'] = 0
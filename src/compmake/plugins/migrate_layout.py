@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from compmake.storage import StorageFilesystem, uncached
+from compmake.ui import COMMANDS_ADVANCED, info, ui_command
+from compmake.exceptions import UserError
+
+
+@ui_command(section=COMMANDS_ADVANCED, alias='migrate-layout', dbchange=True)
+def migrate_layout(context, layout='sharded'):
+    """ Converts the filesystem DB to another directory layout, in place.
+
+        Usage:
+
+            migrate-layout layout=sharded   # files in ab/cd/ subdirectories
+            migrate-layout layout=flat      # all files in one directory
+
+        If interrupted, the DB stays usable; run the command again
+        to resume the migration.
+    """
+    db = uncached(context.get_compmake_db())
+    if not isinstance(db, StorageFilesystem):
+        msg = 'Layouts are only supported by the filesystem DB; got %r.' % db
+        raise UserError(msg)
+    if not layout in StorageFilesystem.layouts:
+        msg = 'Invalid layout %r; known: %s.' % (layout,
+                                                 StorageFilesystem.layouts)
+        raise UserError(msg)
+
+    def progress(i, n):
+        if i % 10000 == 0:
+            info('Done %d/%d files.' % (i, n))
+
+    moved = db.migrate_layout(layout, progress=progress)
+    info('Migrated %d files to layout %r.' % (moved, layout))
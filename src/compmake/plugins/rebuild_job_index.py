@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from compmake.exceptions import UserError
+from compmake.jobs import job_index
+from compmake.ui import COMMANDS_ADVANCED, info, ui_command
+
+
+@ui_command(section=COMMANDS_ADVANCED, alias='rebuild-job-index',
+            dbchange=True)
+def rebuild_job_index(context):
+    """ Recreates the index of the definitions of the jobs from the jobs.
+
+        Use this if the jobs were changed with the switch "job_index" off
+        or by another program. ("check-consistency" reports this case.)
+    """
+    db = context.get_compmake_db()
+    if job_index.get_job_index(db) is None:
+        msg = 'The job index is not used (see the switch "job_index").'
+        raise UserError(msg)
+    n = job_index.rebuild_job_index(db)
+    info('Indexed %d jobs.' % n)
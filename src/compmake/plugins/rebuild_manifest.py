@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from compmake.exceptions import UserError
+from compmake.storage import StorageFilesystem, uncached
+from compmake.ui import COMMANDS_ADVANCED, info, ui_command
+
+
+@ui_command(section=COMMANDS_ADVANCED, alias='rebuild-manifest',
+            dbchange=True)
+def rebuild_manifest(context):
+    """ Recreates the list of keys of the filesystem DB from its files.
+
+        Use this if files were added or removed by hand or by another
+        program, so that the manifest no longer matches the directory.
+        ("check-consistency" reports this case.)
+    """
+    db = uncached(context.get_compmake_db())
+    if not isinstance(db, StorageFilesystem):
+        msg = 'Only the filesystem DB has a manifest; got %r.' % db
+        raise UserError(msg)
+    n = db.rebuild_manifest()
+    info('Found %d keys.' % n)
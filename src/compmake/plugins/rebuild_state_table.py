@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from compmake.exceptions import UserError
+from compmake.jobs import state_table
+from compmake.ui import COMMANDS_ADVANCED, info, ui_command
+
+
+@ui_command(section=COMMANDS_ADVANCED, alias='rebuild-state-table',
+            dbchange=True)
+def rebuild_state_table(context):
+    """ Recreates the table of the states of the jobs from the jobs and
+        their caches.
+
+        Use this if the DB was changed by another program.
+        ("check-consistency" reports this case.)
+    """
+    db = context.get_compmake_db()
+    if state_table.get_state_table(db) is None:
+        msg = 'The state table is not used (see the switch "state_table").'
+        raise UserError(msg)
+    n = state_table.rebuild_state_table(db)
+    info('Wrote the states of %d jobs.' % n)
@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-
 """ The actual interface of some commands in commands.py """
-from ..jobs import (children, direct_children, direct_parents, parents,
-                    parse_job_list)
+from ..jobs import (check_job_index, check_state_table, children,
+                    direct_children, direct_parents, parents, parse_job_list)
 from ..ui import COMMANDS_ADVANCED, ui_command
 from compmake.exceptions import CompmakeBug
 from compmake.ui.visualization import error
 from contracts import contract
 from compmake.jobs.storage import get_job, job_exists, all_jobs
+from compmake.storage import StorageFilesystem, uncached
 
 
 @ui_command(section=COMMANDS_ADVANCED, alias='check-consistency')
@@ -25,6 +26,17 @@ def check_consistency(args, context, cq,
     job_list = list(job_list)
     #print('Checking consistency of %d jobs.' % len(job_list))
     errors = {}
+    if not args and isinstance(uncached(db), StorageFilesystem):
+        es = check_manifest(uncached(db))
+        if es:
+            errors['(manifest)'] = es + ['Use "rebuild-manifest" to fix.']
+    if not args:
+        es = check_job_index(db)
+        if es:
+            errors['(job index)'] = es + ['Use "rebuild-job-index" to fix.']
+        es = check_state_table(db)
+        if es:
+            errors['(state table)'] = es + ['Use "rebuild-state-table" to fix.']
     for job_id in job_list:
         try:
             ok, reasons = check_job(job_id, context)
@@ -45,6 +57,20 @@ def check_consistency(args, context, cq,
 
     return 0
 
+@contract(returns='list(str)')
+def check_manifest(db):
+    """ Checks that the manifest of a StorageFilesystem lists exactly
+        the keys found on disk. """
+    on_disk = set(db.keys0())
+    listed = set(db.keys())
+    errors = []
+    for key in sorted(on_disk - listed):
+        errors.append('Key %r is on disk but not in the manifest.' % key)
+    for key in sorted(listed - on_disk):
+        errors.append('Key %r is in the manifest but not on disk.' % key)
+    return errors
+
+
 @contract(returns='tuple(bool, list(str))')
 def check_job(job_id, context):
     db = context.get_compmake_db()
@@ -4,7 +4,7 @@ from collections import defaultdict
 
 from compmake.constants import CompmakeConstants
 
-from ..jobs import get_job, get_job_cache, parse_job_list
+from ..jobs import count_states_by_command, parse_job_list
 from ..structures import Cache
 from ..ui import VISUALIZATION, compmake_colored, ui_command
 from ..utils import pad_to_screen
@@ -42,23 +42,15 @@ def display_stats(job_list, context):
     function2state2count = {}
     total = 0
 
-    for job_id in job_list:
-
-        cache = get_job_cache(job_id, db=db)
-        states2count[cache.state] += 1
-        total += 1
-
-        function_id = get_job(job_id, db=db).command_desc
-        # initialize record if not present
-        if not function_id in function2state2count:
-            function2state2count[function_id] = \
-                dict(list(map(lambda x: (x, 0), states_order)) + [('all', 0)])
-        # update
-        function2state2count[function_id][cache.state] += 1
-        function2state2count[function_id]['all'] += 1
-
-        if total == 100:  # XXX: use standard method
-            print("Loading a large number of jobs...\r")
+    counts = count_states_by_command(job_list, db)
+    for function_id, state2count in counts.items():
+        function2state2count[function_id] = \
+            dict(list(map(lambda x: (x, 0), states_order)) + [('all', 0)])
+        for state, num in state2count.items():
+            function2state2count[function_id][state] += num
+            function2state2count[function_id]['all'] += num
+            states2count[state] += num
+            total += num
 
     if total == 0:
         print(pad_to_screen('No jobs found.'))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import json
+
+from compmake.exceptions import UserError
+from compmake.storage import (MemoryCache, histogram_quantile,
+                              merge_storage_metrics, read_storage_metrics,
+                              reset_storage_metrics)
+from compmake.ui import VISUALIZATION, info, ui_command
+
+
+@ui_command(section=VISUALIZATION, alias='storage-stats')
+def storage_stats(context, format='table', reset=False):  # @ReservedAssignment
+    """ Shows the operations done on the DB, summed over all the processes
+        since the last reset, by operation and key prefix.
+
+        Usage:
+
+            storage-stats                # as a table
+            storage-stats format=json    # machine-readable
+            storage-stats reset=1        # forget the counters
+
+        The latency percentiles are upper bounds (the histograms have
+        buckets 1, 3, 10, 30, ... microseconds). Counted only if the
+        config switch "storage_metrics" is on.
+    """
+    if not format in ['table', 'json']:
+        msg = 'Invalid format %r; use "table" or "json".' % format
+        raise UserError(msg)
+    db = context.get_compmake_db()
+
+    if reset:
+        reset_storage_metrics(db.basepath)
+        info('Counters deleted.')
+        return
+
+    datas = read_storage_metrics(db.basepath)
+    merged = merge_storage_metrics(datas)
+
+    if format == 'json':
+        ops = []
+        for (op, prefix), x in sorted(merged.items()):
+            x = dict(x)
+            x.update(op=op, prefix=prefix)
+            ops.append(x)
+        res = dict(processes=datas, total=ops)
+        if isinstance(db, MemoryCache):
+            res['memory_cache'] = db.stats()
+        print(json.dumps(res, indent=1, sort_keys=True))
+        return
+
+    if not merged:
+        print('No storage operations recorded.')
+        return
+
+    def ms(seconds):
+        if seconds is None:
+            return '>%s' % ms(10.0)
+        return '%.2f' % (seconds * 1000)
+
+    print('Storage operations of %d processes:' % len(datas))
+    fmt = '%-14s %-13s %9s %9s %10s %9s %9s %9s %9s'
+    print(fmt % ('op', 'prefix', 'calls', 'keys', 'MB', 'total s',
+                 'mean ms', 'p50 ms', 'p99 ms'))
+    for (op, prefix), x in sorted(merged.items()):
+        print(fmt % (op, prefix, x['calls'], x['keys'],
+                     '%.1f' % (x['bytes'] / 1e6), '%.2f' % x['seconds'],
+                     ms(x['seconds'] / x['calls']),
+                     ms(histogram_quantile(x['histogram'], 0.5)),
+                     ms(histogram_quantile(x['histogram'], 0.99))))
+    total = sum(x['seconds'] for x in merged.values())
+    print('Total time in the storage: %.2f s' % total)
+
+    if isinstance(db, MemoryCache):
+        s = db.stats()
+        print('Memory cache: %d hits, %d misses, %d evictions, '
+              '%d entries (%.1f MB).' % (s['hits'], s['misses'],
+                                         s['evictions'], s['entries'],
+                                         s['nbytes'] / 1e6))
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import os
+
+from compmake.exceptions import UserError
+from compmake.state import get_compmake_config
+from compmake.storage import StorageFilesystem, uncached
+from compmake.ui import COMMANDS_ADVANCED, VISUALIZATION, info, ui_command
+
+
+def get_filesystem_db(context):
+    db = uncached(context.get_compmake_db())
+    if not isinstance(db, StorageFilesystem):
+        msg = 'Tiers are only supported by the filesystem DB; got %r.' % db
+        raise UserError(msg)
+    return db
+
+
+@ui_command(section=VISUALIZATION, alias='tier-status')
+def tier_status(context):
+    """ Shows the number of keys and bytes in the DB directory ("hot")
+        and in the cold directory (see "tier-demote"). """
+    db = get_filesystem_db(context)
+    stats = db.tier_stats()
+    for tier in ['hot', 'cold']:
+        n, nbytes = stats[tier]
+        info('%4s: %8d keys %10.1f MB' % (tier, n, nbytes / 1e6))
+    if db.cold_dirname is not None:
+        info('cold directory: %s' % db.cold_dirname)
+
+
+@ui_command(section=COMMANDS_ADVANCED, alias='tier-demote', dbchange=True)
+def tier_demote(context, days=None, min_size=None):
+    """ Moves to the directory given by the switch "cold_dir" the results
+        (and blobs) that are large and that were not read for a while.
+
+        Usage:
+
+            tier-demote                        # use cold_after_days and
+                                               #  cold_min_size
+            tier-demote days=7 min_size=1000000
+
+        The results stay readable; see also "tier-status".
+    """
+    db = get_filesystem_db(context)
+    cold_dir = get_compmake_config('cold_dir')
+    if not cold_dir:
+        msg = 'Set the switch "cold_dir" first.'
+        raise UserError(msg)
+    if days is None:
+        days = get_compmake_config('cold_after_days')
+    if min_size is None:
+        min_size = get_compmake_config('cold_min_size')
+
+    def progress(i, n):
+        if i % 1000 == 0:
+            info('Moved %d/%d files.' % (i, n))
+
+    n, nbytes = db.demote(os.path.expanduser(cold_dir),
+                          min_size=int(min_size),
+                          min_age=float(days) * 24 * 3600,
+                          progress=progress)
+    info('Moved %d results (%.1f MB) to %s.' % (n, nbytes / 1e6,
+                                                db.cold_dirname))
@@ -14,7 +14,9 @@ from ..config import config_populate_optparser
 from ..context import Context
 from ..exceptions import CommandFailed, CompmakeBug, MakeFailed, UserError
 from ..jobs import all_jobs
-from ..storage import StorageFilesystem
+from ..storage import (StorageFilesystem, detect_storage_engine,
+                       storage_engines)
+from ..storage.filesystem import detect_compression
 from ..ui import interpret_commands_wrap, info
 from ..utils import setproctitle
 
@@ -114,6 +116,11 @@ def compmake_main(args):
     parser.add_option('--nosysexit', default=False, action='store_true',
                       help='Does not sys.exit(ret); useful for debugging.')
 
+    parser.add_option('--engine', default=None,
+                      help='Storage engine (%s); by default it is detected '
+                           'from the contents of the DB directory.' %
+                           ", ".join(sorted(storage_engines)))
+
     config_populate_optparser(parser)
 
     (options, args) = parser.parse_args(args)
@@ -145,7 +152,7 @@ def compmake_main(args):
         if os.path.exists(child):
             one_arg = child
 
-        context = load_existing_db(one_arg)
+        context = load_existing_db(one_arg, engine=options.engine)
         # If the context was custom we load it
         if 'context' in context.compmake_db:
             context = context.compmake_db['context']
@@ -229,19 +236,23 @@ def write_atomic(filename, contents):
 
 
 @contract(returns=Context)
-def load_existing_db(dirname):
+def load_existing_db(dirname, engine=None):
     assert os.path.isdir(dirname)
     info('Loading existing jobs DB %r.' % dirname)
-    # check if it is compressed
-    files = os.listdir(dirname)
-    for one in files:
-        if '.gz' in one:
-            compress = True
-            break
-    else:
-        compress = False
+    if engine is None:
+        engine = detect_storage_engine(dirname)
 
-    db = StorageFilesystem(dirname, compress=compress)
+    if not engine in storage_engines:
+        msg = 'Unknown storage engine %r; known: %s.' % (
+            engine, sorted(storage_engines))
+        raise UserError(msg)
+
+    if engine == 'filesystem':
+        # check if it is compressed; the layout is read by StorageFilesystem
+        compress = detect_compression(dirname)
+        db = StorageFilesystem(dirname, compress=compress)
+    else:
+        db = storage_engines[engine](dirname, compress=True)
     context = Context(db=db)
     jobs = list(all_jobs(db=db))
     # logger.info('Found %d existing jobs.' % len(jobs))
@@ -1,4 +1,9 @@
 # -*- coding: utf-8 -*-
 from .filesystem import StorageFilesystem
-from .memorycache import MemoryCache
+from .sqlite import StorageSQLite
+from .memorycache import MemoryCache, uncached
+from .engines import *
 
+from .atomic import *
+from .batch import *
+from .metrics import *
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+    Read-modify-write of one key, atomic with respect to the other
+    processes doing the same on the same key.
+
+    Engines can implement atomic_update(key, function): the filesystem
+    engine holds an fcntl lock while updating, the SQLite engine uses
+    a transaction. For other engines the update is not atomic.
+"""
+
+__all__ = [
+    'atomic_update',
+]
+
+
+def atomic_update(db, key, function):
+    """
+        Sets db[key] = function(db[key]) and returns the new value.
+        The key must exist.
+
+        function receives a fresh copy of the value, which it can modify
+        in place and return. It might be called while a lock is held,
+        so it should be quick and it should not access the DB.
+    """
+    if hasattr(db, 'atomic_update'):
+        return db.atomic_update(key, function)
+    value = function(db[key])
+    db[key] = value
+    return value
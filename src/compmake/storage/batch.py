@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+    Operations on many keys at once.
+
+    Engines can implement get_many(), set_many(), contains_many(),
+    delete_many() to do these efficiently; these functions use them
+    if available, and otherwise do one key at a time.
+"""
+
+__all__ = [
+    'get_many',
+    'set_many',
+    'contains_many',
+    'delete_many',
+]
+
+
+def get_many(db, keys):
+    """ Returns a dict key -> value for the keys that exist. """
+    keys = list(keys)
+    if hasattr(db, 'get_many'):
+        return db.get_many(keys)
+    res = {}
+    for key in keys:
+        if key in db:
+            res[key] = db[key]
+    return res
+
+
+def set_many(db, items):
+    """ Writes all the (key, value) pairs in the dict or sequence. """
+    if isinstance(items, dict):
+        items = list(items.items())
+    else:
+        items = list(items)
+    if hasattr(db, 'set_many'):
+        return db.set_many(items)
+    for key, value in items:
+        db[key] = value
+
+
+def contains_many(db, keys):
+    """ Returns the set of the given keys that exist. """
+    keys = list(keys)
+    if hasattr(db, 'contains_many'):
+        return db.contains_many(keys)
+    return set(key for key in keys if key in db)
+
+
+def delete_many(db, keys):
+    """ Deletes the keys; the ones that do not exist are ignored. """
+    keys = list(keys)
+    if hasattr(db, 'delete_many'):
+        return db.delete_many(keys)
+    for key in keys:
+        if key in db:
+            del db[key]
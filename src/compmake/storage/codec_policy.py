@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from compmake.state import get_compmake_config
+
+__all__ = [
+    'codec_for_key',
+]
+
+# key prefix -> config switch with the codec to use
+prefix2codec_switch = [
+    ('cm-job-', 'codec_job'),
+    ('cm-cache-', 'codec_cache'),
+    ('cm-args-', 'codec_args'),
+    ('cm-res-', 'codec_res'),
+]
+
+
+def codec_for_key(key, codecs=None):
+    """
+        Returns the codec spec (e.g. "zstd:3") to use for writing the key,
+        or None if the storage should use its default format.
+
+        codecs: optional dict prefix -> codec spec that overrides
+                the configuration.
+    """
+    for prefix, switch in prefix2codec_switch:
+        if key.startswith(prefix):
+            if codecs is not None and prefix in codecs:
+                spec = codecs[prefix]
+            else:
+                spec = get_compmake_config(switch)
+            break
+    else:
+        return None
+
+    if spec == 'default':
+        return None
+    return spec
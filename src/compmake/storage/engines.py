@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import os
+
+from compmake.exceptions import UserError
+
+from .filesystem import StorageFilesystem
+from .sqlite import StorageSQLite
+
+__all__ = [
+    'storage_engines',
+    'open_storage',
+    'detect_storage_engine',
+]
+
+# name -> class; all of these take (basepath, compress)
+storage_engines = {
+    'filesystem': StorageFilesystem,
+    'sqlite': StorageSQLite,
+}
+
+
+def open_storage(spec, compress=True, engine=None):
+    """
+        Opens a storage given a string. The engine can be given
+        as a prefix, as in "sqlite:out-dir"; otherwise it is detected
+        from the existing contents of the directory, and defaults
+        to the filesystem engine.
+    """
+    for name in storage_engines:
+        if spec.startswith(name + ':'):
+            if engine is not None and engine != name:
+                msg = 'Conflicting engines %r and %r for %r.' % (engine, name,
+                                                                  spec)
+                raise UserError(msg)
+            engine = name
+            spec = spec[len(name) + 1:]
+            break
+
+    if engine is None:
+        engine = detect_storage_engine(spec)
+
+    if not engine in storage_engines:
+        msg = 'Unknown storage engine %r; known: %s.' % (
+            engine, sorted(storage_engines))
+        raise UserError(msg)
+
+    return storage_engines[engine](spec, compress=compress)
+
+
+def detect_storage_engine(dirname):
+    """ Returns the name of the engine used by an existing DB directory
+        ('filesystem' if the directory does not exist). """
+    sqlite_file = os.path.join(dirname, StorageSQLite.db_filename)
+    if os.path.exists(sqlite_file):
+        return 'sqlite'
+    return 'filesystem'
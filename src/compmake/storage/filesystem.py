@@ -1,22 +1,27 @@
 # -*- coding: utf-8 -*-
+from contextlib import contextmanager
+import fcntl
+import hashlib
 import os
+import shutil
 import stat
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from os.path import basename
+from time import time
 
 from compmake import logger
-from compmake.exceptions import CompmakeBug, SerializationError
+from compmake.exceptions import CompmakeBug, SerializationError, UserError
+from compmake.state import get_compmake_config
 from compmake.utils import (find_pickling_error, safe_pickle_dump,
                             safe_pickle_load)
-from compmake.utils.safe_write import write_data_to_file
+from compmake.utils.filesystem_utils import make_sure_dir_exists
+from compmake.utils.safe_write import safe_write, write_data_to_file
 
-if True:
-    track_time = lambda x: x
-else:
-    from ..utils import TimeTrack
-
-    track_time = TimeTrack.decorator
+from .codec_policy import codec_for_key
+from .manifest import KeyManifest
+from .metrics import tracked
 
 trace_queries = False
 
@@ -26,50 +31,177 @@ __all__ = [
 
 
 class StorageFilesystem(object):
-
-    def __init__(self, basepath, compress=False):
+    """
+        Stores each key as a pickle file.
+
+        layout: 'flat' puts all files in ``basepath``;
+                'sharded' puts them in ``basepath/ab/cd/``, where ``abcd``
+                are the first characters of the hash of the key.
+                If None, the layout recorded in the DB is used.
+
+        codecs: optional dict key prefix -> codec spec (e.g.
+                {'cm-res-': 'zstd:3'}); by default the codecs are given
+                by the configuration switches codec_job, codec_cache,
+                codec_args, codec_res. Files record their codec,
+                so they can be read whatever the current setting.
+
+        The large results that are not read for a while can be moved
+        to a "cold" directory (see demote()), for example on a larger
+        and slower disk. They are read from there transparently and,
+        if the switch cold_promote is true, moved back when read.
+        The same goes for the blobs (see compmake.jobs.blobs). The records
+        of jobs and caches always stay here, and so do the arrays written
+        as ".npy" files, which are memory-mapped from their path.
+    """
+
+    layouts = ['flat', 'sharded']
+
+    # name of the file recording the layout
+    layout_filename = '.compmake-layout'
+
+    # name of the file with the list of keys (see KeyManifest)
+    manifest_filename = '.compmake-manifest'
+
+    # name of the file recording the cold directory
+    cold_filename = '.compmake-cold'
+
+    # the keys that can be moved to the cold directory
+    cold_prefixes = ('cm-res-', 'cm-blob-')
+
+    # directory with the lock files used by atomic_update();
+    # keys are spread over lock_stripes files by hash
+    locks_dirname = 'locks'
+    lock_stripes = 256
+
+    # threads used by get_many() and set_many(), for at least
+    # batch_min keys
+    batch_threads = 8
+    batch_min = 4
+
+    def __init__(self, basepath, compress=False, layout=None, codecs=None):
         self.basepath = os.path.realpath(basepath)
+        self.codecs = codecs
+        self._pool = None
+        self._pool_pid = None
         self.checked_existence = False
+
+        self.layout, self.layout_previous = self._init_layout(layout)
+        # read again only when a key is not found (see _missing())
+        self.cold_dirname = read_cold_dirname(self.basepath)
+
         if compress:
             self.file_extension = '.pickle.gz'
-            others = list(self.keys0('.pickle'))
+            other_extension = '.pickle'
         else:
             self.file_extension = '.pickle'
-            others = list(self.keys0('.pickle.gz'))
-        if others:
-            msg = 'Extension is %s but found %s files with other extension.' % (self.file_extension, len(others))
-            raise Exception(msg)
-
-
+            other_extension = '.pickle.gz'
+
+        filename = os.path.join(self.basepath, self.manifest_filename)
+        self.manifest = KeyManifest(filename)
+        if not self.manifest.exists():
+            # New DB, or created by a version without manifest:
+            # this is the only time we need to list the directory.
+            others = list(self.keys0(other_extension))
+            if others:
+                msg = 'Extension is %s but found %s files with other extension.' % (self.file_extension, len(others))
+                raise Exception(msg)
+            self.rebuild_manifest()
 
         # create a bunch of files that contain shortcuts
         create_scripts(self.basepath)
 
+    def _init_layout(self, layout):
+        """ Returns the pair (layout, previous layout), where the
+            second is not None if a migration is in progress. """
+        if layout is not None and not layout in self.layouts:
+            msg = 'Invalid layout %r; known: %s.' % (layout, self.layouts)
+            raise ValueError(msg)
+        recorded = read_layout(self.basepath)
+        if recorded is None:
+            if layout is None or layout == 'flat':
+                return 'flat', None
+            # new sharded DB; make sure we are not hiding old files
+            if os.path.exists(self.basepath) and has_flat_files(self.basepath):
+                msg = ('Asked for layout %r but the DB %r contains files '
+                       'in the flat layout. Use "migrate-layout".' %
+                       (layout, self.basepath))
+                raise ValueError(msg)
+            write_layout(self.basepath, layout)
+            return layout, None
+
+        current, previous = recorded
+        if layout is not None and (layout != current or previous is not None):
+            msg = ('Asked for layout %r but the DB %r uses %r. '
+                   'Use "migrate-layout".' % (layout, self.basepath,
+                                              format_layout(*recorded)))
+            raise ValueError(msg)
+        return current, previous
+
     def __repr__(self):
-        return "FilesystemDB(%r;%s)" % (self.basepath, self.file_extension)
+        return "FilesystemDB(%r;%s;%s)" % (self.basepath, self.file_extension,
+                                           self.layout)
+
+    def __getstate__(self):
+        # threads cannot be pickled; the pool is recreated on demand
+        state = dict(self.__dict__)
+        state.update(_pool=None, _pool_pid=None)
+        return state
 
-    @track_time
     def sizeof(self, key):
-        filename = self.filename_for_key(key)
-        statinfo = os.stat(filename)
-        return statinfo.st_size
+        with tracked(self.basepath, 'sizeof', key):
+            filename = self.existing_filename_for_key(key)
+            statinfo = os.stat(filename)
+            return statinfo.st_size
+
+    def key_stat(self, key):
+        """ Returns None if the key does not exist, otherwise a pair
+            (version, size), where version changes every time the key
+            is written. Used by MemoryCache. """
+        filename = self.existing_filename_for_key(key)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        # files are replaced by rename(), so the inode changes
+        return (st.st_ino, st.st_mtime_ns, st.st_size), st.st_size
 
-    @track_time
     def __getitem__(self, key):
         if trace_queries:
             logger.debug('R %s' % str(key))
 
         self.check_existence()
 
-        filename = self.filename_for_key(key)
-
-        if not os.path.exists(filename):
-            msg = 'Could not find key %r.' % key
-            msg += '\n file: %s' % filename
-            raise CompmakeBug(msg)
-
+        with tracked(self.basepath, 'get', key) as op:
+            filename = self.existing_filename_for_key(key)
+            try:
+                op.nbytes = os.stat(filename).st_size
+                value = self._load(key, filename)
+            except FileNotFoundError:
+                # moved to the other tier by another process
+                filename = self._missing(key)
+                try:
+                    op.nbytes = os.stat(filename).st_size
+                    value = self._load(key, filename)
+                except FileNotFoundError:
+                    msg = 'Could not find key %r.' % key
+                    msg += '\n file: %s' % filename
+                    raise CompmakeBug(msg)
+
+        if (self.cold_dirname is not None and
+                filename.startswith(self.cold_dirname + os.sep) and
+                get_compmake_config('cold_promote')):
+            try:
+                self._move(filename, self.filename_for_key(key))
+            except (IOError, OSError):
+                # promoted by another process in the meantime
+                pass
+        return value
+
+    def _load(self, key, filename):
         try:
             return safe_pickle_load(filename)
+        except FileNotFoundError:
+            raise
         except Exception as e:
             msg = ("Could not unpickle data for key %r. \n file: %s" %
                    (key, filename))
@@ -85,19 +217,30 @@ class StorageFilesystem(object):
                 # logger.info('Creating filesystem db %r' % self.basepath)
                 os.makedirs(self.basepath)
 
-    @track_time
     def __setitem__(self, key, value):  # @ReservedAssignment
         if trace_queries:
             logger.debug('W %s' % str(key))
 
         self.check_existence()
 
+        with tracked(self.basepath, 'set', key) as op:
+            op.nbytes = self._write(key, value)
+
+    def _write(self, key, value):
+        """ Returns the size of the file written. """
         filename = self.filename_for_key(key)
+        existed = os.path.exists(self.existing_filename_for_key(key))
 
         try:
-            safe_pickle_dump(value, filename)
-            assert os.path.exists(filename)
-        except KeyboardInterrupt:
+            safe_pickle_dump(value, filename,
+                             codec=codec_for_key(key, self.codecs))
+            nbytes = os.stat(filename).st_size
+            if self.layout_previous is not None:
+                # do not leave a stale copy behind during a migration
+                old = self.filename_for_key(key, layout=self.layout_previous)
+                if os.path.exists(old):
+                    os.unlink(old)
+        except (KeyboardInterrupt, UserError):
             raise
         except BaseException as e:
             msg = ('Cannot set key %s: cannot pickle object '
@@ -108,44 +251,166 @@ class StorageFilesystem(object):
             logger.error(emsg)
             raise SerializationError(msg + '\n' + emsg)
 
-    @track_time
+        if key.startswith(self.cold_prefixes):
+            # do not leave the old value in the cold directory
+            cold = self.cold_filename_for_key(key)
+            if cold is not None and os.path.exists(cold):
+                os.unlink(cold)
+
+        if not existed:
+            self.manifest.added(key)
+        return nbytes
+
+    def atomic_update(self, key, function):
+        """ Sets self[key] = function(self[key]) holding a lock
+            that other processes updating the same key respect.
+            Readers do not take the lock: files are replaced by rename(),
+            so they see either the old or the new value. """
+        with self._key_lock(key):
+            value = function(self[key])
+            self[key] = value
+        return value
+
+    @contextmanager
+    def _key_lock(self, key):
+        h = hashlib.md5(key.encode('utf-8')).hexdigest()
+        stripe = int(h[:8], 16) % self.lock_stripes
+        filename = os.path.join(self.basepath, self.locks_dirname,
+                                '%03d.lock' % stripe)
+        make_sure_dir_exists(filename)
+        with open(filename, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
     def __delitem__(self, key):
-        filename = self.filename_for_key(key)
-        if not os.path.exists(filename):
-            msg = 'I expected path %s to exist before deleting' % filename
-            raise ValueError(msg)
-        os.remove(filename)
+        with tracked(self.basepath, 'delete', key):
+            filename = self.existing_filename_for_key(key)
+            if not os.path.exists(filename):
+                filename = self._missing(key)
+            if not os.path.exists(filename):
+                msg = 'I expected path %s to exist before deleting' % filename
+                raise ValueError(msg)
+            os.remove(filename)
+            self.manifest.removed(key)
 
-    @track_time
     def __contains__(self, key):
         if trace_queries:
             logger.debug('? %s' % str(key))
 
-        filename = self.filename_for_key(key)
-        ex = os.path.exists(filename)
+        with tracked(self.basepath, 'contains', key):
+            filename = self.existing_filename_for_key(key)
+            ex = os.path.exists(filename)
 
         # logger.debug('? %s %s %s' % (str(key), filename, ex))
         return ex
 
-    @track_time
-    def keys0(self, extension=None):
+    def layouts_to_read(self):
+        """ The layouts where keys can be found. """
+        if self.layout_previous is None:
+            return [self.layout]
+        else:
+            return [self.layout, self.layout_previous]
+
+    def keys0(self, extension=None, layout=None):
         if extension is None:
             extension = self.file_extension
-        filename = self.filename_for_key('*', extension)
-        for x in glob(filename):
-            # b = splitext(basename(x))[0]
-            b = basename(x.replace(extension, ''))
-            key = self.basename2key(b)
-            yield key
-
-    @track_time
+        if layout is None:
+            layouts = self.layouts_to_read()
+        else:
+            layouts = [layout]
+        dirs = [(self.basepath, one) for one in layouts]
+        if layout is None and self.cold_dirname is not None:
+            dirs.append((self.cold_dirname, 'sharded'))
+        for dirname, one in dirs:
+            pattern = os.path.join(dirname, layout_glob[one],
+                                   '*' + extension)
+            for x in glob(pattern):
+                # b = splitext(basename(x))[0]
+                b = basename(x.replace(extension, ''))
+                key = self.basename2key(b)
+                yield key
+
     def keys(self):
-        # slow process
-        found = sorted(list(self.keys0()))
-        return found
+        # read from the manifest; see keys0() for the slow way
+        with tracked(self.basepath, 'keys', ''):
+            return sorted(self.manifest.get_keys())
+
+    def keys_with_prefix(self, prefix):
+        """ Returns the sorted list of keys starting with prefix. """
+        with tracked(self.basepath, 'keys', prefix):
+            keys = self.manifest.get_keys()
+            return sorted(k for k in keys if k.startswith(prefix))
+
+    def _map(self, function, items):
+        """ Returns [function(x) for x in items], using threads. """
+        items = list(items)
+        if len(items) < self.batch_min:
+            return [function(x) for x in items]
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=self.batch_threads)
+            self._pool_pid = os.getpid()
+        return list(self._pool.map(function, items))
+
+    def get_many(self, keys):
+        """ Returns a dict key -> value for the keys that exist;
+            the files are read in parallel. """
+        present = self.contains_many(keys)
+        keys = [k for k in keys if k in present]
+        missing = object()
+
+        def get(key):
+            # might have been deleted by somebody else in the meantime
+            if not os.path.exists(self.existing_filename_for_key(key)):
+                return missing
+            return self[key]
+
+        values = self._map(get, keys)
+        return dict((k, v) for k, v in zip(keys, values) if v is not missing)
+
+    def set_many(self, items):
+        """ Writes the (key, value) pairs in parallel. """
+        self._map(lambda kv: self.__setitem__(kv[0], kv[1]), items)
+
+    def contains_many(self, keys):
+        """ Returns the set of the given keys that exist, as recorded
+            in the manifest. """
+        keys = list(keys)
+        with tracked(self.basepath, 'contains_many', keys=keys):
+            existing = self.manifest.get_keys()
+            return set(k for k in keys if k in existing)
+
+    def delete_many(self, keys):
+        """ Deletes the keys that exist. """
+        keys = list(keys)
+        with tracked(self.basepath, 'delete_many', keys=keys):
+            deleted = []
+            for key in self.contains_many(keys):
+                try:
+                    os.remove(self.existing_filename_for_key(key))
+                except OSError:
+                    if os.path.exists(self.existing_filename_for_key(key)):
+                        raise
+                    continue
+                deleted.append(key)
+            self.manifest.removed_many(deleted)
+
+    def register_key(self, key):
+        """ To be called after the file for key was written
+            without using __setitem__(). """
+        self.manifest.added(key)
+
+    def rebuild_manifest(self):
+        """ Recreates the manifest from the files in the directory.
+            Returns the number of keys found. """
+        keys = set(self.keys0())
+        self.manifest.write(keys)
+        return len(keys)
 
     def reopen_after_fork(self):
-        pass
+        self._pool = None
 
     dangerous_chars = {
         '/': 'CMSLASH',
@@ -165,12 +430,255 @@ class StorageFilesystem(object):
             key = key.replace(replacement, char)
         return key
 
-    def filename_for_key(self, key, extension=None):
+    def filename_for_key(self, key, extension=None, layout=None):
         """ Returns the pickle storage filename corresponding to the job id """
         if extension is None:
             extension = self.file_extension
+        if layout is None:
+            layout = self.layout
         f = self.key2basename(key) + extension
-        return os.path.join(self.basepath, f)
+        if layout == 'sharded':
+            h = hashlib.md5(key.encode('utf-8')).hexdigest()
+            return os.path.join(self.basepath, h[0:2], h[2:4], f)
+        else:
+            return os.path.join(self.basepath, f)
+
+    def existing_filename_for_key(self, key):
+        """ Like filename_for_key(), but during a migration it returns
+            the old location if the key was not moved yet, and it returns
+            the file in the cold directory if the key was moved there. """
+        filename = self.filename_for_key(key)
+        if self.layout_previous is not None and not os.path.exists(filename):
+            old = self.filename_for_key(key, layout=self.layout_previous)
+            if os.path.exists(old):
+                return old
+        if key.startswith(self.cold_prefixes) and not os.path.exists(filename):
+            cold = self.cold_filename_for_key(key)
+            if cold is not None and os.path.exists(cold):
+                return cold
+        return filename
+
+    def _missing(self, key):
+        """ Called when the file of a key that should exist is not found:
+            another process might have moved it, or started using a cold
+            directory. Returns the filename to try again. """
+        if self.cold_dirname is None:
+            self.cold_dirname = read_cold_dirname(self.basepath)
+        return self.existing_filename_for_key(key)
+
+    def cold_filename_for_key(self, key):
+        """ The file of the key in the cold directory, or None if there
+            is no cold directory. The cold directory always uses the
+            sharded layout. """
+        if self.cold_dirname is None:
+            return None
+        filename = self.filename_for_key(key, layout='sharded')
+        return os.path.join(self.cold_dirname,
+                            os.path.relpath(filename, self.basepath))
+
+    def _move(self, src, dst):
+        """ Moves a file, possibly to another filesystem, so that
+            at any time one of the two exists. """
+        tmp = '%s.tmp.%s' % (dst, os.getpid())
+        make_sure_dir_exists(dst)
+        try:
+            shutil.copyfile(src, tmp)
+            shutil.copystat(src, tmp)
+            os.rename(tmp, dst)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        try:
+            os.unlink(src)
+        except FileNotFoundError:  # moved by another process too
+            pass
+
+    def demote(self, cold_dirname, min_size, min_age, progress=None):
+        """
+            Moves to cold_dirname the results and blobs of at least
+            min_size bytes that were not read in the last min_age seconds
+            (according to the access time of the files).
+
+            The cold directory is recorded in the DB, and cannot be
+            changed while it contains keys.
+            Returns a tuple (number of files moved, bytes moved).
+        """
+        cold_dirname = os.path.realpath(cold_dirname)
+        current = read_cold_dirname(self.basepath)
+        if current is not None and current != cold_dirname:
+            if self.tier_stats()['cold'][0] > 0:
+                msg = ('The DB %r uses the cold directory %r; cannot use %r.'
+                       % (self.basepath, current, cold_dirname))
+                raise UserError(msg)
+        if current != cold_dirname:
+            write_cold_dirname(self.basepath, cold_dirname)
+        self.cold_dirname = cold_dirname
+
+        now = time()
+        todo = []
+        for key in self.manifest.get_keys():
+            if not key.startswith(self.cold_prefixes):
+                continue
+            filename = self.filename_for_key(key)
+            try:
+                st = os.stat(filename)
+            except OSError:  # already cold
+                continue
+            if st.st_size >= min_size and now - st.st_atime >= min_age:
+                todo.append((key, filename, st.st_size))
+
+        moved = nbytes = 0
+        for i, (key, filename, size) in enumerate(todo):
+            try:
+                self._move(filename, self.cold_filename_for_key(key))
+            except FileNotFoundError:
+                # deleted or moved by another process in the meantime
+                pass
+            else:
+                moved += 1
+                nbytes += size
+            if progress is not None:
+                progress(i + 1, len(todo))
+        return moved, nbytes
+
+    def tier_stats(self):
+        """ Returns a dict tier -> (number of keys, bytes),
+            for the tiers "hot" and "cold". """
+        res = {'hot': [0, 0], 'cold': [0, 0]}
+        for key in self.manifest.get_keys():
+            filename = self.existing_filename_for_key(key)
+            try:
+                size = os.stat(filename).st_size
+            except OSError:  # deleted in the meantime
+                continue
+            cold = (self.cold_dirname is not None and
+                    filename.startswith(self.cold_dirname + os.sep))
+            stats = res['cold' if cold else 'hot']
+            stats[0] += 1
+            stats[1] += size
+        return dict((k, tuple(v)) for k, v in res.items())
+
+    def migrate_layout(self, layout, progress=None):
+        """
+            Moves all files to the given layout, in place.
+
+            The target layout is recorded before starting, so if this is
+            interrupted the DB is still readable and calling this again
+            resumes the migration.
+
+            progress: optional function called after each file with
+            (done, total), where total is the number of files found in
+            the other layouts; they are either moved, or deleted if the
+            key was written again in the new layout.
+            Returns the number of files moved.
+        """
+        if not layout in self.layouts:
+            msg = 'Invalid layout %r; known: %s.' % (layout, self.layouts)
+            raise ValueError(msg)
+
+        sources = [x for x in self.layouts if x != layout]
+        write_layout(self.basepath, layout, previous=sources[0])
+        self.layout, self.layout_previous = layout, sources[0]
+
+        todo = []
+        for source in sources:
+            todo.extend((key, source) for key in self.keys0(layout=source))
+
+        moved = 0
+        for i, (key, source) in enumerate(todo):
+            src = self.filename_for_key(key, layout=source)
+            dst = self.filename_for_key(key, layout=layout)
+            if (os.path.exists(dst) and
+                    os.path.getmtime(dst) >= os.path.getmtime(src)):
+                # written twice; keep the most recent one
+                os.unlink(src)
+            else:
+                make_sure_dir_exists(dst)
+                os.rename(src, dst)
+                moved += 1
+            if progress is not None:
+                progress(i + 1, len(todo))
+
+        write_layout(self.basepath, layout)
+        self.layout, self.layout_previous = layout, None
+        return moved
+
+
+# glob pattern for the directories containing the files
+layout_glob = {
+    'flat': '',
+    'sharded': os.path.join('[0-9a-f][0-9a-f]', '[0-9a-f][0-9a-f]'),
+}
+
+
+def format_layout(current, previous):
+    if previous is None:
+        return current
+    else:
+        return '%s->%s' % (previous, current)
+
+
+def read_layout(basepath):
+    """ Returns None if no layout is recorded, otherwise a pair
+        (layout, previous layout), where the second is not None
+        if a migration was interrupted. """
+    filename = os.path.join(basepath, StorageFilesystem.layout_filename)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        s = f.read().strip()
+    if '->' in s:
+        previous, current = s.split('->')
+    else:
+        previous, current = None, s
+    for x in [current, previous]:
+        if x is not None and not x in StorageFilesystem.layouts:
+            msg = 'Invalid layout %r in %s.' % (s, filename)
+            raise CompmakeBug(msg)
+    return current, previous
+
+
+def write_layout(basepath, layout, previous=None):
+    filename = os.path.join(basepath, StorageFilesystem.layout_filename)
+    s = format_layout(layout, previous) + '\n'
+    make_sure_dir_exists(filename)
+    with safe_write(filename, mode='w') as f:
+        f.write(s)
+
+
+def read_cold_dirname(basepath):
+    """ Returns the cold directory recorded in the DB, or None. """
+    filename = os.path.join(basepath, StorageFilesystem.cold_filename)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return f.read().strip() or None
+
+
+def write_cold_dirname(basepath, dirname):
+    filename = os.path.join(basepath, StorageFilesystem.cold_filename)
+    make_sure_dir_exists(filename)
+    with safe_write(filename, mode='w') as f:
+        f.write(dirname + '\n')
+
+
+def has_flat_files(basepath):
+    for x in os.listdir(basepath):
+        if x.endswith('.pickle') or x.endswith('.pickle.gz'):
+            return True
+    return False
+
+
+def detect_compression(basepath):
+    """ Returns True if the DB at basepath uses compressed files. """
+    recorded = read_layout(basepath)
+    layouts = ['flat'] if recorded is None else [x for x in recorded if x]
+    for layout in layouts:
+        pattern = os.path.join(basepath, layout_glob[layout], '*.pickle*')
+        for x in glob(pattern):
+            return '.gz' in x
+    return False
 
 
 def chmod_plus_x(filename):
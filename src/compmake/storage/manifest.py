@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+import fcntl
+import os
+
+from compmake.exceptions import CompmakeBug
+from compmake.utils.filesystem_utils import make_sure_dir_exists
+from compmake.utils.safe_write import safe_write
+
+__all__ = [
+    'KeyManifest',
+]
+
+
+class KeyManifest(object):
+    """
+        Append-only log of the keys added and removed from a DB,
+        so that the list of keys can be obtained without listing
+        directories.
+
+        Each line is "+key" or "-key". Readers keep the set of live keys
+        in memory and only read what was appended since the last time.
+        When the log is much longer than the set of live keys it is
+        rewritten (compacted).
+
+        Appends take a shared lock and compaction an exclusive lock
+        on a separate lock file, so that several processes can write
+        to the same DB.
+    """
+
+    header = '# compmake key manifest 1\n'
+
+    # compact when there are more than 2*live + compact_min lines
+    compact_min = 1000
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock_filename = filename + '.lock'
+        self._forget()
+
+    def _forget(self):
+        self.keys = None
+        self.inode = None
+        self.offset = 0
+        self.nlines = 0
+
+    def __getstate__(self):
+        # do not send the whole set of keys to the workers
+        state = dict(self.__dict__)
+        state.update(keys=None, inode=None, offset=0, nlines=0)
+        return state
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    @contextmanager
+    def _locked(self, exclusive):
+        make_sure_dir_exists(self.lock_filename)
+        with open(self.lock_filename, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _append(self, line):
+        with self._locked(exclusive=False):
+            # a single write() on a file opened in append mode
+            fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+            try:
+                os.write(fd, line.encode('utf-8'))
+            finally:
+                os.close(fd)
+
+    def added(self, key):
+        self._append('+%s\n' % key)
+
+    def removed(self, key):
+        self._append('-%s\n' % key)
+
+    def removed_many(self, keys):
+        if keys:
+            self._append(''.join('-%s\n' % key for key in keys))
+
+    def write(self, keys):
+        """ Rewrites the manifest so that it contains exactly these keys. """
+        with self._locked(exclusive=True):
+            self._write(keys)
+
+    def _write(self, keys):
+        make_sure_dir_exists(self.filename)
+        with safe_write(self.filename, mode='w') as f:
+            f.write(self.header)
+            for key in sorted(keys):
+                f.write('+%s\n' % key)
+        self._forget()
+
+    def get_keys(self):
+        """ Returns the set of live keys (do not modify it). """
+        with self._locked(exclusive=False):
+            self._read_tail()
+
+        if self.nlines > 2 * len(self.keys) + self.compact_min:
+            self.compact()
+        return self.keys
+
+    def compact(self):
+        with self._locked(exclusive=True):
+            self._read_tail()
+            keys = self.keys
+            self._write(keys)
+            self._read_tail()
+
+    def _read_tail(self):
+        """ Reads what was appended since the last time. """
+        st = os.stat(self.filename)
+        if (self.keys is None or st.st_ino != self.inode or
+                st.st_size < self.offset):
+            # first time, or rewritten by somebody else
+            self._forget()
+            self.keys = set()
+            self.inode = st.st_ino
+
+        if st.st_size == self.offset:
+            return
+
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        # ignore a partially written last line
+        end = data.rfind(b'\n') + 1
+        data = data[:end]
+        self.offset += end
+
+        for line in data.decode('utf-8').split('\n'):
+            if not line or line.startswith('#'):
+                continue
+            self.nlines += 1
+            op, key = line[0], line[1:]
+            if op == '+':
+                self.keys.add(key)
+            elif op == '-':
+                self.keys.discard(key)
+            else:
+                msg = 'Invalid line %r in manifest %s.' % (line, self.filename)
+                raise CompmakeBug(msg)
@@ -1,55 +1,228 @@
 # -*- coding: utf-8 -*-
-import sys
+from collections import OrderedDict
+
+from .atomic import atomic_update
+from .batch import contains_many, delete_many, get_many, set_many
 
 __all__ = [
     'MemoryCache',
+    'uncached',
 ]
 
 
+def uncached(db):
+    """ Returns the storage engine behind any MemoryCache. """
+    while isinstance(db, MemoryCache):
+        db = db.db
+    return db
+
+
 # noinspection PyArgumentList
 class MemoryCache(object):
+    """
+        Read-through, write-through cache in front of a storage engine,
+        with the same interface as the engine.
+
+        Values are kept in LRU order within a budget of ``max_bytes``,
+        where the size of a value is its serialized size in the DB.
+
+        policies: dict key prefix -> bool, whether to cache the keys
+                  with that prefix. Keys not matching any prefix are
+                  not cached.
+
+        If the engine has a ``key_stat()`` method, each read checks
+        that the cached value is still the current one, so that the
+        values written by other processes (e.g. the workers of parmake)
+        are seen. Otherwise the cache assumes that it is the only
+        writer; use ``invalidate()`` if that is not the case.
 
-    def __init__(self, db, cache_values=True):
-        self.data = {}
+        Writes go to the DB and drop the cached value, so that the
+        objects returned are never modified by the writers.
+        Do not modify the objects returned, unless writing them back.
+    """
+
+    default_policies = {
+        'cm-job-': True,
+        'cm-cache-': True,
+        'cm-details-': False,
+        'cm-args-': False,
+        'cm-res-': False,
+    }
+
+    def __init__(self, db, cache_values=True, max_bytes=256 * 1024 * 1024,
+                 policies=None):
         self.db = db
         self.cache_values = cache_values
-        self.keys_to_cache = ':job:'
-        
-    def __getitem__(self, key):
-        if key in self.data:
-            return self.data[key]
-        ob = self.db.__getitem__(key)
-        if self.should_cache(key):
-            self.data[key] = ob
-        return ob 
-    
+        self.max_bytes = max_bytes
+        if policies is None:
+            policies = dict(MemoryCache.default_policies)
+        self.policies = policies
+        self.validate = hasattr(db, 'key_stat')
+        self._reset()
+
+    def _reset(self):
+        # key -> (value, version, nbytes)
+        self.data = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # found changed in the DB
+        self.stale = 0
+
+    def __repr__(self):
+        return 'MemoryCache(%r)' % self.db
+
+    def __getstate__(self):
+        # do not send the cached values to the workers
+        state = dict(self.__dict__)
+        state.update(data=OrderedDict(), nbytes=0)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __getattr__(self, name):
+        # everything else (basepath, reopen_after_fork(), ...) is the DB's
+        if name.startswith('__') or not 'db' in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.db, name)
+
     def should_cache(self, key):
         if not self.cache_values:
             return False
-        return self.keys_to_cache in key
-        
+        for prefix, cache in self.policies.items():
+            if key.startswith(prefix):
+                return cache
+        return False
+
+    def __getitem__(self, key):
+        if not self.should_cache(key):
+            return self.db[key]
+
+        found, value, version, nbytes = self._lookup(key)
+        if found:
+            return value
+        if self.validate and version is None:
+            # raises the usual error
+            return self.db[key]
+
+        value = self.db[key]
+        self._put(key, value, version, nbytes)
+        return value
+
+    def _lookup(self, key):
+        """ Returns (found, value, version, nbytes), where version and
+            nbytes are the current ones in the DB (version is None if the
+            key does not exist in the DB). Counts hits and misses. """
+        if self.validate:
+            stat = self.db.key_stat(key)
+            if stat is None:
+                self._forget(key)
+                return False, None, None, None
+            version, nbytes = stat
+        else:
+            version = nbytes = None
+
+        if key in self.data:
+            value, cached_version, _ = self.data[key]
+            if cached_version == version:
+                self.hits += 1
+                self.data.move_to_end(key)
+                return True, value, version, nbytes
+            self.stale += 1
+            self._forget(key)
+
+        self.misses += 1
+        return False, None, version, nbytes
+
+    def _put(self, key, value, version, nbytes):
+        if nbytes is None:
+            nbytes = self.db.sizeof(key)
+        if nbytes > self.max_bytes:
+            return
+        self.data[key] = (value, version, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, _, n) = self.data.popitem(last=False)
+            self.nbytes -= n
+            self.evictions += 1
+
+    def _forget(self, key):
+        if key in self.data:
+            _, _, nbytes = self.data.pop(key)
+            self.nbytes -= nbytes
+
+    def invalidate(self, key=None):
+        """ Forgets the value of key, or all values if key is None. """
+        if key is None:
+            self.data.clear()
+            self.nbytes = 0
+        else:
+            self._forget(key)
+
     def __setitem__(self, key, value):
-        # TODO: check value
-        if self.should_cache(key):
-            self.data[key] = value
+        self._forget(key)
         self.db[key] = value
-            
+
     def __delitem__(self, key):
-        if key in self.data:
-            self.data.__delitem__(key)
+        self._forget(key)
         self.db.__delitem__(key)
-        
+
+    def atomic_update(self, key, function):
+        # the function must get a fresh copy, not the cached value
+        self._forget(key)
+        return atomic_update(self.db, key, function)
+
     def __contains__(self, key):
-        if key in self.data:
+        if key in self.data and not self.validate:
             return True
-        else:
-            return self.db.__contains__(key)
-  
+        return self.db.__contains__(key)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        res = get_many(self.db, [k for k in keys if not self.should_cache(k)])
+        todo = {}
+        for key in contains_many(self.db,
+                                 [k for k in keys if self.should_cache(k)]):
+            found, value, version, nbytes = self._lookup(key)
+            if found:
+                res[key] = value
+            else:
+                todo[key] = (version, nbytes)
+        for key, value in get_many(self.db, todo).items():
+            version, nbytes = todo[key]
+            self._put(key, value, version, nbytes)
+            res[key] = value
+        return res
+
+    def set_many(self, items):
+        items = list(items)
+        for key, _ in items:
+            self._forget(key)
+        set_many(self.db, items)
+
+    def contains_many(self, keys):
+        return contains_many(self.db, keys)
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        for key in keys:
+            self._forget(key)
+        delete_many(self.db, keys)
+
     def sizeof(self, key):
-        # XXX: not recursive
-        return sys.getsizeof(key)
-    
+        return self.db.sizeof(key)
+
     def keys(self):
-        return self.db.keys() 
-    
+        return self.db.keys()
+
+    def keys_with_prefix(self, prefix):
+        return self.db.keys_with_prefix(prefix)
 
+    def stats(self):
+        """ Returns a dict with the counters. """
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, stale=self.stale,
+                    entries=len(self.data), nbytes=self.nbytes,
+                    max_bytes=self.max_bytes)
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+    Counters of the operations done by the storage engines:
+    for each operation and key prefix, the number of calls and keys,
+    the bytes read or written, the time spent and a histogram
+    of the latencies.
+
+    Each process keeps its own counters for each DB and writes them
+    every few seconds (and at exit) to "metrics/<host>-<pid>.json" in the
+    DB directory, so that the operations of the workers of parmake can
+    be summed with read_storage_metrics(). See the command "storage-stats".
+
+    The files of the processes that exited are summed into
+    "metrics/merged.json" the first time that each process writes its
+    counters, and by read_storage_metrics(), so that there is one file
+    per process running.
+"""
+import atexit
+from bisect import bisect
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import re
+import socket
+import threading
+from time import time
+
+import psutil
+
+from compmake import logger
+from compmake.state import get_compmake_config
+from compmake.utils.safe_write import safe_write
+
+try:
+    from time import perf_counter
+except ImportError:  # Python 2
+    from time import time as perf_counter
+
+__all__ = [
+    'StorageMetrics',
+    'tracked',
+    'get_storage_metrics',
+    'flush_storage_metrics',
+    'read_storage_metrics',
+    'reset_storage_metrics',
+    'compact_storage_metrics',
+    'merge_storage_metrics',
+    'histogram_quantile',
+]
+
+metrics_dirname = 'metrics'
+merged_filename = 'merged.json'
+
+# upper bounds (seconds) of the buckets of the latency histograms;
+# the last bucket is for the latencies above the last bound
+latency_buckets = [1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2,
+                   0.1, 0.3, 1.0, 3.0, 10.0]
+
+
+def key_prefix(key):
+    """ Returns the prefix of the key, like "cm-job-". """
+    if not key:
+        return '*'
+    if key.startswith('cm-'):
+        i = key.find('-', 3)
+        if i > 0:
+            return key[:i + 1]
+    return '?'
+
+
+def keys_prefix(keys):
+    """ The prefix of the keys if they have the same, otherwise "*". """
+    prefixes = set(key_prefix(k) for k in keys)
+    if len(prefixes) == 1:
+        return prefixes.pop()
+    return '*'
+
+
+class StorageMetrics(object):
+    """ The counters of one process for one DB. """
+
+    # seconds between the writes of the counters to the DB directory
+    flush_interval = 5.0
+
+    def __init__(self, basepath):
+        self.basepath = basepath
+        self.filename = os.path.join(basepath, metrics_dirname, '%s-%s.json'
+                                     % (socket.gethostname(), os.getpid()))
+        self.lock = threading.Lock()
+        # held while writing the file
+        self.flush_lock = threading.Lock()
+        self.compacted = False
+        self.reset()
+
+    def reset(self):
+        # (op, prefix) -> [calls, keys, bytes, seconds, histogram]
+        self.data = {}
+        self.last_flush = time()
+        self.dirty = False
+
+    def record(self, op, prefix, nkeys, nbytes, seconds):
+        k = (op, prefix)
+        with self.lock:
+            entry = self.data.get(k, None)
+            if entry is None:
+                entry = [0, 0, 0, 0.0, [0] * (len(latency_buckets) + 1)]
+                self.data[k] = entry
+            entry[0] += 1
+            entry[1] += nkeys
+            entry[2] += nbytes
+            entry[3] += seconds
+            entry[4][bisect(latency_buckets, seconds)] += 1
+            self.dirty = True
+        if time() - self.last_flush > self.flush_interval:
+            # by one thread; the others go on
+            if self.flush_lock.acquire(False):
+                try:
+                    self._flush_or_warn()
+                finally:
+                    self.flush_lock.release()
+
+    def as_dict(self):
+        """ Returns the counters in the format written to the files. """
+        with self.lock:
+            ops = []
+            for (op, prefix), entry in sorted(self.data.items()):
+                calls, nkeys, nbytes, seconds, histogram = entry
+                ops.append(dict(op=op, prefix=prefix, calls=calls, keys=nkeys,
+                                bytes=nbytes, seconds=seconds,
+                                histogram=list(histogram)))
+        return dict(host=socket.gethostname(), pid=os.getpid(),
+                    latency_buckets=latency_buckets, ops=ops)
+
+    def flush(self):
+        """ Writes the counters to the DB directory. """
+        with self.flush_lock:
+            self._flush()
+
+    def _flush_or_warn(self):
+        # the metrics must not make the operations fail
+        try:
+            self._flush()
+        except Exception as e:
+            logger.warning('Could not write the storage metrics to %s: %s' %
+                           (self.filename, e))
+
+    def _flush(self):
+        self.last_flush = time()
+        if not self.dirty or not os.path.exists(self.basepath):
+            return
+        self.dirty = False
+        data = json.dumps(self.as_dict(), indent=1, sort_keys=True)
+        with safe_write(self.filename, mode='w') as f:
+            f.write(data)
+        if not self.compacted:
+            self.compacted = True
+            compact_storage_metrics(self.basepath)
+
+
+class TrackedOp(object):
+    """ Measures one operation; set nbytes before the end. """
+    __slots__ = ('metrics', 'op', 'prefix', 'nkeys', 'nbytes', 't0')
+
+    def __init__(self, metrics, op, prefix, nkeys):
+        self.metrics = metrics
+        self.op = op
+        self.prefix = prefix
+        self.nkeys = nkeys
+        self.nbytes = 0
+
+    def __enter__(self):
+        self.t0 = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.op, self.prefix, self.nkeys, self.nbytes,
+                            perf_counter() - self.t0)
+
+
+class NotTracked(object):
+    __slots__ = ('nbytes',)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def tracked(basepath, op, key=None, keys=None):
+    """
+        Returns a context manager measuring an operation on the DB
+        in basepath, concerning either one key or a list of keys.
+        Set its attribute nbytes to the bytes read or written.
+
+        Does nothing if the switch "storage_metrics" is off.
+    """
+    if not get_compmake_config('storage_metrics'):
+        return NotTracked()
+    if keys is not None:
+        prefix = keys_prefix(keys)
+        nkeys = len(keys)
+    else:
+        prefix = key_prefix(key)
+        nkeys = 1
+    return TrackedOp(get_storage_metrics(basepath), op, prefix, nkeys)
+
+
+class Instances(object):
+    # (basepath, pid) -> StorageMetrics
+    metrics = {}
+
+
+def get_storage_metrics(basepath):
+    """ Returns the counters of this process for the DB. """
+    k = (basepath, os.getpid())
+    if not k in Instances.metrics:
+        Instances.metrics[k] = StorageMetrics(basepath)
+    return Instances.metrics[k]
+
+
+def flush_storage_metrics():
+    """ Writes the counters of this process, for all DBs. """
+    pid = os.getpid()
+    for (_, p), metrics in list(Instances.metrics.items()):
+        if p == pid:
+            with metrics.flush_lock:
+                metrics._flush_or_warn()
+
+
+atexit.register(flush_storage_metrics)
+
+
+def _read(filename):
+    """ Returns the counters in the file, or None. """
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if data.get('latency_buckets') != latency_buckets:
+        # written by another version
+        return None
+    return data
+
+
+def read_storage_metrics(basepath):
+    """ Returns the list of the counters of all the processes
+        (in the format of StorageMetrics.as_dict()). """
+    get_storage_metrics(basepath).flush()
+    dirname = os.path.join(basepath, metrics_dirname)
+    if not os.path.exists(dirname):
+        return []
+    compact_storage_metrics(basepath)
+    res = []
+    for entry in os.scandir(dirname):
+        if entry.name.endswith('.json'):
+            data = _read(entry.path)
+            if data is not None:
+                res.append(data)
+    return res
+
+
+# "<host>-<pid>.json"
+process_file_pattern = re.compile(r'^(.*)-(\d+)\.json$')
+
+
+@contextmanager
+def _locked(dirname):
+    with open(os.path.join(dirname, '.lock'), 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def compact_storage_metrics(basepath):
+    """ Sums the counters of the processes of this host that exited
+        into one file, and deletes their files. """
+    dirname = os.path.join(basepath, metrics_dirname)
+    if not os.path.exists(dirname):
+        return
+    host = socket.gethostname()
+    with _locked(dirname):
+        dead = []
+        for entry in os.scandir(dirname):
+            m = process_file_pattern.match(entry.name)
+            if (m is not None and m.group(1) == host and
+                    not psutil.pid_exists(int(m.group(2)))):
+                dead.append(entry.path)
+        if not dead:
+            return
+        merged = os.path.join(dirname, merged_filename)
+        datas = [_read(x) for x in [merged] + dead]
+        totals = merge_storage_metrics([x for x in datas if x is not None])
+        ops = []
+        for (op, prefix), x in sorted(totals.items()):
+            ops.append(dict(op=op, prefix=prefix, **x))
+        data = dict(host=None, pid=None, latency_buckets=latency_buckets,
+                    ops=ops)
+        with safe_write(merged, mode='w') as f:
+            f.write(json.dumps(data, indent=1, sort_keys=True))
+        for filename in dead:
+            os.unlink(filename)
+
+
+def reset_storage_metrics(basepath):
+    """ Deletes the counters of all the processes. """
+    get_storage_metrics(basepath).reset()
+    dirname = os.path.join(basepath, metrics_dirname)
+    if os.path.exists(dirname):
+        with _locked(dirname):
+            for entry in os.scandir(dirname):
+                if entry.name.endswith('.json'):
+                    os.unlink(entry.path)
+
+
+def merge_storage_metrics(datas):
+    """ Sums the counters of several processes; returns a dict
+        (op, prefix) -> dict(calls, keys, bytes, seconds, histogram). """
+    res = {}
+    for data in datas:
+        for x in data['ops']:
+            k = (x['op'], x['prefix'])
+            if not k in res:
+                res[k] = dict(calls=0, keys=0, bytes=0, seconds=0.0,
+                              histogram=[0] * (len(latency_buckets) + 1))
+            r = res[k]
+            for field in ['calls', 'keys', 'bytes', 'seconds']:
+                r[field] += x[field]
+            r['histogram'] = [a + b for a, b in zip(r['histogram'],
+                                                    x['histogram'])]
+    return res
+
+
+def histogram_quantile(histogram, q):
+    """ Returns an upper bound for the q-quantile of the latencies,
+        or None if it is in the last bucket. """
+    total = sum(histogram)
+    if total == 0:
+        return 0.0
+    cumulative = 0
+    for i, n in enumerate(histogram):
+        cumulative += n
+        if cumulative >= q * total:
+            if i < len(latency_buckets):
+                return latency_buckets[i]
+            return None
+    return None
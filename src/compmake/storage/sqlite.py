@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+import os
+import sqlite3
+import sys
+import threading
+import traceback
+import zlib
+
+from compmake import logger
+from compmake.exceptions import CompmakeBug, SerializationError, UserError
+from compmake.utils import find_pickling_error, pickle_decode, pickle_encode
+
+from .codec_policy import codec_for_key
+from .filesystem import create_scripts
+from .metrics import tracked
+
+if sys.version_info[0] >= 3:
+    import pickle  # @UnusedImport
+else:
+    import cPickle as pickle  # @Reimport
+
+trace_queries = False
+
+__all__ = [
+    'StorageSQLite',
+]
+
+
+class StorageSQLite(object):
+    """
+        Stores all keys in a single SQLite file (in WAL mode) inside
+        the directory ``basepath``.
+
+        It has the same interface as StorageFilesystem; keys are the
+        primary key of the table, so that listing by prefix is an
+        index range scan instead of a directory listing.
+
+        Values are written with the codec chosen for their key
+        (see StorageFilesystem); with the default codec they are
+        compressed with zlib if compress is True.
+    """
+
+    db_filename = 'compmake.sqlite'
+
+    # seconds to wait for a lock held by another process
+    busy_timeout = 60.0
+
+    def __init__(self, basepath, compress=False, codecs=None):
+        self.basepath = os.path.realpath(basepath)
+        self.compress = compress
+        self.codecs = codecs
+        self.filename = os.path.join(self.basepath, self.db_filename)
+        self._local = threading.local()
+
+        if not os.path.exists(self.basepath):
+            os.makedirs(self.basepath)
+
+        # The id is the version of the row for key_stat(): "INSERT OR
+        # REPLACE" gives a new id to the row, and with AUTOINCREMENT the
+        # ids of the deleted rows are never used again.
+        conn = self._connection()
+        with self._transaction(conn):
+            conn.execute('CREATE TABLE IF NOT EXISTS kv ('
+                         ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                         ' key TEXT NOT NULL UNIQUE,'
+                         ' compressed INTEGER NOT NULL,'
+                         ' value BLOB NOT NULL)')
+
+        # create a bunch of files that contain shortcuts
+        create_scripts(self.basepath)
+
+    def __repr__(self):
+        return "SQLiteDB(%r)" % self.filename
+
+    def __getstate__(self):
+        # connections cannot be pickled; they are reopened on demand
+        state = dict(self.__dict__)
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connection(self):
+        """ Returns the connection for this process and thread. """
+        local = self._local
+        pid = os.getpid()
+        if getattr(local, 'pid', None) != pid:
+            conn = sqlite3.connect(self.filename,
+                                   timeout=self.busy_timeout,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            local.connection = conn
+            local.pid = pid
+        return local.connection
+
+    def reopen_after_fork(self):
+        self._local = threading.local()
+
+    def sizeof(self, key):
+        with tracked(self.basepath, 'sizeof', key):
+            c = self._connection().execute(
+                'SELECT length(value) FROM kv WHERE key=?', (key,))
+            row = c.fetchone()
+        if row is None:
+            msg = 'Could not find key %r.' % key
+            raise CompmakeBug(msg)
+        return row[0]
+
+    def key_stat(self, key):
+        """ Returns None if the key does not exist, otherwise a pair
+            (version, size), where version changes every time the key
+            is written. Used by MemoryCache. """
+        c = self._connection().execute(
+            'SELECT id, length(value) FROM kv WHERE key=?', (key,))
+        row = c.fetchone()
+        if row is None:
+            return None
+        version, size = row
+        return version, size
+
+    def __getitem__(self, key):
+        if trace_queries:
+            logger.debug('R %s' % str(key))
+
+        return self._get(self._connection(), key)
+
+    def _get(self, conn, key):
+        with tracked(self.basepath, 'get', key) as op:
+            c = conn.execute(
+                'SELECT compressed, value FROM kv WHERE key=?', (key,))
+            row = c.fetchone()
+            if row is None:
+                msg = 'Could not find key %r.' % key
+                msg += '\n db: %s' % self.filename
+                raise CompmakeBug(msg)
+
+            compressed, data = row
+            op.nbytes = len(data)
+            return self._decode(key, compressed, data)
+
+    def _decode(self, key, compressed, data):
+        try:
+            if compressed:
+                return pickle.loads(zlib.decompress(data))
+            # plain pickle, or written with a codec
+            return pickle_decode(data)
+        except Exception as e:
+            msg = ("Could not unpickle data for key %r. \n db: %s" %
+                   (key, self.filename))
+            logger.error(msg)
+            logger.exception(e)
+            msg += "\n" + traceback.format_exc()
+            raise CompmakeBug(msg)
+
+    def __setitem__(self, key, value):  # @ReservedAssignment
+        if trace_queries:
+            logger.debug('W %s' % str(key))
+
+        self._set(self._connection(), key, value)
+
+    def _set(self, conn, key, value):
+        with tracked(self.basepath, 'set', key) as op:
+            row = self._encode(key, value)
+            op.nbytes = len(row[2])
+            conn.execute(
+                'INSERT OR REPLACE INTO kv (key, compressed, value) '
+                'VALUES (?, ?, ?)', row)
+
+    def _encode(self, key, value):
+        """ Returns the row (key, compressed, data). """
+        codec = codec_for_key(key, self.codecs)
+        try:
+            if codec is None:
+                data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            else:
+                data = b''.join(pickle_encode(value, codec))
+        except (KeyboardInterrupt, UserError):
+            raise
+        except BaseException as e:
+            msg = ('Cannot set key %s: cannot pickle object '
+                   'of class %s: %s' % (key, value.__class__.__name__, e))
+            logger.error(msg)
+            logger.exception(e)
+            emsg = find_pickling_error(value)
+            logger.error(emsg)
+            raise SerializationError(msg + '\n' + emsg)
+
+        compressed = codec is None and self.compress
+        if compressed:
+            data = zlib.compress(data, 5)
+        return key, int(compressed), sqlite3.Binary(data)
+
+    def __delitem__(self, key):
+        with tracked(self.basepath, 'delete', key):
+            c = self._connection().execute('DELETE FROM kv WHERE key=?',
+                                           (key,))
+        if c.rowcount == 0:
+            msg = 'I expected key %r to exist before deleting' % key
+            raise ValueError(msg)
+
+    def __contains__(self, key):
+        if trace_queries:
+            logger.debug('? %s' % str(key))
+
+        with tracked(self.basepath, 'contains', key):
+            c = self._connection().execute(
+                'SELECT 1 FROM kv WHERE key=?', (key,))
+            return c.fetchone() is not None
+
+    # maximum number of parameters in one query
+    batch_size = 500
+
+    def _select_many(self, what, keys):
+        """ Yields the rows of "SELECT what FROM kv WHERE key IN keys". """
+        keys = list(keys)
+        conn = self._connection()
+        for i in range(0, len(keys), self.batch_size):
+            chunk = keys[i:i + self.batch_size]
+            q = 'SELECT %s FROM kv WHERE key IN (%s)' % (
+                what, ','.join('?' * len(chunk)))
+            for row in conn.execute(q, chunk):
+                yield row
+
+    def get_many(self, keys):
+        """ Returns a dict key -> value for the keys that exist. """
+        keys = list(keys)
+        res = {}
+        with tracked(self.basepath, 'get_many', keys=keys) as op:
+            for key, compressed, data in self._select_many(
+                    'key, compressed, value', keys):
+                op.nbytes += len(data)
+                res[key] = self._decode(key, compressed, data)
+        return res
+
+    def contains_many(self, keys):
+        """ Returns the set of the given keys that exist. """
+        keys = list(keys)
+        with tracked(self.basepath, 'contains_many', keys=keys):
+            return set(row[0] for row in self._select_many('key', keys))
+
+    def set_many(self, items):
+        """ Writes the (key, value) pairs in one transaction. """
+        items = list(items)
+        with tracked(self.basepath, 'set_many',
+                     keys=[key for key, _ in items]) as op:
+            rows = [self._encode(key, value) for key, value in items]
+            op.nbytes = sum(len(row[2]) for row in rows)
+            conn = self._connection()
+            with self._transaction(conn):
+                conn.executemany(
+                    'INSERT OR REPLACE INTO kv (key, compressed, value) '
+                    'VALUES (?, ?, ?)', rows)
+
+    def delete_many(self, keys):
+        """ Deletes the keys that exist, in one transaction. """
+        keys = list(keys)
+        with tracked(self.basepath, 'delete_many', keys=keys):
+            conn = self._connection()
+            with self._transaction(conn):
+                conn.executemany('DELETE FROM kv WHERE key=?',
+                                 [(key,) for key in keys])
+
+    def atomic_update(self, key, function):
+        """ Sets self[key] = function(self[key]) in one transaction. """
+        conn = self._connection()
+        with self._transaction(conn):
+            value = function(self._get(conn, key))
+            self._set(conn, key, value)
+        return value
+
+    @contextmanager
+    def _transaction(self, conn):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def keys(self):
+        with tracked(self.basepath, 'keys', ''):
+            c = self._connection().execute('SELECT key FROM kv ORDER BY key')
+            return [row[0] for row in c]
+
+    def keys_with_prefix(self, prefix):
+        """ Returns the sorted list of keys starting with prefix. """
+        if not prefix:
+            return self.keys()
+        # [prefix, prefix_next) is a range on the index of the keys
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        with tracked(self.basepath, 'keys', prefix):
+            c = self._connection().execute(
+                'SELECT key FROM kv WHERE key >= ? AND key < ? ORDER BY key',
+                (prefix, upper))
+            return [row[0] for row in c]
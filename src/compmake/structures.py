@@ -110,6 +110,10 @@ class Job(object):
 
         self.pickle_main_context = pickle_main_context_save()
 
+        # fingerprint of the code of the command (see
+        # jobs/code_fingerprint.py)
+        self.code_fingerprint = None
+
 
 def same_computation(jobargs1, jobargs2):
     """ Returns boolean, string tuple """
@@ -129,7 +133,8 @@ def same_computation(jobargs1, jobargs2):
             reason += '  - old: %s \n' % cmd1
             reason += '  - new: %s \n' % cmd2
 
-            # TODO: can we check the actual code?
+            # the code itself is compared by up_to_date() with the
+            # switch "check_code" (see jobs/code_fingerprint.py)
 
         warn = ' (or you did not implement proper __eq__)'
         if len(args1) != len(args2):
@@ -224,7 +229,8 @@ class Cache(object):
         # time end
         self.timestamp = 0.0
 
-        # Hash for dependencies when this was computed
+        # Hash for dependencies when this was computed:
+        # child -> its result_digest (see jobs/early_cutoff.py)
         self.hashes_dependencies = {}
 
         self.jobs_defined = set()
@@ -248,6 +254,48 @@ class Cache(object):
         self.int_save_results = None
         self.int_gc = None
 
+        # see cache_has_large_overhead()
+        self.walltime_overhead = None
+
+        # fingerprint of the computation, if using the shared cache
+        # (jobs/shared_cache.not_shareable if it cannot be shared)
+        self.fingerprint = None
+
+        # digest of the result, if using early cutoff
+        self.result_digest = None
+
+        # Job.code_fingerprint when this was computed
+        self.code_fingerprint = None
+
+    # The bulky fields, which are stored apart from the record
+    # (see set_job_cache()) and loaded when first accessed.
+    details_fields = ['backtrace',
+                      'captured_stdout',
+                      'captured_stderr',
+                      'int_make',
+                      'int_load_results',
+                      'int_compute',
+                      'int_save_results',
+                      'int_gc']
+
+    def __getattr__(self, name):
+        # called only for the attributes that are not in __dict__
+        if not name in Cache.details_fields:
+            raise AttributeError(name)
+        loader = self.__dict__.pop('_details_loader', None)
+        details = loader() if loader is not None else {}
+        for field in Cache.details_fields:
+            self.__dict__.setdefault(field, details.get(field, None))
+        return self.__dict__[name]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_details_loader', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
     def __repr__(self):
         return ('Cache(%s;%s;cpu:%s;wall:%s)' %
                 (Cache.state2desc[self.state],
@@ -255,11 +303,19 @@ class Cache(object):
                  self.walltime_used))
 
 
-def cache_has_large_overhead(cache):
+def walltime_overhead(cache):
     overhead = (cache.int_load_results.get_walltime_used() +
                 cache.int_save_results.get_walltime_used() +
                 cache.int_gc.get_walltime_used())
-    return overhead - cache.int_make.get_walltime_used() > 1.0
+    return overhead - cache.int_make.get_walltime_used()
+
+
+def cache_has_large_overhead(cache):
+    # computed when the job is done, so that the timers are not loaded
+    overhead = getattr(cache, 'walltime_overhead', None)
+    if overhead is None:
+        overhead = walltime_overhead(cache)
+    return overhead > 1.0
 
 
 def timing_summary(cache):
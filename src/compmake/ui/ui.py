@@ -4,7 +4,8 @@ import six
 from .. import CompmakeConstants, get_compmake_config, get_compmake_status
 from ..events import publish
 from ..exceptions import CommandFailed, UserError
-from ..jobs import (CacheQueryDB, all_jobs, collect_dependencies, get_job, 
+from ..jobs import (CacheQueryDB, activate_graph_index, all_jobs,
+    code_fingerprint, collect_dependencies, get_job, indexed_jobs_defined_by,
     job_exists, parse_job_list, set_job, set_job_args)
 from ..jobs.storage import get_job_args
 from ..structures import Job, Promise, same_computation
@@ -99,23 +100,22 @@ def clean_other_jobs(context):
     from compmake.ui import info
     
     todelete = set()
+
+    # the jobs defined by ['root'], from the index if available
+    root_jobs = indexed_jobs_defined_by(['root'], db)
     
     for job_id in all_jobs(force_db=True, db=db):
         if not context.was_job_defined_in_this_session(job_id):
             # it might be ok if it was not defined by ['root']
-            job = get_job(job_id, db=db)
-            if job.defined_by != ['root']:
+            if root_jobs is not None:
+                is_root = job_id in root_jobs
+            else:
+                is_root = get_job(job_id, db=db).defined_by == ['root']
+            if not is_root:
                 # keeping this around
                 continue
-            
-            who = job.defined_by[1:]
-            if who:
-                defined = ' (defined by %s)' % "->".join(who)
-            else:
-                defined = ""
 
-            info('Job %r not defined in this session%s; cleaning.' 
-                 % (job_id,defined))
+            info('Job %r not defined in this session; cleaning.' % job_id)
 # 
 #             if not clean_all:
 #                 # info('Job %s defined-by %s' % (job_id, job.defined_by))
@@ -351,6 +351,7 @@ def comp_(context, command_, *args, **kwargs):
             command_desc=command_desc,
             needs_context=needs_context,
             defined_by=context.currently_executing)
+    c.code_fingerprint = code_fingerprint(command)
     
     # Need to inherit the pickle
     if context.currently_executing[-1] != 'root':
@@ -509,6 +510,12 @@ def interpret_single_command(commands_line, context, cq):
         msg = "Unknown command %r (try 'help'). " % command_name
         raise UserError(msg)
 
+    # the graph of the jobs is read at the first command, then kept
+    activate_graph_index(context.get_compmake_db())
+    if cq.changes is not None:
+        # what the other processes changed since the last command
+        cq.refresh()
+
     # XXX: use more elegant method
     cmd = ui_commands[command_name]
     dbchange = cmd.dbchange
@@ -604,7 +611,7 @@ def interpret_single_command(commands_line, context, cq):
         return None
     finally:
         if dbchange:
-            cq.invalidate()
+            cq.refresh()
 
 
 @contract(returns=dict)
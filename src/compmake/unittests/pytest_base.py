@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 import os
 import pytest
+import subprocess
+import sys
 from shutil import rmtree
 from tempfile import mkdtemp
 
-from compmake import set_compmake_config, logger
+from compmake import get_compmake_config, set_compmake_config, logger
 from compmake.context import Context
 from compmake.exceptions import CommandFailed, MakeFailed
 from compmake.jobs import get_job, parse_job_list
@@ -15,10 +17,16 @@ from contracts import contract
 
 class CompmakeTestBase:
     """Base class for pytest-based compmake tests."""
-    
+
+    # configuration switches set for each test (see set_config())
+    config = {}
+
     @pytest.fixture(autouse=True)
     def setup_teardown(self):
         """Setup and teardown for each test."""
+        self._previous_config = {}
+        for name, value in self.config.items():
+            self.set_config(name, value)
         self.root0 = mkdtemp()
         self.root = os.path.join(self.root0, 'compmake')
         self.db = StorageFilesystem(self.root, compress=True)
@@ -35,7 +43,10 @@ class CompmakeTestBase:
             self.mySetUp()
         
         yield  # This is where the test will run
-        
+
+        for name, value in self._previous_config.items():
+            set_compmake_config(name, value)
+
         # Teardown logic (former tearDown method)
         if True:
             print('not deleting %s' % self.root0)
@@ -51,6 +62,12 @@ class CompmakeTestBase:
             else:
                 raise Exception(msg)
 
+    def set_config(self, name, value):
+        """ Sets a configuration switch until the end of the test. """
+        if not name in self._previous_config:
+            self._previous_config[name] = get_compmake_config(name)
+        set_compmake_config(name, value)
+
     # Keep the same helper methods
     def comp(self, *args, **kwargs):
         return self.cc.comp(*args, **kwargs)
@@ -98,6 +115,15 @@ class CompmakeTestBase:
         ret = compmake_main([self.root, '--nosysexit', '-c', cmd_string])
         assert ret == 0
 
+    @contract(cmd_string=str)
+    def run_elsewhere(self, cmd_string):
+        """ Runs the "compmake_main" script in another process. """
+        script = ('import sys\n'
+                  'from compmake.scripts.master import compmake_main\n'
+                  'sys.exit(compmake_main(sys.argv[1:]))')
+        subprocess.check_call([sys.executable, '-c', script, self.root,
+                               '--nosysexit', '-c', cmd_string])
+
     # Convert assertion methods to use pytest's assert
     def assert_defined_by(self, job_id, expected):
         assert self.get_job(job_id).defined_by == expected
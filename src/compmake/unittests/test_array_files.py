@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+
+import pytest
+
+from compmake.jobs import (array_files_dir, delete_all_job_data,
+                           get_job_userobject, job_userobject_sizeof,
+                           set_job_userobject)
+from .pytest_base import CompmakeTestBase
+
+np = pytest.importorskip('numpy')
+
+
+def big(n):
+    return dict(a=np.ones(n), b=[np.zeros(n), 'x'], c=np.ones(3))
+
+
+def total(x):
+    return x['a'].sum() + x['b'][0].sum()
+
+
+class TestArrayFiles(CompmakeTestBase):
+
+    config = dict(mmap_arrays=True)
+
+    def test_mmap(self):
+        n = 200 * 1000
+        self.comp(total, self.comp(big, n, job_id='a'), job_id='b')
+        self.assert_cmd_success('make')
+        assert get_job_userobject('b', self.db) == n
+
+        res = get_job_userobject('a', self.db)
+        assert isinstance(res['a'], np.memmap)
+        assert isinstance(res['b'][0], np.memmap)
+        assert res['b'][1] == 'x'
+        # too small
+        assert not isinstance(res['c'], np.memmap)
+
+        dirname = array_files_dir('a', self.db)
+        assert len(os.listdir(dirname)) == 2
+        assert job_userobject_sizeof('a', self.db) > 2 * n * 8
+
+        self.assert_cmd_success('dump a directory=%s' % self.root0)
+        with open(os.path.join(self.root0, 'a.pickle'), 'rb') as f:
+            dumped = pickle.load(f)
+        assert dumped['a'].sum() == n
+
+        delete_all_job_data('a', self.db)
+        assert not os.path.exists(dirname)
+
+    def test_disabled(self):
+        self.set_config('mmap_arrays', False)
+        self.comp(big, 200 * 1000, job_id='a')
+        self.assert_cmd_success('make')
+        res = get_job_userobject('a', self.db)
+        assert not isinstance(res['a'], np.memmap)
+        assert not os.path.exists(array_files_dir('a', self.db))
+
+    def test_rewrite(self):
+        self.comp(big, 200 * 1000, job_id='a')
+        self.assert_cmd_success('make')
+        dirname = array_files_dir('a', self.db)
+        before = set(os.listdir(dirname))
+        # being written by another process
+        other = os.path.join(dirname, '0.npy.tmp.%d.npy' % (os.getpid() + 1))
+        with open(other, 'wb'):
+            pass
+        set_job_userobject('a', dict(a=np.ones(200 * 1000) * 2), self.db)
+        after = set(os.listdir(dirname))
+        # new files, the old ones removed after the result was written
+        assert len(after) == 2 and not before & after
+        assert os.path.basename(other) in after
+        assert get_job_userobject('a', self.db)['a'].sum() == 400 * 1000
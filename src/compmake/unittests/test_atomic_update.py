@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+
+from compmake.jobs import (db_job_add_dynamic_children, db_job_add_parent,
+                           get_job)
+from compmake.storage import (MemoryCache, StorageFilesystem, StorageSQLite,
+                              atomic_update)
+from .pytest_base import CompmakeTestBase
+
+
+def f(*args):
+    return 1
+
+
+def add_parents(db, job_id, parents):
+    db.reopen_after_fork()
+    for parent in parents:
+        db_job_add_parent(db=db, job_id=job_id, parent=parent)
+
+
+class TestAtomicUpdate(CompmakeTestBase):
+
+    def engines(self):
+        return [StorageFilesystem(self.root0 + '/fs'),
+                StorageSQLite(self.root0 + '/sqlite'),
+                MemoryCache(StorageFilesystem(self.root0 + '/fs2'))]
+
+    def test_update(self):
+        for db in self.engines():
+            db['cm-x'] = [1]
+            assert db['cm-x'] == [1]
+
+            def append(x):
+                x.append(2)
+                return x
+
+            assert atomic_update(db, 'cm-x', append) == [1, 2]
+            assert db['cm-x'] == [1, 2]
+
+    def test_concurrent(self):
+        self.comp(f, job_id='child')
+        n, k = 4, 20
+        ctx = multiprocessing.get_context('fork')
+        for db in [self.db, StorageSQLite(self.root0 + '/sqlite')]:
+            if db is not self.db:
+                db['cm-job-child'] = get_job('child', self.db)
+            processes = [ctx.Process(target=add_parents,
+                                     args=(db, 'child',
+                                           ['p%d-%d' % (i, j)
+                                            for j in range(k)]))
+                         for i in range(n)]
+            for p in processes:
+                p.start()
+            for p in processes:
+                p.join()
+                assert p.exitcode == 0
+            parents = get_job('child', db).parents
+            assert len(parents) == n * k
+
+    def test_dynamic_children(self):
+        a = self.comp(f, job_id='a')
+        self.comp(f, a, job_id='b')
+        db_job_add_dynamic_children('b', set(['c']), 'a', self.db)
+        job = get_job('b', self.db)
+        assert job.children == set(['a', 'c'])
+        assert job.dynamic_children == {'a': set(['c'])}
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from compmake.jobs import (blob_refcounts, delete_all_job_data,
+                           get_job_args, get_job_userobject)
+from compmake.jobs.blobs import _as_blob, blob_prefix
+from .pytest_base import CompmakeTestBase
+
+np = pytest.importorskip('numpy')
+
+
+def g(x, k):
+    return x.sum() + k
+
+
+def f(k):
+    return dict(a=np.ones(20 * 1000) * k, k=k)
+
+
+class TestBlobs(CompmakeTestBase):
+
+    config = dict(blobs=True, blobs_min_size=10 * 1000)
+
+    def blobs_in_db(self):
+        return list(self.db.keys_with_prefix(blob_prefix))
+
+    def test_shared_args(self):
+        x = np.ones(10 * 1000)
+        for k in range(4):
+            self.comp(g, x, k, job_id='g%d' % k)
+        # the same array is stored once
+        assert len(self.blobs_in_db()) == 1
+        assert list(blob_refcounts(self.db).values()) == [4]
+
+        self.assert_cmd_success('make')
+        for k in range(4):
+            assert get_job_userobject('g%d' % k, self.db) == 10 * 1000 + k
+        args = get_job_args('g0', self.db)
+        assert np.all(args[1][0] == x)
+
+    def test_results(self):
+        self.comp(f, 1, job_id='a')
+        self.comp(f, 1, job_id='b')
+        self.comp(f, 2, job_id='c')
+        self.assert_cmd_success('make')
+        # equal results share the blob
+        assert len(self.blobs_in_db()) == 2
+        res = get_job_userobject('a', self.db)
+        assert res['k'] == 1 and res['a'].sum() == 20 * 1000
+
+        delete_all_job_data('c', self.db)
+        counts = blob_refcounts(self.db)
+        assert sorted(counts.values()) == [0, 2]
+
+        self.assert_cmd_success('gc-blobs dry_run=1')
+        assert len(self.blobs_in_db()) == 2
+        self.assert_cmd_success('gc-blobs')
+        assert len(self.blobs_in_db()) == 1
+        assert get_job_userobject('b', self.db)['a'].sum() == 20 * 1000
+
+    def test_disabled(self):
+        self.set_config('blobs', False)
+        self.comp(f, 1, job_id='a')
+        self.assert_cmd_success('make')
+        assert self.blobs_in_db() == []
+        assert get_job_userobject('a', self.db)['k'] == 1
+
+    def test_changed_in_place(self):
+        x = np.zeros(10 * 1000)
+        self.comp(g, x, 0, job_id='g0')
+        x += 1
+        self.comp(g, x, 0, job_id='g1')
+        self.assert_cmd_success('make')
+        assert get_job_userobject('g0', self.db) == 0
+        assert get_job_userobject('g1', self.db) == 10 * 1000
+        assert len(self.blobs_in_db()) == 2
+
+    def test_hash_without_pickle(self):
+        a = np.arange(10 * 1000, dtype='float64')
+        h, data = _as_blob(a, 1000)
+        assert data is None
+        # non contiguous, same content
+        b = np.vstack([a, a]).T[:, 0]
+        assert _as_blob(b, 1000)[0] == h
+        assert _as_blob(a.astype('float32'), 1000)[0] != h
+        assert _as_blob(a.tobytes(), 1000)[0] != h
+        assert _as_blob('x' * 10, 1000) == (None, None)
+        assert _as_blob(a[:10], 1000) == (None, None)
+        # the others are pickled
+        assert _as_blob(list(range(1000)), 1000)[1] is not None
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import pickle
+
+from compmake.jobs import (delete_all_job_data, get_job_cache,
+                           job2cachedetailskey, job2cachekey, mark_to_remake,
+                           set_job_cache)
+from compmake.structures import Cache, cache_has_large_overhead
+from .pytest_base import CompmakeTestBase
+
+
+def f():
+    return 1
+
+
+def failing():
+    print('x' * 100000)
+    raise ValueError('bad')
+
+
+class TestCacheDetails(CompmakeTestBase):
+
+    def test_split(self):
+        self.comp(f, job_id='a')
+        self.assert_cmd_success('make')
+        record = self.db[job2cachekey('a')]
+        for field in Cache.details_fields:
+            assert not field in record.__dict__
+        assert len(pickle.dumps(record)) < 1000
+
+        cache = get_job_cache('a', self.db)
+        assert cache.state == Cache.DONE
+        assert not cache_has_large_overhead(cache)
+        assert not 'int_make' in cache.__dict__
+        assert cache.int_make.get_walltime_used() >= 0
+        assert cache.captured_stdout is None
+
+        self.assert_cmd_success('details a')
+        self.assert_cmd_success('ls')
+
+        # written back without loading the details: they are kept
+        mark_to_remake('a', self.db)
+        cache = get_job_cache('a', self.db)
+        assert cache.timestamp == Cache.TIMESTAMP_TO_REMAKE
+        assert cache.int_make is not None
+
+        delete_all_job_data('a', self.db)
+        assert not job2cachedetailskey('a') in self.db
+
+    def test_failed(self):
+        self.comp(failing, job_id='f')
+        self.assert_cmd_fail('make')
+        record = self.db[job2cachekey('f')]
+        assert len(pickle.dumps(record)) < 1000
+
+        cache = get_job_cache('f', self.db)
+        assert cache.state == Cache.FAILED
+        assert 'bad' in cache.exception
+        assert 'ValueError' in cache.backtrace
+        assert b'x' * 100000 in cache.captured_stdout
+        self.assert_cmd_success('details f')
+
+    def test_old_records(self):
+        self.comp(failing, job_id='a')
+        self.assert_cmd_fail('make')
+        # a record written before the split
+        old = get_job_cache('a', self.db)
+        for f in Cache.details_fields:
+            getattr(old, f)
+        old.__dict__.pop('walltime_overhead')
+        self.db[job2cachekey('a')] = old
+        del self.db[job2cachedetailskey('a')]
+
+        cache = get_job_cache('a', self.db)
+        assert b'x' * 100000 in cache.captured_stdout
+        assert getattr(cache, 'walltime_overhead', None) is None
+        self.assert_cmd_success('ls')
+
+        set_job_cache('a', cache, self.db)
+        assert not 'captured_stdout' in self.db[job2cachekey('a')].__dict__
+        assert b'x' * 100000 in get_job_cache('a', self.db).captured_stdout
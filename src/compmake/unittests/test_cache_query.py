@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from compmake.jobs import CacheQueryDB, all_jobs
+from compmake.structures import Promise
+from compmake.ui import batch_command
+from .pytest_base import CompmakeTestBase
+
+
+def f(*args):
+    return len(args)
+
+
+def g():
+    return 1
+
+
+def define(context):
+    # a new parent for an existing job
+    context.comp(f, Promise('b0'), job_id='dyn-a')
+    return context.comp(f, job_id='dyn-b')
+
+
+class TestCacheQuery(CompmakeTestBase):
+
+    def define_jobs(self):
+        # two chains: a0 <- a1 <- a2 and b0 <- b1, plus a dynamic job
+        a0 = self.comp(f, job_id='a0')
+        a1 = self.comp(f, a0, job_id='a1')
+        self.comp(f, a1, job_id='a2')
+        self.comp(f, self.comp(f, job_id='b0'), job_id='b1')
+        self.cc.comp_dynamic(define, job_id='d')
+
+    def statuses(self, cq):
+        jobs = sorted(all_jobs(self.db))
+        return dict((j, (cq.up_to_date(j)[0], cq.dependencies_up_to_date(j),
+                         sorted(cq.direct_children(j)),
+                         sorted(cq.direct_parents(j))))
+                    for j in jobs + ['missing'] if cq.job_exists(j))
+
+    def check(self, cq, commands):
+        """ Returns the jobs whose status was forgotten. """
+        batch_command(commands, context=self.cc, cq=cq)
+        forgotten = set(j for j in all_jobs(self.db)
+                        if not cq.up_to_date.is_cached(j))
+        assert self.statuses(cq) == self.statuses(CacheQueryDB(self.db))
+        return forgotten
+
+    def test_targeted(self):
+        self.define_jobs()
+        cq = CacheQueryDB(self.db)
+        self.statuses(cq)
+        # the chain "a" is not read again
+        assert self.check(cq, 'make b1') == set(['b0', 'b1'])
+        assert self.check(cq, 'make a0') == set(['a0', 'a1', 'a2'])
+        self.check(cq, 'make d')
+        assert 'dyn-a' in cq.all_jobs()
+        self.check(cq, 'invalidate b0')
+        assert not cq.up_to_date('b1')[0]
+        self.check(cq, 'make')
+        self.check(cq, 'clean d')
+        self.check(cq, 'delete a2')
+        assert not 'a2' in cq.all_jobs()
+
+    def test_parmake(self):
+        self.define_jobs()
+        cq = CacheQueryDB(self.db)
+        self.statuses(cq)
+        self.check(cq, 'make b0')
+        # d defines a parent of b0 in a worker
+        self.check(cq, 'parmake n=2 d')
+        self.check(cq, 'parmake n=2')
+        self.check(cq, 'invalidate a0')
+        self.check(cq, 'parmake n=2 a2')
+
+    def test_hit_rates(self):
+        self.comp(g, job_id='x')
+        cq = CacheQueryDB(self.db)
+        for _ in range(3):
+            cq.up_to_date('x')
+        hits, misses = cq.hit_rates()['up_to_date']
+        assert (hits, misses) == (2, 1)
+        # each instance has its own memo
+        assert CacheQueryDB(self.db).hit_rates()['up_to_date'] == (0, 0)
+
+    def test_other_process(self):
+        self.define_jobs()
+        cq = CacheQueryDB(self.db)
+        self.statuses(cq)
+        self.run_elsewhere('make b1')
+        # noticed by the next command, even one not changing the DB
+        batch_command('ls', context=self.cc, cq=cq)
+        assert cq.up_to_date('b1')[0]
+        assert self.statuses(cq) == self.statuses(CacheQueryDB(self.db))
+        self.run_elsewhere('invalidate b0')
+        cq.refresh()
+        assert not cq.up_to_date('b1')[0]
+        self.statuses(cq)
+        # the changes of this process alone do not forget everything
+        assert self.check(cq, 'make a0') == set(['a0', 'a1', 'a2'])
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import sys
+import types
+
+import pytest
+
+from compmake.context import Context
+from compmake.jobs import (code_fingerprint, get_job, get_job_cache,
+                           get_job_userobject)
+from compmake.jobs.code_fingerprint import Instances
+from .pytest_base import CompmakeTestBase
+
+module_name = 'compmake_test_code_fingerprint_module'
+
+calls = []
+
+source = '''
+def helper(x):
+    return x + %(inc)s
+
+def f(x):
+    """ %(doc)s """
+    calls.append('f')
+    return helper(x)
+
+def g(x):
+    calls.append('g')
+    return x * 2
+'''
+
+
+def load(inc=1, doc='f'):
+    """ Creates (again) the module, as if it was edited and reloaded. """
+    module = types.ModuleType(module_name)
+    module.__file__ = __file__
+    module.calls = calls
+    exec(source % dict(inc=inc, doc=doc), module.__dict__)
+    sys.modules[module_name] = module
+    return module
+
+
+class TestCodeFingerprint(CompmakeTestBase):
+
+    config = dict(check_code=True)
+
+    @pytest.fixture(autouse=True)
+    def module(self):
+        del calls[:]
+        yield
+        sys.modules.pop(module_name, None)
+
+    def test_fingerprint(self):
+        m1 = load()
+        fp = code_fingerprint(m1.f)
+        assert fp is not None
+        assert Instances.fingerprints[m1.f] == fp
+        assert code_fingerprint(len) is None
+        # a new function object with the same code
+        assert code_fingerprint(load().f) == fp
+        # the documentation does not matter
+        assert code_fingerprint(load(doc='other').f) == fp
+        # the function called changed
+        m2 = load(inc=2)
+        assert code_fingerprint(m2.f) != fp
+        assert code_fingerprint(m2.g) == code_fingerprint(m1.g)
+
+    def define(self, module):
+        """ Defines the jobs as a new run of the script would. """
+        self.cc = Context(db=self.db)
+        a = self.comp(module.f, 1, job_id='a')
+        self.comp(module.g, 2, job_id='b')
+        self.comp(module.g, a, job_id='c')
+
+    def test_edited(self):
+        self.define(load())
+        self.assert_cmd_success('make')
+        assert get_job_cache('a', self.db).code_fingerprint == \
+            get_job('a', self.db).code_fingerprint
+        del calls[:]
+
+        # same code: nothing to do
+        self.define(load(doc='other'))
+        for job_id in 'abc':
+            assert self.up_to_date(job_id)
+
+        # a uses the edited function, c uses a
+        self.define(load(inc=2))
+        assert not self.up_to_date('a')
+        assert self.up_to_date('b')
+        assert not self.up_to_date('c')
+        self.assert_cmd_success('make')
+        assert sorted(calls) == ['f', 'g']
+        assert get_job_userobject('c', self.db) == 6
+
+    def test_switch_off(self):
+        self.define(load())
+        self.assert_cmd_success('make')
+        self.set_config('check_code', False)
+        self.define(load(inc=2))
+        assert self.up_to_date('a')
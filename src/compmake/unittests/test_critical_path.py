@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from compmake.jobs import (CacheQueryDB, compute_priorities, get_job_cache,
+                           predict_durations, set_job_cache)
+from .pytest_base import CompmakeTestBase
+
+
+def long_step(x=None):
+    return x
+
+
+def short_step():
+    return 1
+
+
+def other_step():
+    return 2
+
+
+def simulate(priorities, durations, children, workers):
+    """ Returns the total time to make the jobs with the given number of
+        workers, choosing the ready job with the highest priority. """
+    done = set()
+    running = []  # (end, job_id)
+    t = 0.0
+    while len(done) < len(durations):
+        busy = set(j for _, j in running)
+        ready = [j for j in durations
+                 if not j in done and not j in busy and
+                 all(c in done for c in children.get(j, []))]
+        ready.sort(key=lambda j: (priorities[j], j))
+        while ready and len(running) < workers:
+            j = ready.pop()
+            running.append((t + durations[j], j))
+        running.sort()
+        t, j = running.pop(0)
+        done.add(j)
+    return t
+
+
+class TestCriticalPath(CompmakeTestBase):
+
+    def define(self):
+        """ A chain of 3 long jobs, and 4 short ones; all done. """
+        c0 = self.comp(long_step, job_id='c0')
+        c1 = self.comp(long_step, c0, job_id='c1')
+        self.comp(long_step, c1, job_id='c2')
+        for i in range(4):
+            self.comp(short_step, job_id='s%d' % i)
+        self.assert_cmd_success('make')
+        self.durations = dict(c0=10.0, c1=10.0, c2=10.0,
+                              s0=1.0, s1=1.0, s2=1.0, s3=1.0)
+        for job_id, walltime in self.durations.items():
+            cache = get_job_cache(job_id, self.db)
+            cache.walltime_used = walltime
+            set_job_cache(job_id, cache, self.db)
+        self.children = dict(c1=['c0'], c2=['c1'])
+
+    def priorities(self, mode):
+        self.set_config('priority', mode)
+        return compute_priorities(list(self.durations), CacheQueryDB(self.db))
+
+    def test_bottom_level(self):
+        self.define()
+        p = self.priorities('critical_path')
+        assert p == dict(c0=30.0, c1=20.0, c2=10.0,
+                         s0=1.0, s1=1.0, s2=1.0, s3=1.0)
+
+    def test_makespan(self):
+        self.define()
+        makespan = {}
+        for mode in ['heuristic', 'critical_path']:
+            makespan[mode] = simulate(self.priorities(mode), self.durations,
+                                      self.children, workers=2)
+        assert makespan['critical_path'] == 30.0
+        assert makespan['heuristic'] > 30.0
+
+    @pytest.mark.parametrize('state_table', [True, False])
+    def test_predict(self, state_table):
+        self.set_config('state_table', state_table)
+        self.define()
+        # never made
+        self.comp(long_step, job_id='c3')
+        self.comp(other_step, job_id='o')
+        jobs = list(self.durations) + ['c3', 'o']
+        d = predict_durations(jobs, CacheQueryDB(self.db))
+        assert d['c0'] == 10.0
+        assert d['c3'] == 10.0
+        assert d['o'] == (10.0 + 1.0) / 2
+
+    def test_make(self):
+        self.set_config('priority', 'critical_path')
+        self.define()
+        self.assert_cmd_success('clean; parmake n=2')
+        self.assertJobsEqual('done', sorted(self.durations))
+        self.set_config('priority', 'other')
+        self.assert_cmd_fail('clean; make')
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from compmake.jobs import get_job, get_job_cache, result_digest
+from .pytest_base import CompmakeTestBase
+
+calls = []
+values = {'a': 1}
+
+
+def source(name):
+    calls.append(name)
+    return values[name]
+
+
+def g(x, name):
+    calls.append(name)
+    return x + 1
+
+
+class TestEarlyCutoff(CompmakeTestBase):
+
+    config = dict(early_cutoff=True)
+
+    def mySetUp(self):
+        values['a'] = 1
+        del calls[:]
+
+    def define(self):
+        a = self.comp(source, 'a', job_id='a')
+        b = self.comp(g, a, 'b', job_id='b')
+        self.comp(g, b, 'c', job_id='c')
+        self.assert_cmd_success('make')
+        del calls[:]
+
+    def test_digests(self):
+        self.define()
+        cache = get_job_cache('b', self.db)
+        context = get_job('b', self.db).pickle_main_context
+        assert cache.result_digest == result_digest(2, context)
+        assert cache.hashes_dependencies == dict(
+            a=get_job_cache('a', self.db).result_digest)
+
+    def test_same_result(self):
+        self.define()
+        self.assert_cmd_success('remake a')
+        assert calls == ['a']
+        # the children are newer, but with the same results
+        assert self.up_to_date('b')
+        assert self.up_to_date('c')
+        # in other processes
+        before = dict((x, get_job_cache(x, self.db).timestamp) for x in 'abc')
+        self.assert_cmd_success('invalidate a; parmake n=2')
+        after = dict((x, get_job_cache(x, self.db).timestamp) for x in 'abc')
+        assert after['a'] > before['a']
+        assert after['b'] == before['b'] and after['c'] == before['c']
+
+    def test_different_result(self):
+        self.define()
+        values['a'] = 10
+        self.assert_cmd_success('remake a')
+        assert not self.up_to_date('b')
+        self.assert_cmd_success('make')
+        assert calls == ['a', 'b', 'c']
+
+    def test_cutoff_below(self):
+        """ b is made again with the same result: c is not. """
+        self.define()
+        self.assert_cmd_success('invalidate b; make')
+        assert calls == ['b']
+
+    def test_switch_off(self):
+        self.define()
+        self.set_config('early_cutoff', False)
+        self.assert_cmd_success('remake a')
+        assert not self.up_to_date('b')
+        self.assert_cmd_success('make')
+        assert calls == ['a', 'b', 'c']
+
+    def test_chain(self):
+        x = self.comp(source, 'a', job_id='j0')
+        for i in range(1, 50):
+            x = self.comp(g, x, 'j%d' % i, job_id='j%d' % i)
+        self.assert_cmd_success('make')
+        del calls[:]
+        self.assert_cmd_success('invalidate j0; make')
+        # each job was cut off looking at its child only
+        assert calls == ['a']
+        assert self.up_to_date('j49')
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import random
+from time import time
+
+from compmake.jobs import (CacheQueryDB, critical_path, get_job_cache,
+                           plan_make, set_job_cache, simulate_schedule)
+from .pytest_base import CompmakeTestBase
+from .test_critical_path import long_step, short_step
+
+
+class TestExplain(CompmakeTestBase):
+
+    config = dict(priority='critical_path')
+
+    def test_simulate(self):
+        # a chain of 3 and 4 independent jobs
+        durations = [10.0, 10.0, 10.0, 1.0, 1.0, 1.0, 1.0]
+        children = [[], [0], [1], [], [], [], []]
+        priorities = [30.0, 20.0, 10.0, 1.0, 1.0, 1.0, 1.0]
+        assert simulate_schedule(durations, children, priorities, 1) == 34.0
+        assert simulate_schedule(durations, children, priorities, 2) == 30.0
+        # the short jobs first
+        short_first = [3.0, 2.0, 1.0, 5.0, 5.0, 5.0, 5.0]
+        assert simulate_schedule(durations, children, short_first, 2) == 32.0
+        assert critical_path(durations, children) == (30.0, [0, 1, 2])
+        assert critical_path([], []) == (0.0, [])
+
+    def define(self):
+        c0 = self.comp(long_step, job_id='c0')
+        c1 = self.comp(long_step, c0, job_id='c1')
+        self.comp(long_step, c1, job_id='c2')
+        for i in range(4):
+            self.comp(short_step, job_id='s%d' % i)
+        self.assert_cmd_success('make')
+        for job_id in ['c0', 'c1', 'c2', 's0', 's1', 's2', 's3']:
+            cache = get_job_cache(job_id, self.db)
+            cache.walltime_used = 10.0 if job_id[0] == 'c' else 1.0
+            set_job_cache(job_id, cache, self.db)
+
+    def test_plan(self):
+        self.define()
+        assert plan_make(['c2', 's0'], CacheQueryDB(self.db)).jobs == []
+
+        self.assert_cmd_success('invalidate c0; invalidate s0')
+        # never made
+        self.comp(short_step, job_id='s4')
+        cq = CacheQueryDB(self.db)
+        plan = plan_make(['c2', 's0', 's1', 's4'], cq)
+        assert plan.jobs == ['c0', 'c1', 'c2', 's0', 's4']
+        assert plan.ready == 3
+        assert plan.from_history == 4
+        assert plan.total() == 32.0
+        assert plan.critical_path() == (30.0, ['c0', 'c1', 'c2'])
+        assert plan.makespan(2) == 30.0
+        curve = plan.speedup([1, 2, 4, 8])
+        # stops at the critical path
+        assert curve == [(1, 32.0, 1.0), (2, 30.0, 32.0 / 30)]
+        # memoized; at least one worker per job is the critical path
+        assert sorted(plan.makespans) == [1, 2]
+        assert plan.makespan(5) == 30.0
+
+    def test_command(self):
+        self.define()
+        self.assert_cmd_success('explain')
+        self.assert_cmd_success('invalidate c0; explain n=2')
+        self.assert_cmd_success('explain c2 n=3 format=json')
+        self.assert_cmd_fail('explain format=xml')
+        self.assert_cmd_fail('explain n=0')
+
+    def test_speed(self):
+        rng = random.Random(0)
+        n = 100 * 1000
+        children = [[rng.randrange(i) for _ in range(min(i, 2))]
+                    for i in range(n)]
+        durations = [rng.random() for _ in range(n)]
+        priorities = [rng.random() for _ in range(n)]
+        t0 = time()
+        makespan = simulate_schedule(durations, children, priorities, 16)
+        length, _ = critical_path(durations, children)
+        assert time() - t0 < 5
+        assert length <= makespan
+        assert sum(durations) / 16 <= makespan
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+import pytest
+
+from compmake.jobs import (delete_job, find_garbage, get_job_userobject,
+                           job2jobargskey, job2userobjectkey)
+from compmake.jobs.blobs import blob_prefix
+from .pytest_base import CompmakeTestBase
+
+np = pytest.importorskip('numpy')
+
+
+def f(x):
+    return x.sum()
+
+
+# no such process
+dead_pid = 2 ** 22 + 1
+
+
+class TestGCDB(CompmakeTestBase):
+
+    config = dict(blobs=True, blobs_min_size=1000)
+
+    def write(self, *path, **kwargs):
+        age = kwargs.get('age', 0)
+        filename = os.path.join(self.db.basepath, *path)
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as fo:
+            fo.write(b'x' * 100)
+        if age:
+            t = time.time() - age
+            os.utime(filename, (t, t))
+        return filename
+
+    def categories(self):
+        res = {}
+        for g in find_garbage(self.db):
+            res[g.category] = res.get(g.category, 0) + 1
+        return res
+
+    def test_gc_db(self):
+        self.comp(f, np.ones(1000), job_id='a')
+        self.comp(f, np.zeros(1000), job_id='b')
+        self.assert_cmd_success('make')
+        # the log of the last make
+        assert self.categories() == {'logs': 1}
+
+        dead = self.write('cm-job-a.pickle.tmp.%d' % dead_pid, age=7200)
+        alive = self.write('cm-job-a.pickle.tmp.%d' % os.getpid(), age=7200)
+        self.write('parmake_job2_new_process', 'a.results.pickle')
+        self.write('sge', '2020-01-01T00-00-00', 'w00', 'stdout')
+        # records of a job that does not exist anymore
+        delete_job('b', self.db)
+        self.db[job2userobjectkey('ghost')] = 42
+
+        expected = {'tmp': 1, 'new_process': 1, 'sge': 1, 'logs': 1,
+                    # args, result, cache, details, refs of the args
+                    'orphans': 6, 'blobs': 1}
+        assert self.categories() == expected
+        self.assert_cmd_success('gc-db dry_run=1')
+        assert self.categories() == expected
+        assert os.path.exists(dead)
+
+        self.assert_cmd_success('gc-db')
+        assert self.categories() == {}
+        assert not os.path.exists(dead)
+        assert os.path.exists(alive)
+        assert not job2jobargskey('b') in self.db
+        assert len(list(self.db.keys_with_prefix(blob_prefix))) == 1
+
+        assert get_job_userobject('a', self.db) == 1000
+        self.assert_cmd_success('make')
+
+    def test_other_host(self):
+        # the pid might be of a process on another host writing now
+        recent = self.write('cm-job-a.pickle.tmp.%d' % dead_pid)
+        self.write('arrays', 'a.tmp.%d' % dead_pid, 'x.npy')
+        assert self.categories() == {}
+        self.assert_cmd_success('gc-db')
+        assert os.path.exists(recent)
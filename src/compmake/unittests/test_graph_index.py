@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+import random
+from time import time
+
+from compmake.context import Context
+
+from compmake.jobs import (GraphIndex, activate_graph_index, all_jobs,
+                           children, deactivate_graph_index,
+                           definition_closure, delete_jobs_data,
+                           direct_children,
+                           direct_parents, get_graph_index, parents,
+                           top_targets)
+from compmake.structures import Promise
+from .pytest_base import CompmakeTestBase
+
+
+def f(*args):
+    return 1
+
+
+def gen(context, n):
+    res = [context.comp(f, i) for i in range(n)]
+    return context.comp(f, *res)
+
+
+def mockup(context):
+    a = context.comp(f, job_id='a')
+    b = context.comp(f, a, job_id='b')
+    context.comp(f, a, b, job_id='c')
+    context.comp_dynamic(gen, 3, job_id='d')
+    context.comp_dynamic(gen, 2, job_id='e')
+
+
+class FakeJob(object):
+
+    def __init__(self, children, parents, defined_by):
+        self.children = children
+        self.parents = parents
+        self.defined_by = defined_by
+        self.needs_context = False
+
+
+class TestGraphIndex(CompmakeTestBase):
+
+    def queries(self):
+        """ The results of all the queries, in a comparable form. """
+        db = self.db
+        jobs = sorted(all_jobs(db))
+        res = {}
+        for job_id in jobs:
+            res[job_id] = (direct_children(job_id, db),
+                           direct_parents(job_id, db),
+                           children(job_id, db),
+                           parents(job_id, db),
+                           definition_closure([job_id], db))
+        res['top'] = sorted(top_targets(db))
+        return res
+
+    def check_same(self):
+        activate_graph_index(self.db)
+        with_index = self.queries()
+        assert get_graph_index(self.db) is not None
+        deactivate_graph_index(self.db)
+        assert get_graph_index(self.db) is None
+        assert with_index == self.queries()
+
+    def test_same_results(self):
+        mockup(self.cc)
+        self.check_same()
+        self.assert_cmd_success('make recurse=1')
+        self.check_same()
+
+    def test_parmake(self):
+        mockup(self.cc)
+        self.assert_cmd_success('parmake recurse=1 n=2')
+        # the index used during parmake was kept up to date
+        index = get_graph_index(self.db)
+        assert index is not None
+        assert len(index) == len(list(all_jobs(self.db)))
+        assert index.jobs_defined('d') == set(['d-f', 'd-f-2', 'd-f-3', 'd-f-4'])
+        with_index = self.queries()
+        deactivate_graph_index(self.db)
+        assert with_index == self.queries()
+
+    def test_kept(self):
+        mockup(self.cc)
+        self.assert_cmd_success('make recurse=1')
+        index = get_graph_index(self.db)
+        assert index is not None
+        self.assert_cmd_success('clean d; parmake recurse=1 n=2; clean e')
+        # the same index, kept up to date across the commands
+        assert get_graph_index(self.db) is index
+        with_index = self.queries()
+        deactivate_graph_index(self.db)
+        assert with_index == self.queries()
+
+    def test_other_process(self):
+        mockup(self.cc)
+        self.assert_cmd_success('make recurse=1')
+        index = get_graph_index(self.db)
+        self.assert_cmd_success('ls')
+        assert get_graph_index(self.db) is index
+        self.run_elsewhere('clean d')
+        # loaded again by the next command
+        self.assert_cmd_success('ls')
+        assert get_graph_index(self.db) is not index
+        assert not get_graph_index(self.db).job_exists('d-f')
+        with_index = self.queries()
+        deactivate_graph_index(self.db)
+        assert with_index == self.queries()
+
+    def test_updates(self):
+        mockup(self.cc)
+        activate_graph_index(self.db)
+        get_graph_index(self.db)
+        self.comp(f, 'x', job_id='x')
+        # redefined, with new children
+        Context(db=self.db).comp(f, Promise('x'), job_id='b')
+        self.comp(f, self.comp(f, job_id='y'), job_id='z')
+        self.check_same()
+
+        activate_graph_index(self.db)
+        index = get_graph_index(self.db)
+        delete_jobs_data(['c'], self.db)
+        assert not index.job_exists('c')
+        assert top_targets(self.db) == ['d', 'e', 'z']
+
+    def test_overlay(self):
+        index = GraphIndex({})
+        index.overlay_max = 10
+        for i in range(100):
+            index.set_job('j%d' % i, FakeJob(set(['j%d' % (i - 1)]), set(),
+                                             ['root', 'j0']))
+        assert sum(len(x) for x in index.overlay.values()) <= 30
+        assert index.direct_children('j50') == set(['j49'])
+        assert len(index.closure(['j99'], 'children')) == 100  # with j-1
+        assert len(index.jobs_defined('j0')) == 100
+        index.delete_job('j5')
+        assert len(index.closure(['j99'], 'children')) == 94
+        assert len(index.jobs_defined('j0')) == 99
+
+    def test_speed(self):
+        n = 200 * 1000
+        jobs = {}
+        for i in range(n):
+            kids = set(['j%d' % (i // 2)]) if i > 0 else set()
+            dads = set('j%d' % k for k in [2 * i, 2 * i + 1] if 0 < k < n)
+            jobs['j%d' % i] = FakeJob(kids, dads, ['root'])
+        index = GraphIndex(jobs)
+
+        t0 = time()
+        for i in range(1000):
+            index.direct_children('j%d' % (i * 100))
+            index.direct_parents('j%d' % (i * 100))
+        assert time() - t0 < 0.1
+
+        t0 = time()
+        assert len(index.closure(['j0'], 'parents')) == n - 1
+        assert len(index.closure(['j%d' % (n - 1)], 'children')) == 18
+        assert time() - t0 < 2
+
+    def test_reach(self):
+        """ The closures are memoized, reused and forgotten when the
+            edges change. """
+        jobs = {}
+        n = 10
+        for i in range(n):
+            kids = set(['j%d' % (i - 1)]) if i > 0 else set()
+            dads = set(['j%d' % (i + 1)]) if i < n - 1 else set()
+            jobs['j%d' % i] = FakeJob(kids, dads, ['root'])
+        index = GraphIndex(jobs)
+        assert len(index.closure(['j5'], 'parents')) == 4
+
+        visited = []
+        row = index._row
+
+        def counting_row(relation, h):
+            visited.append(index.ids[h])
+            return row(relation, h)
+
+        index._row = counting_row
+        assert len(index.closure(['j2'], 'parents')) == 7
+        # j5 was not visited again
+        assert sorted(visited) == ['j2', 'j3', 'j4']
+        del visited[:]
+        assert len(index.closure(['j2'], 'parents')) == 7
+        assert visited == []
+
+        # a new parent of j7: forgets the closures containing j7 only
+        index.set_job('x', FakeJob(set(['j7']), set(), ['root']))
+        index.set_job('j7', FakeJob(set(['j6']), set(['j8', 'x']), ['root']))
+        assert set(index.reach['parents']) == set()
+        assert index.closure(['j2'], 'parents') == \
+            set(['j%d' % i for i in range(3, n)] + ['x'])
+        assert len(index.closure(['j1'], 'children')) == 1
+        index.set_job('j8', FakeJob(set(['j7']), set(['j9']), ['root']))
+        assert set(index.reach['children']) == set([index.handles['j1']])
+
+    def test_reach_random(self):
+        """ The memoized closures are the same as computed again. """
+        rng = random.Random(2)
+        n = 60
+        kids = dict(('j%d' % i, set()) for i in range(n))
+        index = GraphIndex({})
+
+        def set_job(job_id):
+            dads = set(x for x in kids if job_id in kids[x])
+            index.set_job(job_id, FakeJob(set(kids[job_id]), dads, ['root']))
+
+        def brute(job_id, relation):
+            res = set()
+            stack = [job_id]
+            while stack:
+                j = stack.pop()
+                if relation == 'children':
+                    following = kids[j]
+                else:
+                    following = [x for x in kids if j in kids[x]]
+                for x in following:
+                    if not x in res:
+                        res.add(x)
+                        stack.append(x)
+            return res
+
+        for job_id in kids:
+            set_job(job_id)
+        for _ in range(300):
+            a, b = sorted(rng.sample(range(n), 2))
+            parent, child = 'j%d' % b, 'j%d' % a
+            if rng.random() < 0.7:
+                kids[parent].add(child)
+            else:
+                kids[parent].discard(child)
+            set_job(parent)
+            set_job(child)
+            for _ in range(3):
+                job_id = 'j%d' % rng.randint(0, n - 1)
+                for relation in ['children', 'parents']:
+                    assert (index.closure([job_id], relation) ==
+                            brute(job_id, relation))
+        # the inverse map of the memoized closures is exact
+        for relation in ['children', 'parents']:
+            inverse = {}
+            for h, result in index.reach[relation].items():
+                for x in result:
+                    inverse.setdefault(x, set()).add(h)
+            assert index.reached_from[relation] == inverse
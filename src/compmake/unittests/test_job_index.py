@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import os
+
+from compmake.exceptions import CompmakeBug
+from compmake.jobs import (all_jobs, check_job_index, deactivate_graph_index,
+                           definition_closure, delete_jobs_data, get_job,
+                           get_job_index, job_index_job_defined, top_targets,
+                           update_job)
+from compmake.storage import get_storage_metrics, reset_storage_metrics
+from .pytest_base import CompmakeTestBase
+from .test_graph_index import f, mockup
+
+
+class TestJobIndex(CompmakeTestBase):
+
+    config = dict(job_index=True, storage_metrics=True)
+
+    def queries(self):
+        deactivate_graph_index(self.db)
+        jobs = sorted(all_jobs(self.db))
+        res = dict((job_id, definition_closure([job_id], self.db))
+                   for job_id in jobs)
+        res['top'] = sorted(top_targets(self.db))
+        return res
+
+    def check_same(self):
+        with_index = self.queries()
+        self.set_config('job_index', False)
+        without = self.queries()
+        self.set_config('job_index', True)
+        assert with_index == without
+        assert check_job_index(self.db) == []
+
+    def test_same_results(self):
+        mockup(self.cc)
+        self.check_same()
+        self.assert_cmd_success('parmake recurse=1 n=2')
+        self.check_same()
+        assert definition_closure(['d'], self.db) == \
+            set(['d-f', 'd-f-2', 'd-f-3', 'd-f-4'])
+        self.assert_cmd_success('clean d; make recurse=1')
+        self.check_same()
+        self.assert_cmd_success('check-consistency')
+
+    def test_no_job_reads(self):
+        mockup(self.cc)
+        deactivate_graph_index(self.db)
+        top_targets(self.db)
+        reset_storage_metrics(self.db.basepath)
+        assert top_targets(self.db) == ['c', 'd', 'e']
+        definition_closure(['d'], self.db)
+        reads = [k for k in get_storage_metrics(self.db.basepath).data
+                 if k[0] in ['get', 'get_many']]
+        assert reads == []
+
+    def test_converges(self):
+        mockup(self.cc)
+        get_job_index(self.db)
+        # changes made without the index
+        self.set_config('job_index', False)
+        self.comp(f, job_id='x')
+        delete_jobs_data(['d'], self.db)
+        self.set_config('job_index', True)
+        assert top_targets(self.db) == ['c', 'e', 'x']
+        assert check_job_index(self.db) == []
+
+        # e becomes a child of x
+        self.set_config('job_index', False)
+
+        def add_parent(job):
+            job.parents.add('x')
+            return job
+
+        def add_child(job):
+            job.children.add('e')
+            return job
+
+        update_job('e', add_parent, self.db)
+        update_job('x', add_child, self.db)
+        self.set_config('job_index', True)
+        errors = check_job_index(self.db)
+        assert len(errors) == 1 and "'e'" in errors[0]
+        try:
+            self.cc.batch_command('check_consistency raise_if_error=1')
+        except CompmakeBug as e:
+            assert 'rebuild-job-index' in str(e)
+        else:
+            raise Exception('Inconsistency not detected.')
+        self.assert_cmd_success('rebuild-job-index')
+        assert check_job_index(self.db) == []
+        assert top_targets(self.db) == ['c', 'x']
+
+    def test_late_append(self):
+        self.comp(f, job_id='a')
+        self.comp(f, job_id='x')
+        index = get_job_index(self.db)
+        old = get_job('a', self.db)
+
+        # another process writes a newer record of a and appends its
+        # line before this one appends the line of the old record
+        def add_parent(job):
+            job.parents.add('x')
+            return job
+
+        def add_child(job):
+            job.children.add('a')
+            return job
+
+        update_job('a', add_parent, self.db)
+        update_job('x', add_child, self.db)
+        job_index_job_defined('a', old, self.db)
+        # left to check-consistency and rebuild-job-index
+        assert index.read()['a'] == ('root', 0)
+        assert len(check_job_index(self.db)) == 1
+        self.assert_cmd_success('rebuild-job-index')
+        assert index.read()['a'] == ('root', 1)
+        assert check_job_index(self.db) == []
+
+    def test_unchanged_no_lock(self):
+        mockup(self.cc)
+        index = get_job_index(self.db)
+        top_targets(self.db)
+        locked = []
+        _locked = index._locked
+
+        def counting():
+            locked.append(1)
+            return _locked()
+
+        index._locked = counting
+        jobs = list(all_jobs(self.db))
+        reset_storage_metrics(self.db.basepath)
+        for job_id in jobs:
+            update_job(job_id, lambda job: job, self.db)
+        top_targets(self.db)
+        assert locked == []
+        # only the records being updated are read
+        reads = [k for k in get_storage_metrics(self.db.basepath).data
+                 if k[0] in ['get_many', 'keys', 'keys_with_prefix']]
+        assert reads == []
+
+    def test_compaction(self):
+        index = get_job_index(self.db)
+        index.compact_min = 10
+        self.comp(f, job_id='a')
+        for i in range(30):
+            self.comp(f, job_id='b%d' % i)
+            update_job('a', lambda job: job, self.db)
+            self.assert_cmd_success('delete b%d' % i)
+        index.read()
+        with open(index.log_filename) as log:
+            assert len(log.readlines()) <= 2 * 1 + 10
+        assert index.entries == dict(a=('root', 0))
+        assert os.path.exists(index.log_filename)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from compmake.context import Context
+from compmake.jobs import CacheQueryDB, get_job
+from compmake.storage import MemoryCache, StorageFilesystem, StorageSQLite
+from .pytest_base import CompmakeTestBase
+
+
+def f(x):
+    return x + 1
+
+
+class TestMemoryCache(CompmakeTestBase):
+
+    def test_hits(self):
+        cache = MemoryCache(self.db)
+        self.db['cm-job-a'] = 1
+        assert cache['cm-job-a'] == 1
+        assert cache['cm-job-a'] == 1
+        assert (cache.hits, cache.misses) == (1, 1)
+        # not cached by default
+        self.db['cm-res-a'] = 1
+        assert cache['cm-res-a'] == 1
+        assert 'cm-res-a' not in cache.data
+
+    def test_other_writer(self):
+        for db in [self.db, StorageSQLite(self.root0 + '/sqlite')]:
+            cache = MemoryCache(db)
+            db['cm-cache-a'] = 1
+            assert cache['cm-cache-a'] == 1
+            # written by somebody else
+            if db is self.db:
+                other = StorageFilesystem(db.basepath, compress=True)
+            else:
+                other = db
+            other['cm-cache-a'] = 2
+            assert cache['cm-cache-a'] == 2
+            assert cache.stale == 1
+            del db['cm-cache-a']
+            assert not 'cm-cache-a' in cache
+
+    def test_delete(self):
+        cache = MemoryCache(self.db)
+        cache['cm-job-a'] = 1
+        assert cache['cm-job-a'] == 1
+        del cache['cm-job-a']
+        assert not 'cm-job-a' in cache
+        assert cache.nbytes == 0
+
+    def test_eviction(self):
+        self.db['cm-job-a'] = 'x' * 1000
+        size = self.db.sizeof('cm-job-a')
+        cache = MemoryCache(self.db, max_bytes=int(size * 2.5))
+        for k in 'abcd':
+            self.db['cm-job-' + k] = 'x' * 1000
+            cache['cm-job-' + k]
+        assert cache.evictions == 2
+        assert list(cache.data) == ['cm-job-c', 'cm-job-d']
+        assert cache.nbytes <= cache.max_bytes
+
+    def test_transparent(self):
+        cache = MemoryCache(self.db)
+        self.cc = Context(db=cache)
+        self.comp(f, self.comp(f, 1, job_id='a'), job_id='b')
+        self.assert_cmd_success('make')
+        self.assert_cmd_success('parmake n=2')
+        self.assert_cmd_success('ls')
+        cq = CacheQueryDB(cache)
+        assert cq.up_to_date('b')
+        assert get_job('b', cache).job_id == 'b'
+        assert cache.hits > 0
+        assert cache.basepath == self.db.basepath
+        self.assert_cmd_success('check-consistency')
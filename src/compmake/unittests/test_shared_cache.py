@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+
+from compmake.context import Context
+from compmake.jobs import (SharedCache, get_job_cache, get_job_userobject,
+                           job_fingerprint, not_shareable, set_job_cache)
+from compmake.jobs.shared_cache import command_id
+from compmake.storage import StorageFilesystem
+from .pytest_base import CompmakeTestBase
+
+calls = []
+
+
+def f(x):
+    calls.append(x)
+    return x * 2
+
+
+def g(x, y=0):
+    calls.append(x)
+    return x + y + 1
+
+
+def defines(context):
+    return context.comp(f, 5)
+
+
+def define(context, x):
+    a = context.comp(f, x, job_id='a')
+    context.comp(g, a, y=10, job_id='b')
+    context.comp_dynamic(defines, job_id='d')
+
+
+class TestSharedCache(CompmakeTestBase):
+
+    config = dict(shared_cache_min_time=0)
+
+    def mySetUp(self):
+        self.set_config('shared_cache', self.root0 + '/shared')
+
+    def other(self, name):
+        db = StorageFilesystem(os.path.join(self.root0, name))
+        return Context(db=db)
+
+    def test_shared(self):
+        define(self.cc, 1)
+        self.assert_cmd_success('make recurse=1')
+        assert get_job_userobject('b', self.db) == 13
+        fp = job_fingerprint('b', self.db)
+        assert get_job_cache('b', self.db).fingerprint == fp
+        # the dynamic job is not shared
+        assert job_fingerprint('d', self.db) is None
+
+        del calls[:]
+        cc2 = self.other('other')
+        define(cc2, 1)
+        cc2.batch_command('make recurse=1')
+        db2 = cc2.get_compmake_db()
+        assert get_job_userobject('a', db2) == 2
+        assert get_job_userobject('b', db2) == 13
+        assert get_job_cache('b', db2).host == 'shared-cache'
+        assert job_fingerprint('b', db2) == fp
+        # including the job defined by the dynamic job
+        assert calls == []
+
+        del calls[:]
+        cc3 = self.other('third')
+        define(cc3, 2)
+        cc3.batch_command('make recurse=1')
+        assert get_job_userobject('b', cc3.get_compmake_db()) == 15
+        assert calls == [2, 4]
+
+    def test_min_time(self):
+        self.set_config('shared_cache_min_time', 1000)
+        define(self.cc, 1)
+        self.assert_cmd_success('make')
+        del calls[:]
+        cc2 = self.other('other')
+        define(cc2, 1)
+        cc2.batch_command('make')
+        assert calls == [1, 2]
+
+    def test_evict(self):
+        cache = SharedCache(self.root0 + '/evict', max_bytes=2500)
+        for i in range(3):
+            fp = '%064x' % i
+            cache.publish(fp, b'x' * 1000)
+            os.utime(cache.filename(fp), (i, i))
+        # the least recently used
+        cache.evict()
+        assert not '%064x' % 0 in cache
+        assert '%064x' % 1 in cache
+        found, value = cache.get('%064x' % 2)
+        assert found and value == b'x' * 1000
+        assert cache.get('%064x' % 3) == (False, None)
+
+    def test_constants(self):
+        def load(k):
+            namespace = {}
+            exec('def h(x):\n'
+                 '    def inner():\n'
+                 '        return %d\n'
+                 '    return x + inner()\n' % k, namespace)
+            return namespace['h']
+        context = dict(main_module='__main__')
+        assert command_id(load(1), context) == command_id(load(1), context)
+        # a constant of a nested function
+        assert command_id(load(1), context) != command_id(load(2), context)
+
+    def test_recorded(self):
+        define(self.cc, 1)
+        self.assert_cmd_success('make recurse=1')
+        assert get_job_cache('d', self.db).fingerprint == not_shareable
+        # a long chain, not made
+        x = self.comp(f, 0, job_id='c0')
+        for i in range(1, 500):
+            x = self.comp(g, x, job_id='c%d' % i)
+        assert job_fingerprint('c499', self.db) is not None
+        # the ones of the dependencies that are done are not computed
+        cache = get_job_cache('a', self.db)
+        cache.fingerprint = 'recorded'
+        set_job_cache('a', cache, self.db)
+        fp = job_fingerprint('b', self.db)
+        assert fp != get_job_cache('b', self.db).fingerprint
+        cache.fingerprint = not_shareable
+        set_job_cache('a', cache, self.db)
+        assert job_fingerprint('b', self.db) is None
+
+    def test_hash_seed(self):
+        script = ('import sys\n'
+                  'from compmake.context import Context\n'
+                  'from compmake.jobs import job_fingerprint\n'
+                  'from compmake.unittests.test_shared_cache import f\n'
+                  'cc = Context(db=sys.argv[1])\n'
+                  'x = frozenset(["a%d" % i for i in range(20)])\n'
+                  'cc.comp(f, [x, set(x), dict.fromkeys(x, x)], job_id="s")\n'
+                  'print(job_fingerprint("s", cc.get_compmake_db()))\n')
+        # compmake needs the file of the main module
+        filename = os.path.join(self.root0, 'seed.py')
+        with open(filename, 'w') as fo:
+            fo.write(script)
+        fps = set()
+        for seed in ['1', '2']:
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            dirname = os.path.join(self.root0, 'seed%s' % seed)
+            out = subprocess.check_output([sys.executable, filename,
+                                           dirname], env=env)
+            fps.add(out.split()[-1])
+        assert len(fps) == 1
+        assert fps != set([b'None'])
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+
+import pytest
+
+from compmake.exceptions import CompmakeBug, CompmakeException
+from compmake.jobs import (all_jobs, check_state_table,
+                           count_states_by_command, delete_all_job_data,
+                           get_job_cache, get_state_table, job2cachekey,
+                           jobs_copied, read_state_table, set_job_cache)
+from compmake.jobs.state_table import (state_table_dirname,
+                                       state_table_update)
+from compmake.structures import Cache
+from .pytest_base import CompmakeTestBase
+
+np = pytest.importorskip('numpy')
+
+
+def f(x):
+    return x
+
+
+def g(x):
+    if x < 0:
+        raise ValueError(x)
+    return x
+
+
+def counts(db):
+    res = count_states_by_command(all_jobs(db), db)
+    return dict((k, dict(v)) for k, v in res.items())
+
+
+class TestStateTable(CompmakeTestBase):
+
+    config = dict(state_table=True)
+
+    def define(self):
+        for i in range(3):
+            self.comp(f, i, job_id='f%d' % i)
+        self.comp(f, self.comp(g, -1, job_id='g0'), job_id='f3')
+        self.comp(g, 1, job_id='g1')
+
+    def test_counts(self):
+        self.define()
+        assert counts(self.db) == {'f': {Cache.NOT_STARTED: 4},
+                                   'g': {Cache.NOT_STARTED: 2}}
+        self.assert_cmd_fail('make')
+        expected = {'f': {Cache.DONE: 3, Cache.BLOCKED: 1},
+                    'g': {Cache.DONE: 1, Cache.FAILED: 1}}
+        assert counts(self.db) == expected
+        self.assertJobsEqual('failed', ['g0'])
+        self.assertJobsEqual('blocked', ['f3'])
+        self.assertJobsEqual('todo', ['g0', 'f3'])
+        self.assert_cmd_success('stats')
+
+        job_ids, commands, records = read_state_table(self.db)
+        i = job_ids.index('f0')
+        assert commands[i] == 'f'
+        assert records['state'][i] == Cache.DONE
+        assert records['walltime'][i] >= 0
+        assert records['timestamp'][i] > 0
+
+        # the same without the table
+        self.set_config('state_table', False)
+        assert counts(self.db) == expected
+
+    def test_updates(self):
+        self.define()
+        self.assert_cmd_fail('make')
+        self.assert_cmd_success('clean f0')
+        delete_all_job_data('f1', self.db)
+        expected = {'f': {Cache.DONE: 1, Cache.BLOCKED: 1,
+                          Cache.NOT_STARTED: 1},
+                    'g': {Cache.DONE: 1, Cache.FAILED: 1}}
+        assert counts(self.db) == expected
+        self.assertJobsEqual('done', ['f2', 'g1'])
+
+        # rebuilt if missing
+        shutil.rmtree(os.path.join(self.db.basepath, state_table_dirname))
+        assert counts(self.db) == expected
+
+    def test_missing_rows(self):
+        # jobs defined while the switch was off are added
+        self.set_config('state_table', False)
+        self.define()
+        self.assert_cmd_fail('make')
+        self.set_config('state_table', True)
+        get_state_table(self.db)
+        self.comp(f, 10, job_id='f10')
+        assert counts(self.db) == {'f': {Cache.DONE: 3, Cache.BLOCKED: 1,
+                                         Cache.NOT_STARTED: 1},
+                                   'g': {Cache.DONE: 1, Cache.FAILED: 1}}
+        states = get_state_table(self.db).read_states()
+        assert isinstance(states, np.ndarray)
+
+    def test_late_write(self):
+        self.define()
+        self.assert_cmd_fail('make')
+        old = get_job_cache('f0', self.db)
+        # another process writes a newer record of f0 and its row
+        # before this one writes the row of the old record
+        self.set_config('state_table', False)
+        set_job_cache('f0', Cache(Cache.NOT_STARTED), self.db)
+        self.set_config('state_table', True)
+        state_table_update('f0', old, self.db)
+        assert check_state_table(self.db) == []
+        self.assertJobsEqual('done', ['f1', 'f2', 'g1'])
+
+    def test_check(self):
+        self.define()
+        self.assert_cmd_fail('make')
+        assert check_state_table(self.db) == []
+
+        # a cache that cannot be read is deleted
+        self.db[job2cachekey('f0')] = 'not a cache'
+        with pytest.raises(CompmakeException):
+            get_job_cache('f0', self.db)
+        assert counts(self.db)['f'][Cache.NOT_STARTED] == 1
+        assert check_state_table(self.db) == []
+
+        # written without set_job_cache()
+        self.db[job2cachekey('f1')] = Cache(Cache.FAILED)
+        errors = check_state_table(self.db)
+        assert len(errors) == 1 and "'f1'" in errors[0]
+        try:
+            self.cc.batch_command('check_consistency raise_if_error=1')
+        except CompmakeBug as e:
+            assert 'rebuild-state-table' in str(e)
+        else:
+            raise Exception('Inconsistency not detected.')
+        self.assert_cmd_success('rebuild-state-table')
+        assert check_state_table(self.db) == []
+
+        self.db[job2cachekey('f1')] = Cache(Cache.DONE)
+        jobs_copied(['f1'], self.db)
+        assert check_state_table(self.db) == []
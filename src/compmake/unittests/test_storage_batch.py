@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from compmake.jobs import (CacheQueryDB, all_jobs, delete_job_caches,
+                           delete_jobs_data, get_job_caches, get_jobs)
+from compmake.storage import (MemoryCache, StorageSQLite, contains_many,
+                              delete_many, get_many, set_many)
+from compmake.structures import Cache
+from .pytest_base import CompmakeTestBase
+
+
+def f(x):
+    return x + 1
+
+
+class Plain(object):
+    """ An engine without the batch methods. """
+
+    def __init__(self):
+        self.data = {}
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+
+class TestBatch(CompmakeTestBase):
+
+    def engines(self):
+        return [self.db, StorageSQLite(self.root0 + '/sqlite'),
+                MemoryCache(StorageSQLite(self.root0 + '/sqlite2')),
+                Plain()]
+
+    def test_engines(self):
+        for db in self.engines():
+            items = dict(('cm-job-%d' % i, i) for i in range(20))
+            set_many(db, items)
+            keys = list(items) + ['missing']
+            assert contains_many(db, keys) == set(items)
+            assert get_many(db, keys) == items
+            delete_many(db, ['cm-job-0', 'cm-job-1', 'missing'])
+            assert len(get_many(db, keys)) == 18
+            assert not 'cm-job-0' in db
+
+    def test_jobs(self):
+        self.comp(f, self.comp(f, 1, job_id='a'), job_id='b')
+        self.comp(f, 2, job_id='c')
+        self.assert_cmd_success('make a')
+        caches = get_job_caches(['a', 'b'], self.db)
+        assert caches['a'].state == Cache.DONE
+        assert caches['b'].state == Cache.NOT_STARTED
+        assert sorted(get_jobs(['a', 'x'], self.db)) == ['a']
+
+        cq = CacheQueryDB(self.db)
+        cq.prefetch_tree(['b'])
+        assert cq.get_job.is_cached('a')
+        assert not cq.up_to_date('b')[0]
+
+        delete_jobs_data(['a', 'b'], self.db)
+        assert list(all_jobs(self.db)) == ['c']
+
+    def test_commands(self):
+        self.comp(f, self.comp(f, 1, job_id='a'), job_id='b')
+        self.assert_cmd_success('make')
+        self.assert_cmd_success('ls')
+        self.assert_cmd_success('stats')
+        self.assert_cmd_success('clean')
+        assert not self.up_to_date('a')
+        self.assert_cmd_success('make')
+        assert self.up_to_date('b')
+
+    def test_delete_caches(self):
+        self.comp(f, self.comp(f, 1, job_id='a'), job_id='b')
+        self.comp(f, 2, job_id='c')
+        self.assert_cmd_success('make')
+        cq = CacheQueryDB(self.db)
+        assert cq.up_to_date('b')[0]
+        delete_job_caches(['a', 'b'], self.db)
+        caches = get_job_caches(['a', 'b', 'c'], self.db)
+        assert caches['a'].state == Cache.NOT_STARTED
+        assert caches['b'].state == Cache.NOT_STARTED
+        assert caches['c'].state == Cache.DONE
+        cq.refresh()
+        assert not cq.up_to_date('b')[0]
+        self.assert_cmd_success('check-consistency')
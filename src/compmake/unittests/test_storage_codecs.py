@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from compmake.context import Context
+from compmake.exceptions import UserError
+from compmake.jobs import get_job_userobject
+from compmake.storage import StorageFilesystem, StorageSQLite
+from compmake.utils import (codec_available, pickle_decode, pickle_encode,
+                            safe_pickle_dump, safe_pickle_load)
+from .pytest_base import CompmakeTestBase
+
+np = pytest.importorskip('numpy')
+
+
+def make_array(n):
+    return np.arange(n, dtype='float64')
+
+
+class TestCodecs(CompmakeTestBase):
+
+    @pytest.mark.parametrize('codec', ['none', 'gzip', 'gzip:1', 'zstd:3',
+                                       'lz4'])
+    def test_roundtrip(self, codec):
+        if not codec_available(codec.split(':')[0]):
+            pytest.skip('codec %r not installed' % codec)
+        value = dict(a=np.ones((100, 100)), b='x' * 5000, c=[1, 2])
+        data = b''.join(pickle_encode(value, codec))
+        value2 = pickle_decode(data)
+        assert (value2['a'] == value['a']).all()
+        assert value2['a'].flags.writeable
+        assert value2['b'] == value['b']
+
+    def test_mixed_files(self):
+        # the format is recorded in the file, not in the extension
+        filename = self.root0 + '/x.pickle.gz'
+        for codec in [None, 'none', 'gzip:9']:
+            safe_pickle_dump([1, 2], filename, codec=codec)
+            assert safe_pickle_load(filename) == [1, 2]
+        safe_pickle_dump([1, 2], self.root0 + '/x.pickle')
+        assert safe_pickle_load(self.root0 + '/x.pickle') == [1, 2]
+
+    def test_unknown(self):
+        with pytest.raises(UserError):
+            pickle_encode(1, 'nope')
+
+    def test_per_prefix(self):
+        codecs = {'cm-res-': 'gzip', 'cm-job-': 'default'}
+        self.db = StorageFilesystem(self.root, compress=True, codecs=codecs)
+        self.cc = Context(db=self.db)
+        self.comp(make_array, 10000, job_id='a')
+        self.assert_cmd_success('make')
+        assert get_job_userobject('a', self.db).sum() == 10000 * 9999 / 2
+
+        def header(key):
+            with open(self.db.filename_for_key(key), 'rb') as f:
+                return f.read(12)
+
+        assert b'gzip' in header('cm-res-a')
+        assert b'none' in header('cm-cache-a')
+        assert header('cm-job-a').startswith(b'\x1f\x8b')
+
+        # written with different settings
+        self.db.codecs = {'cm-cache-': 'gzip:1', 'cm-res-': 'none'}
+        self.assert_cmd_success('remake a')
+        self.assert_cmd_success_script('ls')
+
+    def test_sqlite(self):
+        db = StorageSQLite(self.root, compress=True,
+                           codecs={'cm-res-': 'gzip'})
+        db['cm-res-a'] = make_array(1000)
+        db['cm-cache-a'] = 'small'
+        db['other'] = 'default'
+        assert db['cm-res-a'].shape == (1000,)
+        assert db['cm-cache-a'] == 'small'
+        assert db['other'] == 'default'
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+
+from compmake.jobs import all_jobs, get_job_userobject
+from compmake.storage import StorageFilesystem
+from compmake.storage.filesystem import read_layout, write_layout
+from compmake.utils.filesystem_utils import make_sure_dir_exists
+from .pytest_base import CompmakeTestBase
+
+
+def g(x):
+    return x + 1
+
+
+class TestLayout(CompmakeTestBase):
+
+    def define(self):
+        a = self.comp(g, 1, job_id='a')
+        self.comp(g, a, job_id='b')
+
+    def test_new_sharded(self):
+        root = os.path.join(self.root0, 'sharded')
+        db = StorageFilesystem(root, compress=True, layout='sharded')
+        db['cm-job-x'] = 1
+        filename = db.filename_for_key('cm-job-x')
+        assert os.path.dirname(os.path.dirname(filename)) != root
+        assert db.keys_with_prefix('cm-job-') == ['cm-job-x']
+
+        db2 = StorageFilesystem(root, compress=True)
+        assert db2.layout == 'sharded'
+        assert db2['cm-job-x'] == 1
+
+    def test_migrate(self):
+        self.define()
+        self.assert_cmd_success('make')
+        self.assert_cmd_success('migrate-layout layout=sharded')
+        assert read_layout(self.root) == ('sharded', None)
+        assert not [x for x in os.listdir(self.root) if '.pickle' in x]
+
+        assert sorted(all_jobs(self.db)) == ['a', 'b']
+        assert self.up_to_date('b')
+        # the script must detect the layout by itself
+        self.assert_cmd_success_script('ls')
+
+        self.assert_cmd_success('migrate-layout layout=flat')
+        assert read_layout(self.root) == ('flat', None)
+        assert get_job_userobject('b', self.db) == 3
+
+    def test_resume(self):
+        self.define()
+        self.assert_cmd_success('make')
+        # simulate an interrupted migration: only one file was moved
+        write_layout(self.root, 'sharded', previous='flat')
+        db = StorageFilesystem(self.root, compress=True)
+        key = 'cm-res-a'
+        dst = db.filename_for_key(key)
+        os.makedirs(os.path.dirname(dst))
+        os.rename(db.filename_for_key(key, layout='flat'), dst)
+
+        assert db[key] == 2
+        assert sorted(all_jobs(db)) == ['a', 'b']
+
+        # also in the new layout, more recent: deleted instead of moved
+        src = db.filename_for_key('cm-res-b', layout='flat')
+        dst = db.filename_for_key('cm-res-b')
+        make_sure_dir_exists(dst)
+        shutil.copy(src, dst)
+        calls = []
+        moved = db.migrate_layout('sharded',
+                                  progress=lambda i, n: calls.append((i, n)))
+        n = len(calls)
+        assert calls == [(i + 1, n) for i in range(n)]
+        assert moved == n - 1
+        assert read_layout(self.root) == ('sharded', None)
+        assert not list(db.keys0(layout='flat'))
+        assert db['cm-res-b'] == 3
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import os
+
+from compmake.plugins.sanity_check import check_manifest
+from compmake.storage import StorageFilesystem
+from compmake.storage.manifest import KeyManifest
+from .pytest_base import CompmakeTestBase
+
+
+class TestManifest(CompmakeTestBase):
+
+    def test_no_scan(self):
+        db = self.db
+        db['cm-job-a'] = 1
+        db['cm-job-b'] = 1
+        db['cm-job-a'] = 2
+        del db['cm-job-b']
+
+        def fail(*args, **kwargs):
+            raise Exception('should not list the directory')
+
+        db.keys0 = fail
+        assert db.keys_with_prefix('cm-job-') == ['cm-job-a']
+
+    def test_other_process(self):
+        # another instance sees what this one appended
+        other = StorageFilesystem(self.root, compress=True)
+        assert other.keys() == []
+        self.db['k1'] = 1
+        assert other.keys() == ['k1']
+        del self.db['k1']
+        other['k2'] = 2
+        assert other.keys() == ['k2']
+        assert self.db.keys() == ['k2']
+
+    def test_compact(self):
+        db = self.db
+        n = KeyManifest.compact_min + 10
+        for i in range(n):
+            db['k'] = i
+            del db['k']
+        size0 = os.stat(db.manifest.filename).st_size
+        assert db.keys() == []
+        size1 = os.stat(db.manifest.filename).st_size
+        assert size1 < size0
+
+    def test_rebuild(self):
+        self.db['a'] = 1
+        os.unlink(self.db.manifest.filename)
+        db2 = StorageFilesystem(self.root, compress=True)
+        assert db2.keys() == ['a']
+
+        # written behind our back
+        os.unlink(db2.filename_for_key('a'))
+        assert check_manifest(db2)
+        self.assert_cmd_success('rebuild-manifest')
+        assert not check_manifest(self.db)
+        assert self.db.keys() == []
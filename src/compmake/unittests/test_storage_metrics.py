@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import socket
+
+from compmake.storage import (StorageSQLite, get_storage_metrics,
+                              merge_storage_metrics, read_storage_metrics,
+                              reset_storage_metrics)
+from compmake.storage.metrics import (latency_buckets, merged_filename,
+                                      metrics_dirname)
+from .pytest_base import CompmakeTestBase
+
+
+def f(x):
+    return 'x' * x
+
+
+class TestStorageMetrics(CompmakeTestBase):
+
+    config = dict(storage_metrics=True)
+
+    def merged(self, db):
+        return merge_storage_metrics(read_storage_metrics(db.basepath))
+
+    def test_filesystem(self):
+        for i in range(3):
+            self.comp(f, 1000, job_id='f%d' % i)
+        self.assert_cmd_success('make')
+        m = self.merged(self.db)
+        assert m[('set', 'cm-job-')]['calls'] >= 3
+        assert m[('set', 'cm-res-')]['bytes'] > 0
+        assert m[('keys', 'cm-job-')]['calls'] > 0
+        for x in m.values():
+            assert sum(x['histogram']) == x['calls']
+
+        self.assert_cmd_success('storage-stats')
+        self.assert_cmd_success('storage-stats format=json')
+        self.assert_cmd_fail('storage-stats format=xml')
+
+        self.assert_cmd_success('storage-stats reset=1')
+        # only what was read after the reset
+        m = self.merged(self.db)
+        assert not ('set', 'cm-res-') in m
+
+    def test_workers(self):
+        for i in range(4):
+            self.comp(f, 1000, job_id='f%d' % i)
+        self.assert_cmd_success('parmake n=2')
+        datas = read_storage_metrics(self.db.basepath)
+        # the master and the workers
+        assert len(datas) >= 2
+        m = merge_storage_metrics(datas)
+        assert m[('set', 'cm-res-')]['calls'] >= 4
+        json.dumps(datas)
+
+    def test_sqlite(self):
+        db = StorageSQLite(self.root0 + '/sqlite')
+        db['cm-res-a'] = 'x' * 1000
+        assert db['cm-res-a'] == 'x' * 1000
+        assert 'cm-res-a' in db
+        db.get_many(['cm-res-a', 'cm-job-b'])
+        del db['cm-res-a']
+        m = self.merged(db)
+        assert m[('set', 'cm-res-')]['bytes'] > 1000
+        assert m[('get', 'cm-res-')]['calls'] == 1
+        assert m[('contains', 'cm-res-')]['calls'] == 1
+        assert m[('get_many', '*')]['keys'] == 2
+        assert m[('delete', 'cm-res-')]['calls'] == 1
+
+    def test_disabled(self):
+        self.set_config('storage_metrics', False)
+        reset_storage_metrics(self.db.basepath)
+        self.comp(f, 10, job_id='f')
+        self.assert_cmd_success('make')
+        assert get_storage_metrics(self.db.basepath).data == {}
+        assert self.merged(self.db) == {}
+
+    def test_compaction(self):
+        for i in range(4):
+            self.comp(f, 1000, job_id='f%d' % i)
+        self.assert_cmd_success('parmake n=2')
+        before = self.merged(self.db)
+        dirname = os.path.join(self.db.basepath, metrics_dirname)
+        # a process that exited
+        data = dict(latency_buckets=latency_buckets,
+                    ops=[dict(op='set', prefix='cm-res-', calls=1, keys=1,
+                              bytes=10, seconds=0.0,
+                              histogram=[1] + [0] * len(latency_buckets))])
+        dead = os.path.join(dirname, '%s-%d.json' % (socket.gethostname(),
+                                                     2 ** 22 + 1))
+        with open(dead, 'w') as fo:
+            json.dump(data, fo)
+        after = self.merged(self.db)
+        assert not os.path.exists(dead)
+        assert after[('set', 'cm-res-')]['calls'] == \
+            before[('set', 'cm-res-')]['calls'] + 1
+        assert os.path.exists(os.path.join(dirname, merged_filename))
+        assert self.merged(self.db) == after
+
+    def test_flush_errors(self):
+        metrics = get_storage_metrics(self.db.basepath)
+
+        def fail():
+            raise IOError('disk full')
+
+        metrics._flush = fail
+        metrics.last_flush = 0
+        try:
+            self.db['cm-res-x'] = 1
+            assert self.db['cm-res-x'] == 1
+        finally:
+            del metrics._flush
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import os
+
+from compmake.context import Context
+from compmake.jobs import all_jobs, get_job_userobject
+from compmake.storage import StorageSQLite, detect_storage_engine
+from .pytest_base import CompmakeTestBase
+
+
+def f(x):
+    return x * 2
+
+
+class TestSQLite(CompmakeTestBase):
+
+    def mySetUp(self):
+        self.db = StorageSQLite(self.root, compress=True)
+        self.cc = Context(db=self.db)
+
+    def test_exists(self):
+        db = self.db
+        k = 'ciao'
+        assert not k in db
+        db[k] = {'complex': 123}
+        assert k in db
+        assert db[k] == {'complex': 123}
+        assert db.sizeof(k) > 0
+        del db[k]
+        assert not k in db
+
+    def test_prefix(self):
+        db = self.db
+        for k in ['cm-job-a', 'cm-job-b', 'cm-jobx', 'cm-cache-a']:
+            db[k] = 1
+        assert db.keys_with_prefix('cm-job-') == ['cm-job-a', 'cm-job-b']
+        assert db.keys() == sorted(['cm-job-a', 'cm-job-b', 'cm-jobx',
+                                    'cm-cache-a'])
+
+    def test_make(self):
+        self.comp(f, self.comp(f, 1, job_id='a'), job_id='b')
+        self.assert_cmd_success('make')
+        assert sorted(all_jobs(self.db)) == ['a', 'b']
+        assert get_job_userobject('b', self.db) == 4
+
+        assert detect_storage_engine(self.root) == 'sqlite'
+        assert os.path.exists(os.path.join(self.root,
+                                           StorageSQLite.db_filename))
+        self.assert_cmd_success_script('ls')
+
+    def test_open_from_string(self):
+        cc = Context(db='sqlite:' + self.root)
+        assert isinstance(cc.get_compmake_db(), StorageSQLite)
+
+    def test_key_stat(self):
+        db = self.db
+        db['a'] = 1
+        db['b'] = 2
+        version = db.key_stat('b')[0]
+        # the row with the largest id, written again with the same size
+        del db['b']
+        db['b'] = 3
+        assert db.key_stat('b')[0] != version
+        assert db.key_stat('c') is None
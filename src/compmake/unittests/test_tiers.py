@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import os
+
+from compmake.jobs import get_job_userobject, job2userobjectkey
+from compmake.jobs.blobs import blob_prefix
+from compmake.storage import StorageFilesystem
+from .pytest_base import CompmakeTestBase
+
+
+def big(n):
+    return os.urandom(n)
+
+
+class TestTiers(CompmakeTestBase):
+
+    def mySetUp(self):
+        self.set_config('cold_dir', self.root0 + '/cold')
+
+    def define(self):
+        self.comp(big, 100 * 1000, job_id='big')
+        self.comp(big, 10, job_id='small')
+        self.comp(big, 100 * 1000, job_id='recent')
+        self.assert_cmd_success('make')
+        # as if they were last read two days ago
+        for job_id in ['big', 'small']:
+            key = job2userobjectkey(job_id)
+            filename = self.db.existing_filename_for_key(key)
+            st = os.stat(filename)
+            os.utime(filename, (st.st_atime - 2 * 24 * 3600, st.st_mtime))
+
+    def test_demote(self):
+        self.define()
+        value = get_job_userobject('big', self.db)
+        key = job2userobjectkey('big')
+        hot = self.db.filename_for_key(key)
+        os.utime(hot, (0, 0))
+        self.assert_cmd_success('tier-demote days=1 min_size=50000')
+        self.assert_cmd_success('tier-status')
+
+        cold = self.db.cold_filename_for_key(key)
+        assert cold.startswith(os.path.realpath(self.root0 + '/cold'))
+        assert not os.path.exists(hot) and os.path.exists(cold)
+        assert self.db.existing_filename_for_key(key) == cold
+        stats = self.db.tier_stats()
+        assert stats['cold'] == (1, os.stat(cold).st_size)
+        for job_id in ['small', 'recent']:
+            k = job2userobjectkey(job_id)
+            assert self.db.existing_filename_for_key(k) == \
+                self.db.filename_for_key(k)
+
+        # transparent reads
+        assert self.up_to_date('big')
+        self.set_config('cold_promote', False)
+        assert get_job_userobject('big', self.db) == value
+        assert os.path.exists(cold)
+
+        self.set_config('cold_promote', True)
+        assert get_job_userobject('big', self.db) == value
+        assert os.path.exists(hot) and not os.path.exists(cold)
+        assert self.db.tier_stats()['cold'] == (0, 0)
+
+    def test_rewrite(self):
+        self.define()
+        self.assert_cmd_success('tier-demote days=1 min_size=50000')
+        key = job2userobjectkey('big')
+        cold = self.db.cold_filename_for_key(key)
+        assert os.path.exists(cold)
+        self.assert_cmd_success('remake big')
+        assert not os.path.exists(cold)
+        assert self.db.tier_stats()['cold'] == (0, 0)
+
+    def test_not_configured(self):
+        self.set_config('cold_dir', '')
+        self.assert_cmd_fail('tier-demote')
+        self.assert_cmd_success('tier-status')
+
+    def test_moved_by_other(self):
+        self.define()
+        # another process demotes after this one looked for .compmake-cold
+        assert self.db.cold_dirname is None
+        other = StorageFilesystem(self.root, compress=True)
+        other.demote(self.root0 + '/cold', 50000, 24 * 3600)
+        key = job2userobjectkey('big')
+        assert os.path.exists(other.cold_filename_for_key(key))
+        assert len(get_job_userobject('big', self.db)) == 100 * 1000
+        assert self.db.cold_dirname == other.cold_dirname
+
+    def test_blobs(self):
+        self.set_config('blobs', True)
+        self.set_config('blobs_min_size', 50000)
+        self.define()
+        blobs = list(self.db.keys_with_prefix(blob_prefix))
+        assert len(blobs) == 2
+        for key in blobs:
+            filename = self.db.existing_filename_for_key(key)
+            st = os.stat(filename)
+            os.utime(filename, (st.st_atime - 2 * 24 * 3600, st.st_mtime))
+        self.assert_cmd_success('tier-demote days=1 min_size=50000')
+        assert self.db.tier_stats()['cold'][0] == 2
+        self.set_config('cold_promote', False)
+        assert len(get_job_userobject('big', self.db)) == 100 * 1000
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+import random
+
+from compmake.exceptions import CompmakeBug
+from compmake.jobs import (CacheQueryDB, children, compute_priorities,
+                           job2cachekey, job2key, parents)
+from compmake.structures import Cache, Job
+from .pytest_base import CompmakeTestBase
+
+
+class DictDB(object):
+    """ A DB in memory. """
+
+    def __init__(self):
+        self.data = {}
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+
+class CountingDB(DictDB):
+    """ Counts the reads. """
+
+    def __init__(self, db):
+        self.data = db.data
+        self.reads = 0
+
+    def __getitem__(self, key):
+        self.reads += 1
+        return self.data[key]
+
+
+def make_db(edges, state=Cache.DONE):
+    """ edges: job -> children, in an order where the children come
+        first; the timestamps (1, 2, ...) follow the order. """
+    db = DictDB()
+    jobs = {}
+    for i, (job_id, kids) in enumerate(edges):
+        jobs[job_id] = Job(job_id, set(kids), 'f', defined_by=['root'])
+        cache = Cache(state)
+        cache.timestamp = float(i + 1)
+        db[job2cachekey(job_id)] = cache
+    for job_id, job in jobs.items():
+        for c in job.children:
+            jobs[c].parents.add(job_id)
+    for job_id, job in jobs.items():
+        db[job2key(job_id)] = job
+    return db
+
+
+def chain(n):
+    return [('j%d' % i, ['j%d' % (i - 1)] if i else []) for i in range(n)]
+
+
+def diamonds(levels):
+    """ Each level has two jobs depending on both jobs of the level
+        below: there are 2^levels paths from the top to the bottom. """
+    edges = [('d0-a', []), ('d0-b', [])]
+    for l in range(1, levels):
+        below = ['d%d-a' % (l - 1), 'd%d-b' % (l - 1)]
+        edges.extend([('d%d-a' % l, below), ('d%d-b' % l, below)])
+    return edges
+
+
+def up_to_date_recursive(cq, job_id, memo):
+    """ The recursive implementation that was used before. """
+    if job_id in memo:
+        return memo[job_id]
+    cache = cq.get_job_cache(job_id)
+    memo[job_id] = res = _up_to_date_recursive(cq, job_id, cache, memo)
+    return res
+
+
+def _up_to_date_recursive(cq, job_id, cache, memo):
+    if cache.state == Cache.NOT_STARTED:
+        return False, 'Not started', cache.timestamp
+    if cache.timestamp == Cache.TIMESTAMP_TO_REMAKE:
+        return False, 'Marked invalid', cache.timestamp
+    for child in list(cq.direct_children(job_id)):
+        child_up, _, child_timestamp = up_to_date_recursive(cq, child, memo)
+        if not child_up:
+            return (False, 'At least: Dep %r not up to date.' % child,
+                    cache.timestamp)
+        if child_timestamp > cache.timestamp:
+            return (False, 'At least: Dep %r have been updated.' % child,
+                    cache.timestamp)
+    defined_by = list(cq.get_job(job_id).defined_by)
+    defined_by.remove('root')
+    for defby in defined_by:
+        if not up_to_date_recursive(cq, defby, memo)[0]:
+            return False, 'Definer %r not up to date.' % defby, cache.timestamp
+    if cache.state == Cache.FAILED:
+        return False, 'Failed', cache.timestamp
+    return True, '', cache.timestamp
+
+
+class TestUpToDateIterative(CompmakeTestBase):
+
+    def test_deep_chain(self):
+        n = 20 * 1000
+        db = make_db(chain(n))
+        top = 'j%d' % (n - 1)
+        cq = CacheQueryDB(db)
+        assert cq.up_to_date(top) == (True, '', float(n))
+        assert len(children(top, db)) == n - 1
+        assert len(parents('j0', db)) == n - 1
+        priorities = compute_priorities(['j%d' % i for i in range(n)], cq)
+        assert priorities['j0'] < priorities[top]
+
+        db[job2cachekey('j100')] = Cache(Cache.NOT_STARTED)
+        cq = CacheQueryDB(db)
+        assert cq.up_to_date(top) == (
+            False, "At least: Dep 'j%d' not up to date." % (n - 2), float(n))
+        assert cq.up_to_date('j100') == (False, 'Not started', 0.0)
+
+    def test_diamonds(self):
+        levels = 200
+        db = make_db(diamonds(levels))
+        top = 'd%d-a' % (levels - 1)
+        assert len(parents('d0-a', db)) == 2 * levels - 2
+        assert len(children(top, db)) == 2 * levels - 2
+        cq = CacheQueryDB(db)
+        assert cq.up_to_date(top)[0]
+        assert len(cq.tree([top])) == 2 * levels - 2
+
+    def test_same_results(self):
+        rng = random.Random(1)
+        n = 300
+        edges = []
+        for i in range(n):
+            kids = rng.sample(range(i), min(i, rng.randint(0, 3)))
+            edges.append(('j%d' % i, ['j%d' % k for k in kids]))
+        db = make_db(edges)
+        for i in range(n):
+            job_id = 'j%d' % i
+            if i > 0 and rng.random() < 0.3:
+                # some jobs defined by others
+                job = db[job2key(job_id)]
+                job.defined_by = ['root', 'j%d' % rng.randint(0, i - 1)]
+            cache = db[job2cachekey(job_id)]
+            r = rng.random()
+            if r < 0.05:
+                cache.state = Cache.NOT_STARTED
+            elif r < 0.1:
+                cache.state = Cache.FAILED
+            elif r < 0.15:
+                cache.timestamp = Cache.TIMESTAMP_TO_REMAKE
+            elif r < 0.3:
+                cache.timestamp = rng.uniform(1, n)
+
+        jobs = ['j%d' % i for i in range(n)]
+        rng.shuffle(jobs)
+        cq = CacheQueryDB(db)
+        expected = CacheQueryDB(db)
+        memo = {}
+        for job_id in jobs:
+            assert (cq.up_to_date(job_id) ==
+                    up_to_date_recursive(expected, job_id, memo))
+        # the same jobs were evaluated
+        assert set(k for k, in cq.up_to_date.cache) == set(memo)
+
+    def test_cycle(self):
+        db = make_db([('a', ['b']), ('b', [])])
+        db[job2key('b')].children.add('a')
+        try:
+            CacheQueryDB(db).up_to_date('a')
+        except CompmakeBug:
+            pass
+        else:
+            raise Exception('Cycle not detected.')
+
+    def test_linear_scaling(self):
+        """ 4 times the jobs take about 4 times the work, counted as
+            the queries to the DB and to CacheQueryDB. """
+
+        def measure(edges):
+            db = CountingDB(make_db(edges))
+            top, bottom = edges[-1][0], edges[0][0]
+            cq = CacheQueryDB(db)
+            cq.up_to_date(top)
+            parents(bottom, db)
+            children(top, db)
+            calls = sum(hits + misses
+                        for hits, misses in cq.hit_rates().values())
+            return db.reads + calls
+
+        for shape, n in [(chain, 2000), (diamonds, 500)]:
+            w1 = measure(shape(n))
+            w4 = measure(shape(4 * n))
+            print('%s: %d for %d, %d for %d' % (shape.__name__, w1, n,
+                                               w4, 4 * n))
+            # 16 times if it were quadratic
+            assert w4 < 5 * w1
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from compmake.jobs import get_job_cache, get_job_userobject
+from compmake.jobs.write_behind import WriteBehind
+from compmake.structures import Cache
+from .pytest_base import CompmakeTestBase
+
+
+def f(x):
+    return [x] * 1000
+
+
+def g(x):
+    return len(x)
+
+
+def cannot_pickle():
+    return lambda: None
+
+
+class TestWriteBehind(CompmakeTestBase):
+
+    config = dict(write_behind=True)
+
+    def define(self):
+        for i in range(4):
+            self.comp(g, self.comp(f, i, job_id='f%d' % i), job_id='g%d' % i)
+
+    def test_make(self):
+        self.define()
+        self.assert_cmd_success('make')
+        assert get_job_userobject('g3', self.db) == 1000
+
+    def test_parmake(self):
+        self.define()
+        self.assert_cmd_success('parmake n=2')
+        assert get_job_userobject('f2', self.db)[0] == 2
+        assert self.up_to_date('g2')
+
+    def test_write_fails(self):
+        self.comp(cannot_pickle, job_id='a')
+        self.comp(g, self.comp(f, 1, job_id='b'), job_id='c')
+        self.assert_cmd_fail('make')
+        cache = get_job_cache('a', self.db)
+        assert cache.state == Cache.FAILED
+        assert 'Could not write the result' in cache.exception
+        assert not 'a' in self.get_jobs('done')
+        # the other jobs were made
+        assert get_job_userobject('c', self.db) == 1000
+
+    def test_order_and_errors(self):
+        writer = WriteBehind(maxsize=1)
+        done = []
+        pendings = [writer.submit(done.append, i) for i in range(5)]
+        for p in pendings:
+            p.wait()
+        assert done == list(range(5))
+
+        def fail():
+            raise ValueError('cannot write')
+
+        p = writer.submit(fail)
+        with pytest.raises(ValueError):
+            p.wait()
@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
-import functools
 
 
 __all__ = [
     'memoized_reset',
+    'memoized_method',
 ]
 
 
@@ -51,10 +51,64 @@ class memoized_reset(object):
         return self.func.__doc__
 
     def __get__(self, obj, objtype):  # @UnusedVariable
-        """Support instance methods."""
-        fn = functools.partial(self.__call__, obj)
-        fn.reset = self._reset
+        """Support instance methods: each instance has its own cache.
+
+        The bound method is stored in the instance, so that this
+        is called only once per instance."""
+        if obj is None:
+            return self
+        fn = memoized_method(self.func, obj)
+        obj.__dict__[self.func.__name__] = fn
         return fn
 
-    def _reset(self):
+    def reset(self):
+        self.cache = {}
+
+
+class memoized_method(object):
+    """ The method of one instance decorated with memoized_reset.
+        Also counts the hits and misses of the cache. """
+
+    def __init__(self, func, obj):
+        self.func = func
+        self.obj = obj
         self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, *args):
+        try:
+            res = self.cache[args]
+        except KeyError:
+            self.misses += 1
+            value = self.func(self.obj, *args)
+            self.cache[args] = value
+            return value
+        except TypeError:
+            # uncachable
+            self.misses += 1
+            return self.func(self.obj, *args)
+        self.hits += 1
+        return res
+
+    def __repr__(self):
+        return self.func.__doc__
+
+    def reset(self):
+        """ Forgets all the values. """
+        self.cache = {}
+
+    def forget(self, *args):
+        """ Forgets the value for these arguments, if any. """
+        self.cache.pop(args, None)
+
+    def is_cached(self, *args):
+        return args in self.cache
+
+    def prime(self, value, *args):
+        """ Sets the value for these arguments. """
+        self.cache[args] = value
+
+    def items(self):
+        """ Returns the list of pairs (args, value) in the cache. """
+        return list(self.cache.items())
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
+import gzip
+import io
+import struct
 import sys
 
 from .debug_pickler import find_pickling_error
-from .safe_write import safe_read, safe_write
+from .safe_write import safe_write
 from compmake import logger
+from compmake.exceptions import UserError
 from contracts import describe_type
 
 
@@ -15,11 +19,238 @@ else:
 __all__ = [
     'safe_pickle_dump',
     'safe_pickle_load',
+    'pickle_encode',
+    'pickle_decode',
+    'register_codec',
+    'parse_codec_spec',
+    'codec_available',
+    'pickle_codecs',
 ]
 
+# Format of the files written with a codec:
+#
+#   magic
+#   codec name, "\n"
+#   uint32 number of segments
+#   for each segment: uint64 stored length, uint8 compressed flag
+#   the segments
+#
+# The first segment is the pickle stream; the others are the
+# out-of-band buffers of protocol 5 (e.g. the data of numpy arrays),
+# which are not copied into the pickle stream.
+codec_magic = b'\x00CMPK\x01'
+gzip_magic = b'\x1f\x8b'
+
+# segments smaller than this are never compressed
+codec_min_size = 1024
+
+
+class Codec(object):
+
+    def __init__(self, name, compress, decompress, default_level):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+        self.default_level = default_level
+
+    def __repr__(self):
+        return 'Codec(%r)' % self.name
+
+
+# name -> Codec
+pickle_codecs = {}
+
+
+def register_codec(name, compress, decompress, default_level=None):
+    """
+        Registers a codec.
+
+        compress(data, level) -> bytes
+        decompress(data) -> bytes
+
+        They should raise UserError if the codec is not available.
+    """
+    if name in pickle_codecs:
+        msg = 'Codec %r already registered.' % name
+        raise ValueError(msg)
+    pickle_codecs[name] = Codec(name, compress, decompress, default_level)
+
+
+def parse_codec_spec(spec):
+    """ Parses a string like "zstd:3" and returns the pair (codec, level). """
+    if ':' in spec:
+        name, level = spec.split(':', 1)
+        try:
+            level = int(level)
+        except ValueError:
+            msg = 'Invalid level in codec spec %r.' % spec
+            raise UserError(msg)
+    else:
+        name, level = spec, None
+    if not name in pickle_codecs:
+        msg = 'Unknown codec %r; known: %s.' % (name, sorted(pickle_codecs))
+        raise UserError(msg)
+    codec = pickle_codecs[name]
+    if level is None:
+        level = codec.default_level
+    return codec, level
+
+
+def codec_available(name):
+    """ Returns True if the module needed by the codec can be imported. """
+    try:
+        pickle_codecs[name].compress(b'', pickle_codecs[name].default_level)
+    except UserError:
+        return False
+    return True
+
+
+def _codec_missing(name, module):
+    msg = ('The codec %r needs the module %r, which is not installed.'
+           % (name, module))
+    return UserError(msg)
+
+
+def _none_compress(data, level):
+    return data
+
+
+def _none_decompress(data):
+    return data
+
+
+def _gzip_compress(data, level):
+    return gzip.compress(data, compresslevel=level)
+
+
+def _gzip_decompress(data):
+    return gzip.decompress(data)
+
+
+def _zstd_compress(data, level):
+    try:
+        import zstandard
+    except ImportError:
+        raise _codec_missing('zstd', 'zstandard')
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_decompress(data):
+    try:
+        import zstandard
+    except ImportError:
+        raise _codec_missing('zstd', 'zstandard')
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def _lz4_compress(data, level):
+    try:
+        import lz4.frame
+    except ImportError:
+        raise _codec_missing('lz4', 'lz4')
+    return lz4.frame.compress(data, compression_level=level)
+
+
+def _lz4_decompress(data):
+    try:
+        import lz4.frame
+    except ImportError:
+        raise _codec_missing('lz4', 'lz4')
+    return lz4.frame.decompress(data)
+
+
+register_codec('none', _none_compress, _none_decompress)
+register_codec('gzip', _gzip_compress, _gzip_decompress, default_level=5)
+register_codec('zstd', _zstd_compress, _zstd_decompress, default_level=3)
+register_codec('lz4', _lz4_compress, _lz4_decompress, default_level=0)
+
+
+def pickle_encode(value, codec, protocol=pickle.HIGHEST_PROTOCOL):
+    """
+        Pickles the value using the codec spec (e.g. "zstd:3").
+
+        Returns a list of bytes-like objects, to be written one
+        after the other.
+    """
+    codec, level = parse_codec_spec(codec)
+    if protocol >= 5:
+        buffers = []
+        data = pickle.dumps(value, protocol, buffer_callback=buffers.append)
+        segments = [data] + [b.raw() for b in buffers]
+    else:
+        segments = [pickle.dumps(value, protocol)]
+
+    stored = []
+    for segment in segments:
+        if codec.name != 'none' and len(segment) >= codec_min_size:
+            stored.append((codec.compress(segment, level), 1))
+        else:
+            stored.append((segment, 0))
+
+    header = [codec_magic, codec.name.encode('ascii'), b'\n',
+              struct.pack('<I', len(stored))]
+    for segment, compressed in stored:
+        header.append(struct.pack('<QB', len(segment), compressed))
+    return [b''.join(header)] + [segment for segment, _ in stored]
+
+
+def _pickle_load_encoded(f):
+    """ Reads the rest of an encoded file, after the magic. """
+    name = f.readline().strip().decode('ascii')
+    if not name in pickle_codecs:
+        msg = 'Data was written with unknown codec %r.' % name
+        raise ValueError(msg)
+    codec = pickle_codecs[name]
+    n, = struct.unpack('<I', f.read(4))
+    lengths = [struct.unpack('<QB', f.read(9)) for _ in range(n)]
+
+    segments = []
+    for length, compressed in lengths:
+        data = bytearray(length)
+        if f.readinto(data) != length:
+            msg = 'Truncated data (expected %d bytes).' % length
+            raise ValueError(msg)
+        if compressed:
+            # arrays must not be backed by read-only memory
+            data = bytearray(codec.decompress(data))
+        segments.append(data)
+
+    return pickle.loads(segments[0], buffers=segments[1:])
+
+
+def pickle_decode(data):
+    """ Inverse of pickle_encode(); also accepts a plain pickle. """
+    if data[:len(codec_magic)] == codec_magic:
+        f = io.BytesIO(data)
+        f.seek(len(codec_magic))
+        return _pickle_load_encoded(f)
+    return pickle.loads(data)
+
 
 def safe_pickle_dump(value, filename, protocol=pickle.HIGHEST_PROTOCOL,
-                     **safe_write_options):
+                     codec=None, **safe_write_options):
+    """
+        If codec is None, the pickle is written as-is (or in a gzip stream
+        if the filename contains ".gz"); otherwise it is written with the
+        given codec (see pickle_encode()), and the codec is recorded in
+        the file.
+    """
+    if codec is not None:
+        try:
+            chunks = pickle_encode(value, codec, protocol)
+        except (KeyboardInterrupt, UserError):
+            raise
+        except Exception:
+            msg = 'Cannot pickle object of class %s' % describe_type(value)
+            logger.error(msg)
+            msg = find_pickling_error(value, protocol)
+            logger.error(msg)
+            raise
+        with safe_write(filename, raw=True, **safe_write_options) as f:
+            for chunk in chunks:
+                f.write(chunk)
+        return
+
     with safe_write(filename, **safe_write_options) as f:
         try:
             pickle.dump(value, f, protocol)
@@ -34,7 +265,15 @@ def safe_pickle_dump(value, filename, protocol=pickle.HIGHEST_PROTOCOL,
 
 
 def safe_pickle_load(filename):
-    # TODO: add debug check 
-    with safe_read(filename) as f:
+    """ Loads files written by safe_pickle_dump() with any codec;
+        the format is detected from the content, not the filename. """
+    with open(filename, 'rb') as f:
+        magic = f.read(len(codec_magic))
+        if magic == codec_magic:
+            return _pickle_load_encoded(f)
+    if magic[:len(gzip_magic)] == gzip_magic:
+        with gzip.open(filename, 'rb') as f:
+            return pickle.load(f)
+    with open(filename, 'rb') as f:
         return pickle.load(f)
-        # TODO: add pickling debug
+    # TODO: add pickling debug
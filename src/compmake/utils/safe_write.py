@@ -17,10 +17,11 @@ def is_gzip_filename(filename):
 
 
 @contextmanager
-def safe_write(filename, mode='wb', compresslevel=5):
+def safe_write(filename, mode='wb', compresslevel=5, raw=False):
     """ 
         Makes atomic writes by writing to a temp filename. 
-        Also if the filename ends in ".gz", writes to a compressed stream.
+        Also if the filename ends in ".gz", writes to a compressed stream,
+        unless raw is True.
         Yields a file descriptor.
         
         It is thread safe because it renames the file.
@@ -41,7 +42,7 @@ def safe_write(filename, mode='wb', compresslevel=5):
                 #
     tmp_filename = '%s.tmp.%s' % (filename, os.getpid())
     try:
-        if is_gzip_filename(filename):
+        if is_gzip_filename(filename) and not raw:
             fopen = lambda fname, fmode: gzip.open(filename=fname, mode=fmode,
                                                    compresslevel=compresslevel)
         else: